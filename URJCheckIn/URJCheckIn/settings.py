@@ -18,9 +18,23 @@ DATABASES = {
         'PASSWORD': '',
         'HOST': '',                      # Empty for localhost through domain sockets or '127.0.0.1' for localhost through TCP.
         'PORT': '',                      # Set to empty string for default.
+        #Base de datos de los tests en un fichero (y no en memoria) para que
+        #los tests de concurrencia puedan usarla desde varios hilos
+        'TEST_NAME': 'test_db.sqlite',
     }
 }
 
+#Las clases que se estan impartiendo solo se cachean (ver get_active_lessons
+#en app/models.py) con una cache compartida por todos los procesos servidor,
+#como memcached; con la de por defecto (LocMemCache, una por proceso) no se
+#cachean porque al modificar una clase solo se invalidaria en un proceso
+#CACHES = {
+#    'default': {
+#        'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+#        'LOCATION': '127.0.0.1:11211',
+#    }
+#}
+
 # Hosts/domain names that are valid for this site; required if DEBUG is False
 # See https://docs.djangoproject.com/en/1.5/ref/settings/#allowed-hosts
 ALLOWED_HOSTS = []
@@ -93,6 +107,8 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    #Solo se usa si METRICS = True
+    'app.metrics.MetricsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -165,6 +181,12 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        #Check ins aceptados que no se han podido guardar (diario .failed)
+        'app.checkin_buffer': {
+            'handlers': ['mail_admins'],
+            'level': 'ERROR',
+            'propagate': True,
+        },
     }
 }
 
@@ -175,3 +197,16 @@ LOGOUT_URL = "/"
 #Para probar el envio de correos python -m smtpd -n -c DebuggingServer localhost:1026
 EMAIL_HOST = 'localhost'
 EMAIL_PORT = 1026
+
+#Ingesta de check ins en lotes por un unico hilo escritor (ver
+#app/checkin_buffer.py), util con SQLite cuando hay muchos check ins a la vez
+CHECKIN_BUFFER = False
+#Nombre base de los diarios de check ins pendientes (uno por proceso)
+CHECKIN_BUFFER_JOURNAL = 'checkins.journal'
+
+#Guardar en MEDIA_ROOT/csv/ una copia de los CSV subidos al admin (auditoria)
+CSV_KEEP_UPLOADS = False
+
+#Metricas de peticiones, consultas SQL y plantillas por vista en /metrics
+#(formato de Prometheus, solo staff). Ver app/metrics.py
+METRICS = False
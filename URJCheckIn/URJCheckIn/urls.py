@@ -33,6 +33,8 @@ urlpatterns = patterns('',
         name='create_lesson'),
     url(r'^subjects/(?P<idsubj>\d+)/statistics$',
         'app.views.subject_statistics', name='subject_statistics'),
+    url(r'^subjects/(?P<idsubj>\d+)/statistics/data$',
+        'app.views.subject_statistics_data', name='subject_statistics_data'),
     url(r'^img/(?P<path>.*)$', 'django.views.static.serve',
         {'document_root': 'static/images'}),
     url(r'^media/(?P<path>.*)$', 'django.views.static.serve', 
@@ -50,22 +52,31 @@ urlpatterns = patterns('',
     url(r'^firefoxos/(?P<path>.*)$', 'django.views.static.serve',
         {'document_root': 'static/firefoxos'}),
     url(r'reports$', 'app.views.reports_page', name='reports'),
-    url(r'more/reports/(?P<current>\d+)/(?P<newer>true|false)$',
+    url(r'more/reports/(?P<current>[\w-]+)/(?P<newer>true|false)$',
         'app.views.more_reports', name='more_reports'),
-    url(r'more/comments/(?P<current>\d+)/(?P<idlesson>\d+)/(?P<newer>true|false)$', 
+    url(r'more/comments/(?P<current>[\w-]+)/(?P<idlesson>\d+)/(?P<newer>true|false)$', 
         'app.views.more_comments', name='more_comments'),
-    url(r'more/lessons/(?P<current>\d+)/(?P<newer>true|false)$',
+    url(r'more/lessons/(?P<current>[\w-]+)/(?P<newer>true|false)$',
         'app.views.more_lessons',  name='more_lessons'),
     url(r'control/attendance$', 'app.views.control_attendance',
         name='control_attendance'),
+    url(r'control/attendance/export$', 'app.exports.export_attendance',
+        name='export_attendance'),
     url(r'control/codes$', 'app.views.show_codes', name='show_codes'),
+    url(r'^metrics$', 'app.metrics.metrics', name='metrics'),
     url(r'^logout$', 'app.views.my_logout', name='my_logout'),
     url(r'^login$', 'django.contrib.auth.views.login'),
     url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
     url(r'^admin/auth/user/csv/', 'app.admin_csv.create_users',
         name='csv_create_users'),
+    url(r'^admin/app/subject/csv/$', 'app.admin_csv.relate_subjects_users',
+        name='csv_relate_subjects_users'),
     url(r'^admin/app/subject/(?P<idsubj>\d+)/csv/',
         'app.admin_csv.relate_subject_user', name='csv_relate_subject_user'),
+    url(r'^admin/import_jobs/(?P<idjob>\d+)$',
+        'app.admin_csv.import_job_status', name='import_job_status'),
+    url(r'^admin/import_jobs/(?P<idjob>\d+)/progress$',
+        'app.admin_csv.import_job_progress', name='import_job_progress'),
     url(r'^admin/', include(admin.site.urls)),
     url(r'^email_change$', 'app.views.email_change', name='email_change'),
     url(r'^password_change/ajax$', 'app.views.password_change',
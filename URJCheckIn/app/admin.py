@@ -1,8 +1,11 @@
 from django.contrib import admin
 from models import (Degree, Subject, Room, UserProfile, Lesson, CheckIn,
-                ForumComment, Timetable, LessonComment, Building, AdminTask)
+                ForumComment, Timetable, LessonComment, Building, AdminTask,
+                OutboxEmail, ImportJob)
 from django.contrib.auth.models import User
 from django.contrib.auth.admin import UserAdmin
+from django.shortcuts import render_to_response
+from django.template import RequestContext
 import datetime
 from django.utils import timezone
 
@@ -84,6 +87,19 @@ class SubjectAdmin(admin.ModelAdmin):
     inlines = [
         TimetableInline,
     ]
+    actions = ['enroll_csv']
+
+    def enroll_csv(self, request, queryset):
+        """
+        Pagina para matricular a la vez en las asignaturas seleccionadas
+        a los usuarios de un fichero CSV
+        """
+        return render_to_response('admin/enroll_csv.html',
+                                  {'subjects': queryset,
+                                   'title': 'Matricular desde CSV'},
+                                  context_instance=RequestContext(request))
+    enroll_csv.short_description = 'Matricular desde CSV'
+
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
         if db_field.name == "creator":
             kwargs["initial"] = request.user
@@ -206,3 +222,27 @@ class AdminTaskAdmin(admin.ModelAdmin):
 
 admin.site.register(AdminTask, AdminTaskAdmin)
 
+###############
+# OutboxEmail #
+###############
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'to', 'created', 'sent', 'attempts',
+                    'next_attempt')
+    list_filter = ('sent', 'created')
+    search_fields = ('to', 'subject')
+
+admin.site.register(OutboxEmail, OutboxEmailAdmin)
+
+#############
+# ImportJob #
+#############
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'kind', 'user', 'status', 'created', 'finished',
+                    'rows_processed', 'rows_created', 'rows_skipped',
+                    'rows_errored')
+    list_filter = ('kind', 'status')
+    readonly_fields = ('started', 'finished', 'rows_processed',
+                       'rows_created', 'rows_skipped', 'rows_errored',
+                       'message')
+
+admin.site.register(ImportJob, ImportJobAdmin)
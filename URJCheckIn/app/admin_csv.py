@@ -4,8 +4,16 @@ reload(sys)
 sys.setdefaultencoding("utf-8")
 from django.contrib.auth.decorators import login_required
 from django.contrib.admin.views.decorators import staff_member_required
-from django.http import HttpResponseRedirect, HttpResponseBadRequest
-from models import get_rand_string, UserProfile, Degree, Subject
+from django.http import (HttpResponseRedirect, HttpResponseBadRequest,
+                         HttpResponse)
+from django.shortcuts import render_to_response, get_object_or_404
+from django.template import RequestContext
+from django.utils import timezone
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from models import (get_rand_string, UserProfile, Degree, Subject,
+                    OutboxEmail, outbox_email, update_subject_students,
+                    ImportJob)
 from django.conf import settings
 import os
 from django.utils.datastructures import MultiValueDictKeyError
@@ -14,24 +22,87 @@ from django.contrib.auth.models import User
 import unicodedata
 from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
-from django.core.mail import send_mail
+from django.utils.encoding import force_text
+import multiprocessing
+import codecs
+import logging
+import json
 
-def handle_uploaded_file(fich, root):
+#Procesos que calculan los hashes de las contrasenas al importar usuarios
+#(None para usar uno por nucleo)
+PASSWORD_HASH_WORKERS = getattr(settings, 'PASSWORD_HASH_WORKERS', None)
+#Contrasenas que se envian de una vez a cada proceso
+PASSWORDS_PER_WORKER = 16
+#Valores de cada consulta __in (SQLite admite como mucho 999 parametros)
+IN_QUERY_SIZE = 500
+#Filas de cada lote de una importacion en segundo plano
+IMPORT_BATCH_SIZE = getattr(settings, 'IMPORT_BATCH_SIZE', 1000)
+#Longitud maxima del resumen de filas omitidas de una importacion
+IMPORT_JOB_MESSAGE_LENGTH = 10000
+
+logger = logging.getLogger(__name__)
+
+def audit_file_name(fich, root):
     """
-    Guarda el fichero fich en el directorio root utilizando el nombre de
-    fich para guardarlo o poniendo ademas un string aleatorio en caso de
-    que ya exista un fichero con ese nombre
-    Devuelve el nombre del fichero guardado (indicando la ruta completa)
+    Devuelve la ruta en el directorio root con el nombre de fich o
+    poniendo ademas un string aleatorio en caso de que ya exista un
+    fichero con ese nombre
     """
     name = str(fich)
     fullname = root + name
     while os.path.exists(fullname):
         fullname = root + get_rand_string() + name
-    with open(fullname, 'wb+') as destination:
-        for chunk in fich.chunks():
-            destination.write(chunk)
     return fullname
 
+def iter_upload_lines(fich, copy=None, chunk_size=None):
+    """
+    Generador de las lineas (en utf-8) del fichero subido fich, leido
+    por trozos, decodificandolas y separandolas sobre la marcha, de
+    forma que nunca esta entero en memoria. Si se indica copy (fichero
+    abierto) se escribe en el cada trozo leido
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    pending = u''
+    first = True
+    for chunk in fich.chunks(chunk_size):
+        if copy is not None:
+            copy.write(chunk)
+        text = decoder.decode(chunk)
+        if first and text:
+            #Marca BOM que ponen algunos editores al principio
+            text = text.lstrip(u'\ufeff')
+            first = False
+        lines = (pending + text).splitlines(True)
+        #La ultima linea puede estar incompleta (si acaba en \r puede
+        #faltar el \n en el siguiente trozo)
+        pending = lines.pop() if lines and not lines[-1].endswith(u'\n') \
+                  else u''
+        for line in lines:
+            yield line.encode('utf-8')
+    pending += decoder.decode('', final=True)
+    if pending:
+        yield pending.encode('utf-8')
+
+def read_csv_upload(fich, keep_copy=None):
+    """
+    Generador de las filas del fichero csv subido fich, con los campos
+    separados por ';', leidas por trozos directamente de la subida
+    Solo se guarda una copia en MEDIA_ROOT/csv/ si keep_copy es True
+    (por defecto si esta activado CSV_KEEP_UPLOADS, para auditoria)
+    """
+    copy = None
+    if keep_copy is None:
+        keep_copy = getattr(settings, 'CSV_KEEP_UPLOADS', False)
+    if keep_copy:
+        copy = open(audit_file_name(fich, settings.MEDIA_ROOT + 'csv/'), 'wb')
+    try:
+        for row in csv.reader(iter_upload_lines(fich, copy), delimiter=';',
+                              quotechar='|'):
+            yield row
+    finally:
+        if copy is not None:
+            copy.close()
+
 @login_required
 @staff_member_required
 def create_users(request):
@@ -46,23 +117,99 @@ def create_users(request):
     except MultiValueDictKeyError:
         return HttpResponseBadRequest('Wrong form')
 
-    fname = handle_uploaded_file(r_file,  settings.MEDIA_ROOT + 'csv/')
+    job = ImportJob(kind='users', user=request.user)
+    job.csv_file.save(str(r_file), r_file)
+    return HttpResponseRedirect(job.get_absolute_url())
+
+@login_required
+@staff_member_required
+def import_job_status(request, idjob):
+    """
+    Pagina con el progreso de la importacion idjob, que se actualiza
+    consultando import_job_progress
+    """
+    job = get_object_or_404(ImportJob, id=idjob)
+    return render_to_response('admin/import_job.html',
+                              {'job': job,
+                               'title': job.get_kind_display()},
+                              context_instance=RequestContext(request))
+
+@login_required
+@staff_member_required
+def import_job_progress(request, idjob):
+    """Devuelve en JSON el estado y los contadores de la importacion"""
+    job = get_object_or_404(ImportJob, id=idjob)
+    return HttpResponse(json.dumps(job.progress()),
+                        content_type="application/json")
+
+def run_import_job(job):
+    """
+    Ejecuta la importacion job, guardando sus contadores tras cada lote
+    de IMPORT_BATCH_SIZE filas. Al terminar se borra el fichero salvo
+    que este activado CSV_KEEP_UPLOADS
+    """
     try:
-        with open(fname, 'rb') as csvfile:
-            reader = csv.reader(csvfile, delimiter=';', quotechar='|')
-            for row in reader:
-                create_user_and_profile(row)
-    except:
-        if os.path.exists(fname):
-            os.remove(fname)
-        return HttpResponseBadRequest('Error procesando el fichero')
-    if os.path.exists(fname):
-        os.remove(fname)
-    return HttpResponseRedirect('/admin/auth/user/')
-
-def create_user_and_profile(info):
-    """
-    Crea un usuario si no existe, el formato de info debe ser:
+        rows = read_csv_upload(job.csv_file, keep_copy=False)
+        if job.kind == 'users':
+            def progress(report):
+                save_job_progress(job, rows_processed=len(report),
+                    rows_created=len([r for r in report
+                                      if r['status'] == 'creado']),
+                    rows_skipped=len([r for r in report
+                                      if r['status'] == 'omitido']),
+                    rows_errored=len([r for r in report
+                                      if r['status'] == 'error']))
+            report = import_users(rows, batch_size=IMPORT_BATCH_SIZE,
+                                  progress=progress)
+            job.message = u'\n'.join(u'Fila %i (%s): %s' % (r['row'],
+                                            r['dni'], r['reason'])
+                                      for r in report
+                                      if r['status'] != 'creado'
+                                     )[:IMPORT_JOB_MESSAGE_LENGTH]
+        else:
+            subjects = list(job.subjects.values_list('id', flat=True))
+            dnis = []
+            for row in rows:
+                #Primera fila de la plantilla con el nombre del campo DNI
+                if row and row[0] != 'DNI':
+                    dnis.append(row[0])
+                if len(dnis) >= IMPORT_BATCH_SIZE:
+                    add_enroll_progress(job, enroll_dnis(dnis, subjects),
+                                        len(dnis))
+                    dnis = []
+            add_enroll_progress(job, enroll_dnis(dnis, subjects), len(dnis))
+        job.status = 'done'
+    except Exception as e:
+        logger.exception('Error en la importacion %i' % job.id)
+        job.status = 'failed'
+        job.message = force_text(e)
+    job.csv_file.close()
+    if not getattr(settings, 'CSV_KEEP_UPLOADS', False):
+        job.csv_file.delete(save=False)
+    job.finished = timezone.now()
+    job.save()
+
+def save_job_progress(job, **counters):
+    """Guarda solo los contadores counters de la importacion job"""
+    for name, value in counters.items():
+        setattr(job, name, value)
+    ImportJob.objects.filter(id=job.id).update(**counters)
+
+def add_enroll_progress(job, result, n_rows):
+    """
+    Suma a los contadores de job el resultado result de enroll_dnis para
+    un lote de n_rows filas
+    """
+    save_job_progress(job, rows_processed=job.rows_processed + n_rows,
+                      rows_created=job.rows_created + result['enrolled'],
+                      rows_skipped=job.rows_skipped +
+                                   result['already_enrolled'],
+                      rows_errored=job.rows_errored + result['unknown'])
+
+def import_users(rows, workers=None, batch_size=None, progress=None):
+    """
+    Crea en bloque los usuarios y perfiles de las filas rows y deja en
+    el outbox los correos de bienvenida. El formato de cada fila es:
     0->First_name (User)
     1->Last_name (User)
     2->Email (User)
@@ -71,66 +218,146 @@ def create_user_and_profile(info):
         por espacios si hay varios]
     5->Is_student (UserProfile) (Si=True / No=False) [realmente sera
         True si no pone 'No']
+    Los DNIs y nombres de usuario existentes se cargan antes en
+    conjuntos, los nombres de usuario se generan en memoria y los
+    usuarios, perfiles y grados se insertan con bulk_create, en una
+    transaccion por cada lote de batch_size usuarios (por defecto todos
+    en una). Los hashes de las contrasenas se calculan antes en paralelo
+    (ver make_passwords). Tras cada lote se llama a progress(report) si
+    se indica
+    Devuelve un informe con un diccionario por fila con 'row' (numero de
+    fila), 'dni', 'status' ('creado', 'omitido' o 'error' si la fila no
+    tiene el formato correcto), 'username' y 'reason' (motivo por el que
+    se omite)
     """
-    if len(info) < 6:
-        return
-    else:
+    dnis = set(UserProfile.objects.values_list('dni', flat=True))
+    usernames = UsernameAllocator(User.objects.values_list('username',
+                                                           flat=True))
+    degrees = dict(Degree.objects.values_list('code', 'id'))
+    report = []
+    new_rows = []
+    for nrow, info in enumerate(rows, 1):
+        dni = force_text(info[3]).strip() if len(info) > 3 else u''
+        result = {'row': nrow, 'dni': dni, 'status': 'error',
+                  'username': None, 'reason': None}
+        report.append(result)
+        if len(info) < 6:
+            result['reason'] = 'faltan columnas'
+            continue
         first_name = info[0].strip()
         last_name = info[1].strip()
         email = info[2].strip()
-        dni = info[3].strip()
-    if not first_name or not last_name or not dni:
-        return
-    #Primera linea de la plantilla con el nombre de los campos
-    elif dni == 'DNI':
-        return
-    elif UserProfile.objects.filter(dni=dni).exists():
-        return
-
-    user = create_user(first_name, last_name, email, dni)
-    if user.email:
-        #TODO poner enlace a la pagina en produccion
-        #TODO poner direccion de correo del emisor en produccion
-        send_mail('Bienvenido a URJCheckIn', 'Acaba de crearse una cuenta de' +
-                  ' usuario para esta dirección de correo.\nLos credenciales' +
-                  ' son:\n\tUsuario: ' + user.username + '\n\tContraseña: ' +
-                  'Introduzca su DNI\nLe recomendamos acceder a su perfil ' +
-                  'para modificar su contraseña.',
-                  'from@example.com',
-                  [user.email], fail_silently=False)
-    #en caso de error mejor poner que es estudiante
-    is_student = not (info[5]=='No')
-    create_profile(user, dni, is_student, info[4].split(), 100)
-
-def create_user(first_name, last_name, email, password):
-    """
-    Crea un usuario y lo devuelve. El username es generado a partir
-    de first_name y last_name
-    """
-    username = get_username(first_name, last_name)
-    user = User(username=username, first_name=first_name, last_name=last_name)
-    try:
-        validate_email(email)
-        user.email = email
-    except ValidationError:
-        pass
-    user.set_password(password)
-    user.save()
-    return user
-
-def create_profile(user, dni, is_student, degrees, age):
-    """
-    Crea un perfil de usuario, con los campos user, dni, is_student,
-    degrees y age
-    """
-    profile = UserProfile(user=user, dni=dni, is_student=is_student, age=age)
-    profile.save()
-    for d_code in degrees:
-        try:
-            degree = Degree.objects.get(code=d_code)
-        except Degree.DoesNotExist:
+        if not first_name or not last_name or not dni:
+            result['reason'] = 'faltan el nombre, los apellidos o el DNI'
+            continue
+        result['status'] = 'omitido'
+        #Primera linea de la plantilla con el nombre de los campos
+        if dni == 'DNI':
+            result['reason'] = 'cabecera'
             continue
-        profile.degrees.add(degree)
+        elif dni in dnis:
+            result['reason'] = 'ya existe un usuario con ese DNI'
+            continue
+        dnis.add(dni)
+        try:
+            validate_email(email)
+        except ValidationError:
+            email = ''
+        result['status'] = 'creado'
+        result['username'] = usernames.allocate(first_name, last_name)
+        new_rows.append({'result': result, 'first_name': first_name,
+                         'last_name': last_name, 'email': email,
+                         #en caso de error mejor poner que es estudiante
+                         'is_student': not (info[5]=='No'),
+                         'degrees': [degrees[code] for code in info[4].split()
+                                     if code in degrees]})
+        if batch_size and len(new_rows) >= batch_size:
+            insert_users(new_rows, workers)
+            new_rows = []
+            if progress is not None:
+                progress(report)
+    if new_rows:
+        insert_users(new_rows, workers)
+    if progress is not None:
+        progress(report)
+    return report
+
+def insert_users(new_rows, workers=None):
+    """
+    Inserta en una transaccion los usuarios, perfiles, grados y correos
+    de bienvenida de las filas new_rows ya comprobadas por import_users
+    """
+    #Las contrasenas iniciales son los DNIs
+    passwords = make_passwords([row['result']['dni'] for row in new_rows],
+                               workers)
+    usernames = [row['result']['username'] for row in new_rows]
+    dnis = [row['result']['dni'] for row in new_rows]
+    with transaction.commit_on_success():
+        #bulk_create no devuelve los ids asignados: se leen por los nombres
+        #de usuario y los DNIs insertados, que son unicos
+        User.objects.bulk_create([User(username=row['result']['username'],
+                                       first_name=row['first_name'],
+                                       last_name=row['last_name'],
+                                       email=row['email'],
+                                       password=password)
+                                  for row, password in zip(new_rows,
+                                                           passwords)])
+        user_ids = {}
+        for part in chunks(usernames):
+            user_ids.update(User.objects.filter(username__in=part
+                                    ).values_list('username', 'id'))
+        UserProfile.objects.bulk_create([UserProfile(
+                                user_id=user_ids[row['result']['username']],
+                                dni=row['result']['dni'],
+                                is_student=row['is_student'], age=100)
+                            for row in new_rows])
+        profile_ids = {}
+        for part in chunks(dnis):
+            profile_ids.update(UserProfile.objects.filter(dni__in=part
+                                    ).values_list('dni', 'id'))
+        through = UserProfile.degrees.through
+        through.objects.bulk_create([through(
+                                userprofile_id=profile_ids[row['result']['dni']],
+                                degree_id=iddegree)
+                            for row in new_rows
+                            for iddegree in set(row['degrees'])])
+        OutboxEmail.objects.bulk_create([welcome_mail(
+                                row['result']['username'], row['email'])
+                            for row in new_rows if row['email']])
+
+def make_passwords(passwords, workers=None):
+    """
+    Devuelve los hashes de las contrasenas passwords (los mismos que
+    pondria set_password), calculados en paralelo por un pool de
+    workers procesos (por defecto PASSWORD_HASH_WORKERS o uno por
+    nucleo)
+    """
+    if workers is None:
+        workers = PASSWORD_HASH_WORKERS or multiprocessing.cpu_count()
+    workers = min(workers, len(passwords) // PASSWORDS_PER_WORKER)
+    if workers < 2:
+        return [make_password(password) for password in passwords]
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(make_password, passwords,
+                        chunksize=PASSWORDS_PER_WORKER)
+    finally:
+        pool.close()
+        pool.join()
+
+def welcome_mail(username, email):
+    """
+    Devuelve (sin guardar) el OutboxEmail de bienvenida al usuario
+    username con direccion email
+    """
+    #TODO poner enlace a la pagina en produccion
+    #TODO poner direccion de correo del emisor en produccion
+    return outbox_email('Bienvenido a URJCheckIn', 'Acaba de crearse una ' +
+              'cuenta de usuario para esta dirección de correo.\nLos ' +
+              'credenciales son:\n\tUsuario: ' + username +
+              '\n\tContraseña: Introduzca su DNI\nLe recomendamos acceder ' +
+              'a su perfil para modificar su contraseña.',
+              'from@example.com', [email])
 
 def remove_accents(input_str):
     """
@@ -141,18 +368,31 @@ def remove_accents(input_str):
     nkfd_form = unicodedata.normalize('NFKD', unicode(input_str))
     return u"".join([c for c in nkfd_form if not unicodedata.combining(c)])
 
-def get_username(name, surname):
+class UsernameAllocator(object):
     """
-    Genera un nombre de usuario con la primera letra del nombre y el
-    primer apellido, si ya existe pone un numero al final
+    Genera en memoria nombres de usuario con la primera letra del
+    nombre y el primer apellido (si ya existe con un numero al final), a
+    partir de los nombres de usuario existentes usernames
     """
-    username = remove_accents((name[0:1] + surname.split()[0]).strip().lower())
-    username_tmp = username
-    num = 0
-    while User.objects.filter(username=username).exists():
-        num += 1
-        username = username_tmp + str(num)
-    return username
+    def __init__(self, usernames):
+        self.usernames = set(usernames)
+        #Siguiente numero a probar para cada nombre base
+        self.next_num = {}
+
+    def allocate(self, name, surname):
+        """Devuelve un nombre de usuario libre y lo marca como usado"""
+        username_tmp = remove_accents((name[0:1] +
+                                       surname.split()[0]).strip().lower())
+        username = username_tmp
+        num = self.next_num.get(username_tmp, 0)
+        if num > 0:
+            username = username_tmp + str(num)
+        while username in self.usernames:
+            num += 1
+            username = username_tmp + str(num)
+        self.next_num[username_tmp] = num + 1
+        self.usernames.add(username)
+        return username
 
 @login_required
 @staff_member_required
@@ -171,24 +411,78 @@ def relate_subject_user(request, idsubj):
     except Subject.DoesNotExist:
         return HttpResponseBadRequest('#404 The subject with id ' + 
                                       str(idsubj) + ' does not exist.')
+    return create_enroll_job(request, r_file, [subject.id])
 
-    fname = handle_uploaded_file(r_file,  settings.MEDIA_ROOT + 'csv/')
+@login_required
+@staff_member_required
+def relate_subjects_users(request):
+    """
+    Relaciona los usuarios cuyos DNIs aparecen en el csv con todas las
+    asignaturas indicadas en el campo subjects (desde la accion
+    'Matricular desde CSV' del admin)
+    """
+    if request.method != 'POST':
+        return HttpResponseBadRequest('Wrong method')
     try:
-        with open(fname, 'rb') as csvfile:
-            reader = csv.reader(csvfile, delimiter=';', quotechar='|')
-            for row in reader:
-                #Primera fila de la plantilla con el nombre del campo DNI
-                if row[0] != 'DNI':
-                    try:
-                        profile = UserProfile.objects.get(dni=row[0])
-                    except UserProfile.DoesNotExist:
-                        continue
-                    profile.subjects.add(subject)
-    except:
-        if os.path.exists(fname):
-            os.remove(fname)
-        return HttpResponseBadRequest('Error procesando el fichero')
-    if os.path.exists(fname):
-        os.remove(fname)
-    return HttpResponseRedirect('/admin/app/subject/')
+        r_file = request.FILES['csv_subject_users']
+        subjects = [int(idsubj) for idsubj in request.POST.getlist('subjects')]
+    except (MultiValueDictKeyError, ValueError):
+        return HttpResponseBadRequest('Wrong form')
+    subjects = list(Subject.objects.filter(id__in=subjects
+                                          ).values_list('id', flat=True))
+    if not subjects:
+        return HttpResponseBadRequest('Wrong form')
+    return create_enroll_job(request, r_file, subjects)
 
+def create_enroll_job(request, r_file, subjects):
+    """
+    Crea la importacion que matricula en las asignaturas con ids
+    subjects a los usuarios cuyos DNIs aparecen en el fichero csv r_file
+    y redirige a la pagina con su progreso
+    La importacion y sus asignaturas se guardan en la misma transaccion,
+    para que run_import_jobs no la ejecute antes de tener las asignaturas
+    """
+    with transaction.commit_on_success():
+        job = ImportJob(kind='enroll', user=request.user)
+        job.csv_file.save(str(r_file), r_file)
+        job.subjects.add(*subjects)
+    return HttpResponseRedirect(job.get_absolute_url())
+
+def chunks(values, size=IN_QUERY_SIZE):
+    """
+    Divide la lista values en listas de como mucho size elementos (para
+    no superar el numero maximo de parametros de una consulta en SQLite)
+    """
+    return [values[i:i+size] for i in range(0, len(values), size)]
+
+def enroll_dnis(dnis, subjects):
+    """
+    Matricula a los usuarios con DNI en dnis en todas las asignaturas
+    con ids subjects: los perfiles se buscan con consultas dni__in y las
+    matriculas que faltan se insertan con un bulk_create en una
+    transaccion
+    Devuelve un diccionario con el numero de matriculas nuevas
+    ('enrolled'), de las que ya existian ('already_enrolled') y de DNIs
+    que no corresponden a ningun usuario ('unknown')
+    """
+    dnis = list(set(force_text(dni).strip() for dni in dnis) - set([u'']))
+    profiles = set()
+    for dnis_chunk in chunks(dnis):
+        profiles.update(UserProfile.objects.filter(dni__in=dnis_chunk
+                                        ).values_list('id', flat=True))
+    through = UserProfile.subjects.through
+    enrolled = set(through.objects.filter(subject__in=subjects
+                            ).values_list('userprofile', 'subject'))
+    new_rows = [(idprofile, idsubj) for idsubj in subjects
+                for idprofile in profiles
+                if (idprofile, idsubj) not in enrolled]
+    with transaction.commit_on_success():
+        through.objects.bulk_create([through(userprofile_id=idprofile,
+                                             subject_id=idsubj)
+                                     for idprofile, idsubj in new_rows])
+        #bulk_create no envia m2m_changed, se actualizan aqui los contadores
+        if new_rows:
+            update_subject_students(subjects)
+    return {'enrolled': len(new_rows),
+            'already_enrolled': len(profiles)*len(subjects) - len(new_rows),
+            'unknown': len(dnis) - len(profiles)}
@@ -0,0 +1,286 @@
+# -*- encoding: utf-8 -*-
+"""
+Utilidades comunes de los benchmarks (comandos benchmark_*): base de
+datos temporal, generacion de datos de prueba y medicion de tiempo y
+numero de consultas
+"""
+from django.db import connection, transaction
+from django.test.utils import (setup_test_environment,
+                               teardown_test_environment)
+from django.contrib.auth.models import User
+from django.contrib.auth.hashers import make_password
+from django.utils import timezone
+from contextlib import contextmanager
+from models import (Degree, Subject, Building, Room, UserProfile, Lesson,
+                    Timetable, CheckIn, LessonComment, ForumComment,
+                    AdminTask, update_lesson_counters, mark_stats_dirty)
+import datetime
+import tempfile
+import random
+import time
+import os
+import pytz
+
+#Contrasena de todos los usuarios generados
+BENCHMARK_PASSWORD = 'benchmark'
+#Franjas (hora de inicio, hora de fin) en las que se generan las clases
+LESSON_HOURS = ((9, 11), (11, 13), (13, 15), (15, 17), (17, 19), (19, 21))
+
+
+@contextmanager
+def benchmark_database(verbosity=0):
+    """
+    Crea una base de datos de pruebas en un fichero sqlite temporal (en
+    un fichero y no en memoria para poder usarla desde varios hilos o
+    procesos) y la destruye al terminar
+    """
+    settings_dict = connection.settings_dict
+    old_name = settings_dict['NAME']
+    old_test_name = settings_dict.get('TEST_NAME')
+    if settings_dict['ENGINE'].endswith('sqlite3'):
+        fd, test_name = tempfile.mkstemp(prefix='urjcheckin_bench_',
+                                         suffix='.sqlite')
+        os.close(fd)
+        settings_dict['TEST_NAME'] = test_name
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity, autoclobber=True)
+    try:
+        yield settings_dict['NAME']
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity)
+        settings_dict['TEST_NAME'] = old_test_name
+        teardown_test_environment()
+
+
+def measure(func, *args, **kwargs):
+    """
+    Ejecuta func(*args, **kwargs) y devuelve una tupla (segundos,
+    numero de consultas, resultado)
+    """
+    old_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    first_query = len(connection.queries)
+    start = time.time()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        n_queries = len(connection.queries) - first_query
+        connection.use_debug_cursor = old_debug_cursor
+    return elapsed, n_queries, result
+
+
+def create_dataset(n_buildings=2, rooms_per_building=20, n_degrees=4,
+                   n_subjects=60, n_students=1000, subjects_per_student=6,
+                   lessons_per_week=2, weeks=17, seed=0):
+    """
+    Genera con bulk_create un semestre de datos de prueba: edificios,
+    aulas, grados, asignaturas con sus horarios y sus clases (sin
+    solapamientos), un profesor por asignatura y alumnos matriculados
+    El semestre empieza weeks/2 semanas antes de hoy, de forma que hay
+    clases pasadas y futuras. Todos los usuarios tienen la contrasena
+    BENCHMARK_PASSWORD
+    Devuelve un diccionario con el numero de objetos creados
+    """
+    rand = random.Random(seed)
+    today = datetime.date.today()
+    first_date = today - datetime.timedelta(days=today.weekday() +
+                                            7*(weeks//2))
+    last_date = first_date + datetime.timedelta(days=7*weeks - 1)
+    current_tz = pytz.timezone(str(timezone.get_current_timezone()))
+    password = make_password(BENCHMARK_PASSWORD)
+
+    with transaction.commit_on_success():
+        Building.objects.bulk_create([Building(building='B%i' % i)
+                                      for i in range(n_buildings)])
+        buildings = list(Building.objects.order_by('id'))
+        Room.objects.bulk_create([Room(room='%i' % i, building=building,
+                                       centre_longitude=-3.8,
+                                       centre_latitude=40.3, radius=50)
+                                  for building in buildings
+                                  for i in range(rooms_per_building)])
+        rooms = list(Room.objects.order_by('id'))
+        Degree.objects.bulk_create([Degree(name='Grado %i' % i,
+                                           code='G%i' % i)
+                                    for i in range(n_degrees)])
+        degrees = list(Degree.objects.order_by('id'))
+
+        User.objects.bulk_create([User(username='prof%i' % i,
+                                       password=password,
+                                       first_name='Profesor',
+                                       last_name='%i' % i)
+                                  for i in range(n_subjects)] +
+                                 [User(username='stud%i' % i,
+                                       password=password,
+                                       first_name='Alumno',
+                                       last_name='%i' % i)
+                                  for i in range(n_students)])
+        users = dict(User.objects.values_list('username', 'id'))
+        teachers = [users['prof%i' % i] for i in range(n_subjects)]
+        students = [users['stud%i' % i] for i in range(n_students)]
+        UserProfile.objects.bulk_create(
+                [UserProfile(user_id=iduser, is_student=False, age=40,
+                             dni='P%i' % iduser) for iduser in teachers] +
+                [UserProfile(user_id=iduser, is_student=True, age=20,
+                             dni='A%i' % iduser) for iduser in students])
+        profiles = dict(UserProfile.objects.values_list('user', 'id'))
+
+        Subject.objects.bulk_create([Subject(name='Asignatura %i' % i,
+                                             first_date=first_date,
+                                             last_date=last_date,
+                                             creator_id=teachers[i])
+                                     for i in range(n_subjects)])
+        subjects = list(Subject.objects.order_by('id'))
+        Subject.degrees.through.objects.bulk_create(
+                [Subject.degrees.through(subject_id=subject.id,
+                                         degree_id=degrees[i % n_degrees].id)
+                 for i, subject in enumerate(subjects)])
+
+        #Matriculas: cada profesor en su asignatura y cada alumno en
+        #subjects_per_student asignaturas al azar
+        through = UserProfile.subjects.through
+        enrollments = [through(userprofile_id=profiles[teachers[i]],
+                               subject_id=subject.id)
+                       for i, subject in enumerate(subjects)]
+        n_students_subj = dict((subject.id, 0) for subject in subjects)
+        for iduser in students:
+            for subject in rand.sample(subjects, min(subjects_per_student,
+                                                     n_subjects)):
+                enrollments.append(through(userprofile_id=profiles[iduser],
+                                           subject_id=subject.id))
+                n_students_subj[subject.id] += 1
+        through.objects.bulk_create(enrollments)
+        for subject in subjects:
+            Subject.objects.filter(id=subject.id).update(
+                                    seats_taken=n_students_subj[subject.id])
+
+        #Horarios sin solapamientos: se reparten las franjas de cada aula
+        slots = [(day, hours, room) for room in rooms for day in range(5)
+                 for hours in LESSON_HOURS]
+        rand.shuffle(slots)
+        timetables = []
+        lessons = []
+        for subject in subjects:
+            for i in range(lessons_per_week):
+                if not slots:
+                    break
+                day, (start_hour, end_hour), room = slots.pop()
+                timetables.append(Timetable(subject=subject, day=str(day),
+                                            start_time=datetime.time(start_hour),
+                                            end_time=datetime.time(end_hour),
+                                            room=room))
+                date = first_date + datetime.timedelta(days=day)
+                while date <= last_date:
+                    start_time = current_tz.localize(datetime.datetime(
+                                        date.year, date.month, date.day,
+                                        start_hour))
+                    end_time = current_tz.localize(datetime.datetime(
+                                        date.year, date.month, date.day,
+                                        end_hour))
+                    lessons.append(Lesson(start_time=start_time,
+                                          end_time=end_time, subject=subject,
+                                          room=room,
+                                          done=end_time < timezone.now(),
+                                          subject_students=
+                                                n_students_subj[subject.id]))
+                    date += datetime.timedelta(days=7)
+        #bulk_create para no generar las clases de nuevo con la senal
+        #pre_save de Timetable
+        Timetable.objects.bulk_create(timetables)
+        Lesson.objects.bulk_create(lessons)
+
+    return {'buildings': len(buildings), 'rooms': len(rooms),
+            'degrees': len(degrees), 'subjects': len(subjects),
+            'teachers': len(teachers), 'students': len(students),
+            'enrollments': len(enrollments), 'timetables': len(timetables),
+            'lessons': len(lessons), 'first_date': first_date,
+            'last_date': last_date}
+
+
+def create_activity(attendance=0.7, forum_comments=300, reports=30, seed=0):
+    """
+    Genera con bulk_create la actividad de las clases ya terminadas de
+    create_dataset: el check in del profesor y de cada alumno con
+    probabilidad attendance y un comentario del profesor en cada clase,
+    ademas de forum_comments comentarios en el foro y reports reportes
+    del primer alumno. Despues recalcula los contadores de las clases
+    (que marca su asistencia semanal como desactualizada)
+    Devuelve un diccionario con el numero de objetos creados
+    """
+    rand = random.Random(seed)
+    now = timezone.now()
+    students = {}
+    for iduser, idsubj in UserProfile.subjects.through.objects.filter(
+                            userprofile__is_student=True).values_list(
+                            'userprofile__user', 'subject'):
+        students.setdefault(idsubj, []).append(iduser)
+    teachers = dict(Subject.objects.values_list('id', 'creator'))
+    checkins = []
+    comments = []
+    with transaction.commit_on_success():
+        for lesson in Lesson.objects.filter(end_time__lt=now).values(
+                                        'id', 'subject', 'codeword'):
+            teacher = teachers[lesson['subject']]
+            checkins.append(CheckIn(user_id=teacher, lesson_id=lesson['id'],
+                                    mark=0, codeword=lesson['codeword']))
+            for iduser in students.get(lesson['subject'], []):
+                if rand.random() < attendance:
+                    checkins.append(CheckIn(user_id=iduser,
+                                            lesson_id=lesson['id'],
+                                            mark=rand.randint(0, 5),
+                                            codeword=lesson['codeword'],
+                                            comment='Comentario'))
+            comments.append(LessonComment(user_id=teacher,
+                                          lesson_id=lesson['id'],
+                                          comment='Comentario del profesor'))
+        CheckIn.objects.bulk_create(checkins)
+        LessonComment.objects.bulk_create(comments)
+        users = list(User.objects.values_list('id', flat=True))
+        ForumComment.objects.bulk_create([ForumComment(
+                                user_id=rand.choice(users),
+                                comment='Comentario %i' % i,
+                                date=now - datetime.timedelta(minutes=i))
+                            for i in range(forum_comments)])
+        student = UserProfile.objects.filter(is_student=True).order_by('id'
+                                            ).values_list('user', flat=True)[0]
+        AdminTask.objects.bulk_create([AdminTask(user_id=student, url='/',
+                                ask='Reporte %i' % i,
+                                time=now - datetime.timedelta(hours=i))
+                            for i in range(reports)])
+        #bulk_create no envia las senales que mantienen los contadores
+        update_lesson_counters(Lesson.objects.all())
+        mark_stats_dirty(teachers.keys())
+    return {'checkins': len(checkins), 'lesson_comments': len(comments),
+            'forum_comments': forum_comments, 'reports': reports}
+
+
+def create_current_lessons(minutes_ago=5, duration=60):
+    """
+    Crea una clase de cada asignatura que empezo hace minutes_ago
+    minutos y dura duration minutos, para simular el comienzo de las
+    clases. Devuelve un diccionario {id de la asignatura: codigo}
+    """
+    now = timezone.now()
+    rooms = list(Room.objects.all())
+    Lesson.objects.bulk_create([Lesson(subject=subject,
+                        room=rooms[i % len(rooms)],
+                        start_time=now - datetime.timedelta(
+                                                minutes=minutes_ago),
+                        end_time=now + datetime.timedelta(
+                                        minutes=duration - minutes_ago),
+                        subject_students=subject.n_students())
+                    for i, subject in enumerate(Subject.objects.all())])
+    return dict(Lesson.objects.filter(start_time__lte=now,
+                                      end_time__gte=now
+                                     ).values_list('subject', 'codeword'))
+
+
+def percentile(values, percent):
+    """
+    Devuelve el percentil percent (0-100) de la lista ordenada values
+    (el valor mas cercano, sin interpolar), o None si esta vacia
+    """
+    if not values:
+        return None
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
@@ -0,0 +1,400 @@
+# -*- encoding: utf-8 -*-
+"""
+Ingesta de check ins en lotes (se activa con settings.CHECKIN_BUFFER)
+
+Con SQLite cada check in guardado en su propia transaccion bloquea la
+base de datos, de forma que al comienzo de las clases las peticiones se
+serializan y fallan con "database is locked". En este modo cada check in
+valido se comprueba contra los ya recibidos (usuario, clase), se anade a
+un diario en disco y se responde al cliente; un unico hilo escritor
+guarda cada pocos milisegundos todos los pendientes en una sola
+transaccion y actualiza los contadores de las clases
+Cada proceso escribe en su propio diario (CHECKIN_BUFFER_JOURNAL seguido
+del pid) y lo bloquea con flock mientras vive. Al crear el buffer se
+guardan los check ins de los diarios que no tiene bloqueados ningun
+proceso (los de procesos que terminaron antes de guardarlos); mientras
+se hace se bloquea CHECKIN_BUFFER_JOURNAL.lock para que dos procesos no
+repitan el mismo diario. Los lotes que no se pueden guardar tras varios
+intentos se apartan en el diario .failed, se avisa a los administradores
+y el hilo escritor los vuelve a intentar cada cierto tiempo
+Con varios procesos servidor los duplicados entre procesos solo se
+detectan al guardar
+"""
+from django.db import transaction, DatabaseError
+from django.db.models import F
+from django.conf import settings
+from django.utils.dateparse import parse_datetime
+from django.utils import timezone
+from models import (CheckIn, Lesson, mark_stats_dirty,
+                    update_lesson_counters)
+import threading
+import logging
+import time
+import atexit
+import fcntl
+import glob
+import json
+import os
+
+#Segundos entre cada escritura de los check ins pendientes
+CHECKIN_BUFFER_INTERVAL = getattr(settings, 'CHECKIN_BUFFER_INTERVAL', 0.005)
+#Intentos de guardar cada lote antes de apartarlo en el diario .failed
+CHECKIN_BUFFER_RETRIES = 10
+#Segundos entre cada intento de guardar los lotes del diario .failed
+CHECKIN_BUFFER_FAILED_INTERVAL = getattr(settings,
+                                'CHECKIN_BUFFER_FAILED_INTERVAL', 60)
+
+logger = logging.getLogger(__name__)
+
+
+def read_journal(name):
+    """Devuelve los check ins del diario name (si existe)"""
+    entries = []
+    if os.path.exists(name):
+        with open(name) as journal:
+            for line in journal:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:#linea incompleta al final
+                    pass
+    return entries
+
+
+def try_lock(name):
+    """
+    Bloquea en exclusiva el fichero name (creandolo si no existe) sin
+    esperar. Devuelve el fichero abierto o None si lo tiene bloqueado
+    otro proceso (u otro buffer del mismo proceso)
+    """
+    lock_file = open(name, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+class CheckInBuffer(object):
+    """
+    Buffer de check ins pendientes de guardar con su diario y su hilo
+    escritor
+    """
+    def __init__(self, journal=None, interval=CHECKIN_BUFFER_INTERVAL,
+                 failed_interval=CHECKIN_BUFFER_FAILED_INTERVAL):
+        #Nombre base de los diarios y diario de los check ins pendientes
+        #de guardar de este proceso, bloqueado mientras exista el buffer
+        self.journal_base = journal or getattr(settings,
+                            'CHECKIN_BUFFER_JOURNAL', 'checkins.journal')
+        self.journal_name = '%s.%i' % (self.journal_base, os.getpid())
+        self.journal_lock = try_lock(self.journal_name + '.lock')
+        if self.journal_lock is None:
+            raise RuntimeError('El diario %s ya esta en uso' %
+                               self.journal_name)
+        self.interval = interval
+        self.failed_interval = failed_interval
+        #Momento del proximo intento de guardar el diario .failed (None si
+        #no hay lotes apartados)
+        self.next_failed_retry = None
+        self.lock = threading.Lock()
+        self.flushed = threading.Condition(self.lock)
+        #(usuario, clase) de los check ins guardados o pendientes de las
+        #clases ya consultadas, y el fin de esas clases para olvidarlas
+        #cuando terminen (ver prune_seen)
+        self.seen = {}
+        self.lesson_ends = {}
+        self.pending = []
+        self.running = False
+        self.thread = None
+        self.replay()
+        self.journal = open(self.journal_name, 'a')
+
+    def journal_names(self, name=None):
+        """
+        Ficheros del diario name (el de este proceso si es None), del
+        mas antiguo al mas reciente
+        """
+        name = name or self.journal_name
+        return [name + '.failed', name + '.flushing', name]
+
+    def orphan_journals(self):
+        """
+        Devuelve los nombres de los diarios de procesos que ya no existen
+        (los que nadie tiene bloqueados), el de este proceso (puede haber
+        uno anterior con el mismo pid) y el del nombre base, y los
+        ficheros abiertos con los que se han bloqueado
+        """
+        names = [self.journal_base, self.journal_name]
+        locks = []
+        for lock_name in glob.glob(self.journal_base + '.*.lock'):
+            name = lock_name[:-len('.lock')]
+            if name == self.journal_name:
+                continue
+            lock_file = try_lock(lock_name)
+            if lock_file is not None:
+                names.append(name)
+                locks.append(lock_file)
+        return names, locks
+
+    def replay(self):
+        """
+        Guarda los check ins que quedaron en los diarios (y en los
+        diarios en proceso de guardado) de los procesos que terminaron
+        antes de guardarlos
+        """
+        with open(self.journal_base + '.lock', 'a') as replay_lock:
+            fcntl.flock(replay_lock, fcntl.LOCK_EX)
+            names, locks = self.orphan_journals()
+            try:
+                entries = []
+                for name in names:
+                    for journal in self.journal_names(name):
+                        entries.extend(read_journal(journal))
+                if entries:
+                    self.write(entries)
+                for name in names:
+                    for journal in self.journal_names(name):
+                        if os.path.exists(journal):
+                            os.remove(journal)
+                for lock_file in locks:
+                    os.remove(lock_file.name)
+            finally:
+                for lock_file in locks:
+                    lock_file.close()
+
+    def submit(self, checkin, is_student, n_students=None):
+        """
+        Anade a los pendientes el CheckIn checkin (ya validado) del
+        usuario (alumno si is_student) y, si es un profesor, los alumnos
+        contados n_students
+        Devuelve False si el usuario ya tenia un check in en la clase y
+        True si se ha aceptado, una vez escrito en el diario
+        """
+        if checkin.lesson_id not in self.seen:
+            users = set(CheckIn.objects.filter(lesson=checkin.lesson_id
+                                              ).values_list('user', flat=True))
+        with self.lock:
+            if checkin.lesson_id not in self.seen:
+                self.seen[checkin.lesson_id] = users
+                self.lesson_ends[checkin.lesson_id] = checkin.lesson.end_time
+            if checkin.user_id in self.seen[checkin.lesson_id]:
+                return False
+            self.seen[checkin.lesson_id].add(checkin.user_id)
+            entry = {'user': checkin.user_id, 'lesson': checkin.lesson_id,
+                     'subject': checkin.lesson.subject_id,
+                     'mark': checkin.mark, 'comment': checkin.comment,
+                     'longitude': checkin.longitude,
+                     'latitude': checkin.latitude,
+                     'codeword': checkin.codeword,
+                     'time': checkin.time.isoformat(),
+                     'is_student': is_student, 'n_students': n_students}
+            self.journal.write(json.dumps(entry) + '\n')
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.pending.append(entry)
+            self.start()
+        return True
+
+    def start(self):
+        """Arranca el hilo escritor si no esta arrancado"""
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self.run,
+                                           name='checkin-buffer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        """Bucle del hilo escritor"""
+        while True:
+            with self.lock:
+                while (not self.pending and self.running and
+                       not self.failed_due()):
+                    self.flushed.wait(self.interval)
+                if not self.running and not self.pending:
+                    return
+            self.flush()
+            if self.failed_due():
+                self.retry_failed()
+            with self.lock:
+                self.flushed.wait(self.interval)
+
+    def flush(self):
+        """
+        Guarda en una sola transaccion todos los check ins pendientes y
+        vacia el diario
+        """
+        with self.lock:
+            entries = self.pending
+            self.pending = []
+            if not entries:
+                return
+            #Se aparta el diario de los pendientes que se van a guardar
+            self.journal.close()
+            os.rename(self.journal_name, self.journal_name + '.flushing')
+            self.journal = open(self.journal_name, 'a')
+        for attempt in range(CHECKIN_BUFFER_RETRIES):
+            try:
+                self.write(entries)
+                break
+            except DatabaseError:
+                #Base de datos bloqueada o check in guardado a la vez desde
+                #otro proceso: se reintenta (los duplicados se descartan)
+                logger.exception('Error guardando %i check ins' % len(entries))
+                time.sleep(self.interval * 2**attempt)
+        else:
+            #Ya se respondio a los clientes: se conservan para repetirlos
+            #desde retry_failed o al crear de nuevo el buffer
+            with open(self.journal_name + '.failed', 'a') as failed:
+                with open(self.journal_name + '.flushing') as flushing:
+                    failed.write(flushing.read())
+            logger.error('No se han podido guardar %i check ins aceptados, ' \
+                         'se reintentaran desde %s.failed' % (len(entries),
+                         self.journal_name))
+            if self.next_failed_retry is None:
+                self.next_failed_retry = time.time() + self.failed_interval
+        os.remove(self.journal_name + '.flushing')
+        with self.lock:
+            if self.next_failed_retry is None:
+                self.prune_seen()
+            self.flushed.notify_all()
+
+    def prune_seen(self):
+        """
+        Olvida los usuarios de las clases ya terminadas sin check ins
+        pendientes (ya estan guardados y no se aceptan mas). Se llama con
+        el lock y sin lotes apartados en el diario .failed
+        """
+        now = timezone.now()
+        pending = set(entry['lesson'] for entry in self.pending)
+        for idlesson, end_time in self.lesson_ends.items():
+            if end_time < now and idlesson not in pending:
+                del self.seen[idlesson]
+                del self.lesson_ends[idlesson]
+
+    def failed_due(self):
+        """Devuelve True si toca reintentar el diario .failed"""
+        return (self.next_failed_retry is not None and
+                time.time() >= self.next_failed_retry)
+
+    def retry_failed(self):
+        """
+        Vuelve a guardar los check ins del diario .failed. Si falla de
+        nuevo se reintenta pasados failed_interval segundos
+        """
+        name = self.journal_name + '.failed'
+        try:
+            self.write(read_journal(name))
+        except DatabaseError:
+            logger.exception('Error guardando los check ins de %s' % name)
+            self.next_failed_retry = time.time() + self.failed_interval
+            return
+        os.remove(name)
+        self.next_failed_retry = None
+        logger.warning('Guardados los check ins apartados en %s' % name)
+
+    def stop(self):
+        """Guarda los pendientes y para el hilo escritor"""
+        with self.lock:
+            self.running = False
+            self.flushed.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        self.flush()
+
+    def close(self):
+        """
+        Para el buffer y libera su diario. Si no queda nada pendiente se
+        borra; si no, se guardara al crear el proximo buffer
+        """
+        self.stop()
+        self.journal.close()
+        if not any(os.path.exists(name) and os.path.getsize(name)
+                   for name in self.journal_names()):
+            for name in self.journal_names():
+                if os.path.exists(name):
+                    os.remove(name)
+            os.remove(self.journal_name + '.lock')
+        self.journal_lock.close()
+
+    def write(self, entries):
+        """
+        Guarda los check ins entries con un bulk_create y actualiza en la
+        misma transaccion los contadores de sus clases (bulk_create no
+        envia las senales de CheckIn). Los que ya estaban guardados (desde
+        otro proceso o al repetir el diario) se descartan
+        """
+        checkins = dict(((entry['user'], entry['lesson']), entry)
+                        for entry in entries)
+        with transaction.commit_on_success():
+            lessons = set(lesson for user, lesson in checkins)
+            for key in CheckIn.objects.filter(lesson__in=lessons
+                                ).values_list('user', 'lesson'):
+                checkins.pop(key, None)
+            CheckIn.objects.bulk_create([self.to_checkin(entry)
+                                         for entry in checkins.values()])
+            self.update_counters(checkins.values())
+
+    def to_checkin(self, entry):
+        return CheckIn(user_id=entry['user'], lesson_id=entry['lesson'],
+                       mark=entry['mark'], comment=entry['comment'],
+                       longitude=entry['longitude'],
+                       latitude=entry['latitude'], codeword=entry['codeword'],
+                       time=parse_datetime(entry['time']))
+
+    def update_counters(self, entries):
+        """
+        Hace lo mismo que update_checkin_counters y check_lesson_done con
+        una actualizacion por clase para todos los check ins entries
+        """
+        counters = {}
+        for entry in entries:
+            lesson = counters.setdefault(entry['lesson'], {'stud_checkins': 0,
+                            'mark_sum': 0, 'mark_count': 0, 'done': False,
+                            'students_counted': None})
+            if entry['is_student'] is None:
+                lesson['recount'] = True
+            elif entry['is_student']:
+                lesson['stud_checkins'] += 1
+                if entry['mark'] is not None:
+                    lesson['mark_sum'] += entry['mark']
+                    lesson['mark_count'] += 1
+            else:
+                lesson['done'] = True
+                if entry['n_students'] is not None:
+                    lesson['students_counted'] = entry['n_students']
+        for idlesson, lesson in counters.items():
+            lessons = Lesson.objects.filter(id=idlesson)
+            if lesson.get('recount'):
+                update_lesson_counters(lessons)
+                continue
+            fields = {'attendance_dirty': True}
+            if lesson['stud_checkins']:
+                fields['stud_checkins'] = F('stud_checkins') + \
+                                          lesson['stud_checkins']
+            if lesson['mark_count']:
+                fields['mark_sum'] = F('mark_sum') + lesson['mark_sum']
+                fields['mark_count'] = F('mark_count') + lesson['mark_count']
+            if lesson['done']:
+                fields['done'] = True
+            if lesson['students_counted'] is not None:
+                fields['students_counted'] = lesson['students_counted']
+            lessons.update(**fields)
+        mark_stats_dirty(set(entry['subject'] for entry in entries))
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+def get_checkin_buffer():
+    """Devuelve el CheckInBuffer del proceso, creandolo si no existe"""
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = CheckInBuffer()
+            atexit.register(_buffer.close)
+    return _buffer
+
+def checkin_buffer_enabled():
+    """Devuelve True si el modo de ingesta en lotes esta activado"""
+    return getattr(settings, 'CHECKIN_BUFFER', False)
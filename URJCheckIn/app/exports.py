@@ -0,0 +1,240 @@
+# -*- encoding: utf-8 -*-
+"""
+Exportacion de la asistencia en CSV (se abre con Excel) de una
+asignatura, un grado o todas las asignaturas, entre dos fechas
+
+La respuesta es un StreamingHttpResponse que va generando las filas
+asignatura a asignatura con values_list, de forma que la memoria y el
+tiempo hasta el primer byte no dependen del tamano de la exportacion:
+por cada asignatura se hacen tres consultas (alumnos, clases realizadas
+y checkins) y solo se guardan en memoria los de esa asignatura. El
+resumen por asignatura lee las clases y los checkins de las semanas
+completas de la asistencia semanal (AttendanceFact), tras aplicar sus
+cambios pendientes, en lugar de contarlos
+"""
+from django.http import StreamingHttpResponse
+from django.contrib.auth.decorators import login_required
+from django.db.models import Count, Q
+from django.utils import timezone
+from models import Subject, Lesson, CheckIn, UserProfile
+from rollup import rollup_attendance, get_subject_attendance
+from forms import AttendanceExportForm
+from views import send_error_page, method_not_allowed
+import datetime
+import codecs
+import csv
+import pytz
+
+#Cabeceras de las columnas de cada tipo de exportacion
+LESSON_HEADER = ['Asignatura', 'Fecha', 'Hora', 'DNI', 'Nombre', 'Apellidos',
+                 'Asistencia', 'Valoracion']
+SUBJECT_HEADER = ['Asignatura', 'DNI', 'Nombre', 'Apellidos',
+                  'Clases realizadas', 'Checkins', 'Asistencia (%)']
+
+
+class Echo(object):
+    """Fichero que devuelve lo que se escribe en el, para csv.writer"""
+    def write(self, value):
+        return value
+
+
+def encode_row(row):
+    """Codifica en utf-8 los unicode de la fila row"""
+    return [value.encode('utf-8') if isinstance(value, unicode) else value
+            for value in row]
+
+
+def stream_csv(header, rows):
+    """
+    Generador de las lineas en CSV (separado por ';' y con BOM para que
+    Excel lo abra como utf-8) de la cabecera header y las filas rows
+    """
+    writer = csv.writer(Echo(), delimiter=';')
+    yield codecs.BOM_UTF8 + writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(encode_row(row))
+
+
+def date_range_filter(start_date, end_date, prefix=''):
+    """
+    Devuelve los argumentos de filter para las clases que empiezan entre
+    los dias start_date y end_date (incluidos, en la zona horaria
+    actual). prefix es el camino hasta la clase, como 'lesson__'
+    """
+    current_tz = pytz.timezone(str(timezone.get_current_timezone()))
+    filters = {}
+    if start_date:
+        filters[prefix + 'start_time__gte'] = current_tz.localize(
+                    datetime.datetime.combine(start_date, datetime.time.min))
+    if end_date:
+        filters[prefix + 'start_time__lt'] = current_tz.localize(
+                    datetime.datetime.combine(end_date + datetime.timedelta(
+                                                    days=1), datetime.time.min))
+    return filters
+
+
+def subject_students(idsubj):
+    """Devuelve (id, dni, nombre, apellidos) de los alumnos de idsubj"""
+    return UserProfile.objects.filter(subjects=idsubj, is_student=True
+                    ).order_by('user__last_name', 'user__first_name', 'id'
+                    ).values_list('user', 'dni', 'user__first_name',
+                                  'user__last_name')
+
+
+def lesson_rows(subjects, start_date, end_date):
+    """
+    Generador de una fila por alumno y clase realizada de las
+    asignaturas subjects (lista de (id, nombre))
+    """
+    lesson_filter = date_range_filter(start_date, end_date)
+    checkin_filter = date_range_filter(start_date, end_date, 'lesson__')
+    for idsubj, name in subjects:
+        lessons = list(Lesson.objects.filter(subject=idsubj, done=True,
+                                             **lesson_filter
+                                            ).order_by('start_time', 'id'
+                                            ).values_list('id', 'start_time'))
+        if not lessons:
+            continue
+        students = list(subject_students(idsubj))
+        marks = dict(((idlesson, iduser), mark) for idlesson, iduser, mark in
+                     CheckIn.objects.filter(lesson__subject=idsubj,
+                                            lesson__done=True,
+                                            **checkin_filter
+                                           ).values_list('lesson', 'user',
+                                                         'mark'))
+        for idlesson, start_time in lessons:
+            start_time = timezone.localtime(start_time)
+            date = start_time.strftime('%Y-%m-%d')
+            hour = start_time.strftime('%H:%M')
+            for iduser, dni, first_name, last_name in students:
+                mark = marks.get((idlesson, iduser))
+                yield [name, date, hour, dni, first_name, last_name,
+                       'No' if mark is None else 'Si',
+                       '' if mark is None else mark]
+
+
+def split_date_range(start_date, end_date):
+    """
+    Divide los dias entre start_date y end_date (None si no hay limite)
+    en las semanas ISO completas, que se leen de la asistencia semanal,
+    y los trozos de semana de los extremos, que se cuentan de las clases
+    y los CheckIns para no salirse de las fechas pedidas
+    Devuelve el Q de AttendanceFact de las semanas completas (None si no
+    hay ninguna) y la lista de trozos (inicio, fin)
+    """
+    one_day = datetime.timedelta(days=1)
+    #Primer lunes desde start_date y ultimo domingo hasta end_date
+    first_day = start_date and start_date + datetime.timedelta(
+                                        days=(7 - start_date.weekday()) % 7)
+    last_day = end_date and end_date - datetime.timedelta(
+                                        days=(end_date.weekday() + 1) % 7)
+    if start_date and end_date and first_day > last_day:
+        return None, [(start_date, end_date)]
+    facts = Q()
+    parts = []
+    if start_date:
+        year, week = first_day.isocalendar()[:2]
+        facts &= Q(year__gt=year) | Q(year=year, week__gte=week)
+        if first_day > start_date:
+            parts.append((start_date, first_day - one_day))
+    if end_date:
+        year, week = last_day.isocalendar()[:2]
+        facts &= Q(year__lt=year) | Q(year=year, week__lte=week)
+        if last_day < end_date:
+            parts.append((last_day + one_day, end_date))
+    return facts, parts
+
+
+def count_attendance(idsubj, start_date, end_date):
+    """
+    Devuelve el numero de clases realizadas de la asignatura idsubj
+    entre los dias start_date y end_date y un diccionario {id del
+    usuario: checkins} de sus alumnos, contados de Lesson y CheckIn
+    """
+    n_lessons = Lesson.objects.filter(subject=idsubj, done=True,
+                        **date_range_filter(start_date, end_date)).count()
+    n_checkins = dict(CheckIn.objects.filter(lesson__subject=idsubj,
+                        lesson__done=True, user__userprofile__is_student=True,
+                        **date_range_filter(start_date, end_date, 'lesson__')
+                    ).order_by().values('user').annotate(n=Count('id')
+                    ).values_list('user', 'n'))
+    return n_lessons, n_checkins
+
+
+def subject_rows(subjects, start_date, end_date):
+    """
+    Generador de una fila por alumno de las asignaturas subjects (lista
+    de (id, nombre)) con su numero de checkins y su porcentaje de
+    asistencia a las clases realizadas. Las semanas completas se leen de
+    la asistencia semanal (AttendanceFact) y los dias sueltos de los
+    extremos se cuentan aparte (ver split_date_range)
+    """
+    facts, parts = split_date_range(start_date, end_date)
+    for idsubj, name in subjects:
+        n_lessons, n_checkins = 0, {}
+        if facts is not None:
+            n_lessons, n_checkins = get_subject_attendance(idsubj, facts)
+        for part_start, part_end in parts:
+            part_lessons, part_checkins = count_attendance(idsubj, part_start,
+                                                           part_end)
+            n_lessons += part_lessons
+            for iduser, checkins in part_checkins.items():
+                n_checkins[iduser] = n_checkins.get(iduser, 0) + checkins
+        for iduser, dni, first_name, last_name in subject_students(idsubj):
+            checkins = n_checkins.get(iduser, 0)
+            if n_lessons > 0:
+                percent = round(100.0 * checkins / n_lessons, 2)
+            else:
+                percent = 0
+            yield [name, dni, first_name, last_name, n_lessons, checkins,
+                   percent]
+
+
+@login_required
+def export_attendance(request):
+    """
+    Devuelve en CSV la asistencia de una asignatura, un grado o todas
+    las asignaturas (ver AttendanceExportForm), por alumno y clase o
+    por alumno y asignatura. Solo con el permiso can_see_statistics
+    """
+    if request.method != 'GET':
+        return method_not_allowed(request)
+    if not request.user.has_perm('app.can_see_statistics'):
+        return send_error_page(request, 'No tienes permisos para ver esta ' +
+                                'informaci&oacute;n.')
+    form = AttendanceExportForm(request.GET)
+    if not form.is_valid():
+        return send_error_page(request, 'Los par&aacute;metros de la ' +
+                               'exportaci&oacute;n no son v&aacute;lidos.')
+
+    subjects = Subject.objects.all()
+    #Asignaturas cuya asistencia se pone al dia (None si todas)
+    idsubjects = None
+    filename = 'asistencia'
+    if form.cleaned_data['subject']:
+        subjects = subjects.filter(id=form.cleaned_data['subject'].id)
+        filename += '_asignatura_%i' % form.cleaned_data['subject'].id
+    if form.cleaned_data['degree']:
+        subjects = subjects.filter(degrees=form.cleaned_data['degree'])
+        filename += '_grado_%i' % form.cleaned_data['degree'].id
+    subjects = list(subjects.order_by('name', 'id').values_list('id', 'name'))
+    if form.cleaned_data['subject'] or form.cleaned_data['degree']:
+        idsubjects = [idsubj for idsubj, name in subjects]
+    start_date = form.cleaned_data['start_date']
+    end_date = form.cleaned_data['end_date']
+    if start_date:
+        filename += '_desde_%s' % start_date.isoformat()
+    if end_date:
+        filename += '_hasta_%s' % end_date.isoformat()
+
+    if form.cleaned_data['rows'] == 'subjects':
+        rollup_attendance(subjects=idsubjects)
+        rows = stream_csv(SUBJECT_HEADER, subject_rows(subjects, start_date,
+                                                       end_date))
+        filename += '_resumen'
+    else:
+        rows = stream_csv(LESSON_HEADER, lesson_rows(subjects, start_date,
+                                                     end_date))
+    resp = StreamingHttpResponse(rows, content_type='text/csv; charset=utf-8')
+    resp['Content-Disposition'] = 'attachment; filename="%s.csv"' % filename
+    return resp
@@ -1,7 +1,7 @@
 # -*- encoding: utf-8 -*-
 from django import forms
 from models import (Subject, UserProfile, Lesson, CheckIn, Room,
-                    Building, AdminTask)
+                    Building, AdminTask, Degree)
 from django.forms.util import to_current_timezone, timezone
 import datetime
 from django.contrib.auth.models import User
@@ -145,10 +145,21 @@ class ControlFilterForm(forms.Form):
                                             ('Sem', 'Seminario'),
                                             ('Subj', 'Asignatura'),
                                     ), required=False)
+    max_prof_attend = forms.FloatField(required=False, min_value=0,
+                    widget=forms.TextInput(attrs={'type': 'number',
+                                'placeholder': 'asist. prof. máx. (%)'}))
+    max_stud_attend = forms.FloatField(required=False, min_value=0,
+                    widget=forms.TextInput(attrs={'type': 'number',
+                                'placeholder': 'asist. alum. máx. (%)'}))
     order = forms.ChoiceField(choices=(
                                         ('name', 'Nombre'),
                                         ('first_date', 'Fecha de inicio'),
                                         ('last_date', 'Fecha de fin'),
+                                        ('stats__percent_prof',
+                                         'Asistencia de profesores'),
+                                        ('stats__percent_stud',
+                                         'Asistencia de alumnos'),
+                                        ('stats__avg_mark', 'Valoración media'),
                                     ))
     order_reverse = forms.BooleanField(required=False)
 
@@ -160,8 +171,9 @@ class CodesFilterForm(forms.Form):
     building = forms.ModelChoiceField(required=False,
                                       queryset=Building.objects.all(),
                                       empty_label="todos")
-    room = forms.ModelChoiceField(required=False, queryset=Room.objects.all(), 
-                                  empty_label="cualquiera")
+    room = forms.ModelChoiceField(required=False,
+                    queryset=Room.objects.select_related('building'),
+                    empty_label="cualquiera")
     subject_type = forms.ChoiceField(choices=(
                                             ('', 'Seminarios y asignaturas'),
                                             ('Sem', 'Seminario'),
@@ -215,7 +227,7 @@ class FreeRoomForm(forms.Form):
           'type': 'date', 'required': 'required', 'placeholder':'AAAA-MM-DD'},
         time_attrs={
           'type': 'time', 'required': 'required', 'placeholder':'HH:MM'}))
-    building = forms.ModelChoiceField(queryset=Building.objects.all())
+    building = forms.ModelMultipleChoiceField(queryset=Building.objects.all())
 
     def clean(self):
         cleaned_data = super(FreeRoomForm, self).clean()
@@ -227,3 +239,34 @@ class FreeRoomForm(forms.Form):
                                             'anterior a la de finalización')
         return cleaned_data
 
+
+
+class AttendanceExportForm(forms.Form):
+    """
+    Formulario para elegir la asistencia que se exporta: de una
+    asignatura, de un grado o de todas, entre dos fechas, por clase o
+    resumida por asignatura
+    """
+    subject = forms.ModelChoiceField(required=False,
+                                     queryset=Subject.objects.all(),
+                                     widget=forms.HiddenInput)
+    degree = forms.ModelChoiceField(required=False,
+                                    queryset=Degree.objects.all(),
+                                    empty_label="todos los grados")
+    start_date = forms.DateField(required=False, widget=forms.TextInput(
+                        attrs={'placeholder':'desde AAAA-MM-DD', 'type':'date'}))
+    end_date = forms.DateField(required=False, widget=forms.TextInput(
+                        attrs={'placeholder':'hasta AAAA-MM-DD', 'type':'date'}))
+    rows = forms.ChoiceField(choices=(
+                                    ('lessons', 'Alumno y clase'),
+                                    ('subjects', 'Alumno y asignatura'),
+                                ), required=False)
+
+    def clean(self):
+        cleaned_data = super(AttendanceExportForm, self).clean()
+        start_date = cleaned_data.get('start_date')
+        end_date = cleaned_data.get('end_date')
+        if start_date and end_date and start_date > end_date:
+            raise forms.ValidationError('La fecha de inicio debe ser ' +
+                                        'anterior a la de finalización')
+        return cleaned_data
@@ -0,0 +1,131 @@
+# -*- encoding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.test.client import RequestFactory
+from django.contrib.auth.models import User
+from django.db import connection
+from django.conf import settings
+from optparse import make_option
+from app.models import (Lesson, CheckIn, UserProfile,
+                        update_lesson_counters)
+from app.benchmark import (benchmark_database, create_dataset,
+                           create_current_lessons)
+from app.checkin_buffer import get_checkin_buffer
+from app.views import checkin_page
+import Queue
+import tempfile
+import threading
+import json
+import time
+
+
+def checkin_worker(requests, results):
+    """
+    Hilo cliente: hace los check ins (usuario, asignatura, codigo) de
+    requests llamando a la vista de /checkin y anade a results la
+    respuesta o el error de cada uno
+    """
+    factory = RequestFactory()
+    try:
+        while True:
+            try:
+                user, idsubj, codeword = requests.get_nowait()
+            except Queue.Empty:
+                return
+            request = factory.post('/checkin', {'subject': idsubj,
+                                   'mark': 4, 'codeword': codeword},
+                                   HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            request.user = user
+            try:
+                resp = json.loads(checkin_page(request).content)
+                results.append('ok' if resp['ok'] else 'duplicado')
+            except Exception as e:
+                results.append(str(e))
+    finally:
+        connection.close()
+
+
+class Command(BaseCommand):
+    """
+    Mide cuantos check ins por segundo se guardan al comienzo de las
+    clases, con varios clientes a la vez contra una base de datos SQLite
+    temporal, con y sin el modo de ingesta en lotes (CHECKIN_BUFFER)
+    """
+    help = ('Mide los check ins por segundo con y sin el modo de ingesta ' +
+            'en lotes')
+    option_list = BaseCommand.option_list + (
+        make_option('--students', type='int', dest='students', default=2000,
+                    help='Numero de alumnos'),
+        make_option('--subjects', type='int', dest='subjects', default=20,
+                    help='Numero de asignaturas con clase ahora'),
+        make_option('--threads', type='int', dest='threads', default=16,
+                    help='Numero de clientes a la vez'),
+    )
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            create_dataset(n_subjects=options['subjects'],
+                           n_students=options['students'],
+                           subjects_per_student=1, weeks=1)
+            #Una clase de cada asignatura que se esta impartiendo ahora
+            codewords = create_current_lessons()
+            users = dict((user.id, user) for user in User.objects.all())
+            checkins = [(users[iduser], idsubj, codewords[idsubj])
+                        for iduser, idsubj in UserProfile.subjects.through.\
+                            objects.filter(userprofile__is_student=True
+                                ).values_list('userprofile__user', 'subject')]
+            #Cada alumno repite una vez de cada 10 su check in
+            checkins += checkins[::10]
+
+            self.stdout.write('%i check ins de %i alumnos en %i clases con ' \
+                              '%i clientes\n' % (len(checkins),
+                              options['students'], len(codewords),
+                              options['threads']))
+            self.stdout.write('%-12s %10s %12s %8s %10s %8s' % ('Modo',
+                              'Tiempo', 'Check ins/s', 'Ok', 'Duplicados',
+                              'Errores'))
+            journal = tempfile.mktemp(prefix='urjcheckin_journal_')
+            old_buffer = getattr(settings, 'CHECKIN_BUFFER', False)
+            old_journal = getattr(settings, 'CHECKIN_BUFFER_JOURNAL', None)
+            settings.CHECKIN_BUFFER_JOURNAL = journal
+            try:
+                for buffered in (False, True):
+                    settings.CHECKIN_BUFFER = buffered
+                    self.run_mode(checkins, options['threads'], buffered)
+            finally:
+                settings.CHECKIN_BUFFER = old_buffer
+                settings.CHECKIN_BUFFER_JOURNAL = old_journal
+
+    def run_mode(self, checkins, n_threads, buffered):
+        """Lanza los check ins desde n_threads hilos y muestra el resultado"""
+        CheckIn.objects.all().delete()
+        update_lesson_counters(Lesson.objects.all())
+        requests = Queue.Queue()
+        for checkin in checkins:
+            requests.put(checkin)
+        results = []
+        threads = [threading.Thread(target=checkin_worker,
+                                    args=(requests, results))
+                   for i in range(n_threads)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if buffered:
+            #Se cuenta tambien el tiempo hasta que todo queda guardado
+            get_checkin_buffer().stop()
+        elapsed = time.time() - start
+
+        n_ok = results.count('ok')
+        n_dup = results.count('duplicado')
+        errors = [r for r in results if r not in ('ok', 'duplicado')]
+        self.stdout.write('%-12s %9.2fs %12.1f %8i %10i %8i' % (
+                          'en lotes' if buffered else 'directo', elapsed,
+                          len(results)/elapsed, n_ok, n_dup, len(errors)))
+        for error in sorted(set(errors)):
+            self.stdout.write('    %i x %s' % (errors.count(error), error))
+        saved = CheckIn.objects.count()
+        counted = sum(Lesson.objects.values_list('stud_checkins', flat=True))
+        if saved != n_ok or counted != n_ok:
+            self.stderr.write('Guardados %i check ins y contados %i, pero ' \
+                              'se aceptaron %i' % (saved, counted, n_ok))
@@ -0,0 +1,70 @@
+# -*- encoding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from app.models import UserProfile
+from app.admin_csv import import_users, make_passwords
+from app.benchmark import benchmark_database, measure
+import multiprocessing
+
+
+def generate_rows(n_rows, prefix):
+    """
+    Devuelve n_rows filas de usuarios con el formato del CSV de
+    creacion de usuarios, con DNIs que empiezan por prefix
+    """
+    rows = [['Nombre', 'Apellidos', 'Email', 'DNI', 'Grados', 'Alumno']]
+    for i in range(n_rows):
+        rows.append(['Nombre%i' % i, 'Apellido%i Segundo' % (i % 500),
+                     'alumno%s%i@example.com' % (prefix, i),
+                     '%s%08i' % (prefix, i), 'G0', 'Si'])
+    return rows
+
+
+class Command(BaseCommand):
+    """
+    Mide las filas por segundo de la importacion de usuarios desde CSV
+    (import_users) segun el numero de procesos que calculan los hashes
+    de las contrasenas, en una base de datos temporal
+    """
+    help = ('Mide las filas por segundo de la importacion de usuarios ' +
+            'segun el numero de procesos para las contrasenas')
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', type='int', dest='rows', default=1000,
+                    help='Numero de filas de cada importacion'),
+        make_option('--workers', dest='workers', default=None,
+                    help='Numeros de procesos a probar separados por comas ' +
+                         '(por defecto 1, 2, 4... hasta el numero de nucleos)'),
+    )
+
+    def handle(self, *args, **options):
+        if options['workers']:
+            workers = [int(w) for w in options['workers'].split(',')]
+        else:
+            workers = [1]
+            while workers[-1]*2 <= multiprocessing.cpu_count():
+                workers.append(workers[-1]*2)
+            if workers[-1] != multiprocessing.cpu_count():
+                workers.append(multiprocessing.cpu_count())
+        n_rows = options['rows']
+        self.stdout.write('%i filas, %i nucleos' % (n_rows,
+                                                multiprocessing.cpu_count()))
+        self.stdout.write('%-9s %14s %14s %10s' % ('Procesos', 'Hashes/s',
+                          'Filas/s', 'Consultas'))
+        with benchmark_database():
+            for i, n_workers in enumerate(workers):
+                passwords = ['%i%08i' % (i, n) for n in range(n_rows)]
+                elapsed_hash = measure(make_passwords, passwords,
+                                       n_workers)[0]
+                rows = generate_rows(n_rows, 'W%i' % i)
+                elapsed, n_queries, report = measure(import_users, rows,
+                                                     n_workers)
+                created = len([r for r in report if r['status'] == 'creado'])
+                self.stdout.write('%-9i %14.1f %14.1f %10i' % (n_workers,
+                                  n_rows/elapsed_hash, created/elapsed,
+                                  n_queries))
+                #Las contrasenas deben ser las mismas que con set_password
+                profile = UserProfile.objects.select_related('user').get(
+                                                        dni=rows[-1][3])
+                if not profile.user.check_password(rows[-1][3]):
+                    self.stderr.write('La contrasena de %s no es su DNI' %
+                                      profile.user.username)
@@ -0,0 +1,258 @@
+# -*- encoding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.auth import SESSION_KEY, BACKEND_SESSION_KEY
+from django.db import connection, transaction
+from django.conf import settings
+from optparse import make_option
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+from app.models import Lesson, CheckIn, UserProfile, update_lesson_counters
+from app.benchmark import (benchmark_database, create_dataset,
+                           create_current_lessons, percentile)
+from app.checkin_buffer import get_checkin_buffer
+import SocketServer
+import httplib
+import urllib
+import Queue
+import random
+import tempfile
+import threading
+import json
+import time
+
+#Valor fijo del token CSRF de los clientes: Django solo comprueba que la
+#cabecera X-CSRFToken coincide con la cookie csrftoken
+CSRF_TOKEN = 'b' * 32
+
+
+class ThreadedWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+    """Servidor WSGI que atiende cada peticion en un hilo"""
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class QuietHandler(WSGIRequestHandler):
+    """Manejador que no escribe una linea por peticion"""
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(application):
+    """
+    Sirve application en un puerto libre de localhost desde otro hilo y
+    devuelve el servidor (server.server_port es el puerto)
+    """
+    server = ThreadedWSGIServer(('127.0.0.1', 0), QuietHandler)
+    server.set_app(application)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def create_sessions(idusers):
+    """
+    Devuelve un diccionario {id del usuario: clave de sesion} con una
+    sesion iniciada de cada usuario, sin pasar por /login para no medir
+    el hash de las contrasenas
+    """
+    sessions = {}
+    with transaction.commit_on_success():
+        for iduser in idusers:
+            session = SessionStore()
+            session[SESSION_KEY] = iduser
+            session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+            session.create()
+            sessions[iduser] = session.session_key
+    return sessions
+
+
+def classify_error(status, body):
+    """Devuelve el tipo de error de una respuesta con codigo status"""
+    if 'database is locked' in body:
+        return 'database is locked'
+    return 'HTTP %i' % status
+
+
+def load_worker(port, requests, results):
+    """
+    Hilo cliente: hace las peticiones (tipo, metodo, ruta, datos, clave
+    de sesion) de requests contra localhost:port y anade a results
+    (tipo, segundos, error o None) de cada una
+    """
+    while True:
+        try:
+            kind, method, path, data, session_key = requests.get_nowait()
+        except Queue.Empty:
+            return
+        headers = {'Cookie': '%s=%s; csrftoken=%s' % (
+                                settings.SESSION_COOKIE_NAME, session_key,
+                                CSRF_TOKEN)}
+        body = None
+        if method == 'POST':
+            body = urllib.urlencode(data)
+            headers.update({'X-CSRFToken': CSRF_TOKEN,
+                            'X-Requested-With': 'XMLHttpRequest',
+                            'Content-Type':
+                                'application/x-www-form-urlencoded'})
+        start = time.time()
+        error = None
+        try:
+            conn = httplib.HTTPConnection('127.0.0.1', port, timeout=60)
+            try:
+                conn.request(method, path, body, headers)
+                resp = conn.getresponse()
+                content = resp.read()
+            finally:
+                conn.close()
+            if resp.status != 200:
+                error = classify_error(resp.status, content)
+            elif kind == 'checkin' and not json.loads(content)['ok']:
+                error = 'check in rechazado'
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+        results.append((kind, time.time() - start, error))
+
+
+class Command(BaseCommand):
+    """
+    Prueba de carga de extremo a extremo del comienzo de las clases:
+    sirve la aplicacion WSGI de URJCheckIn/wsgi.py por HTTP sobre una
+    base de datos SQLite temporal y lanza desde varios clientes a la vez
+    el check in de todos los alumnos, mezclado con visitas a / y a
+    /subjects/<id>. Muestra las peticiones por segundo, la latencia
+    (p50, p95 y p99) de cada tipo de peticion y los errores
+    """
+    help = ('Prueba de carga por HTTP de los check ins al comienzo de ' +
+            'las clases')
+    option_list = BaseCommand.option_list + (
+        make_option('--students', type='int', dest='students', default=2000,
+                    help='Numero de alumnos'),
+        make_option('--subjects', type='int', dest='subjects', default=20,
+                    help='Numero de asignaturas con clase ahora'),
+        make_option('--clients', type='int', dest='clients', default=32,
+                    help='Numero de clientes a la vez'),
+        make_option('--pages', type='float', dest='pages', default=1,
+                    help='Visitas a / y /subjects/<id> por cada check in'),
+        make_option('--buffer', action='store_true', dest='buffer',
+                    default=False,
+                    help='Usa el modo de ingesta en lotes (CHECKIN_BUFFER)'),
+        make_option('--seed', type='int', dest='seed', default=0,
+                    help='Semilla de los datos y del orden de las peticiones'),
+    )
+
+    def handle(self, *args, **options):
+        from URJCheckIn.wsgi import application
+        with benchmark_database():
+            create_dataset(n_subjects=options['subjects'],
+                           n_students=options['students'],
+                           subjects_per_student=1, weeks=1,
+                           seed=options['seed'])
+            codewords = create_current_lessons()
+            enrollments = list(UserProfile.subjects.through.objects.filter(
+                                userprofile__is_student=True).values_list(
+                                'userprofile__user', 'subject'))
+            sessions = create_sessions(set(iduser
+                                           for iduser, idsubj in enrollments))
+            requests = self.build_requests(enrollments, codewords, sessions,
+                                           options['pages'], options['seed'])
+            CheckIn.objects.all().delete()
+            update_lesson_counters(Lesson.objects.all())
+            #Los hilos del servidor abren sus propias conexiones al fichero
+            connection.close()
+
+            journal = tempfile.mktemp(prefix='urjcheckin_journal_')
+            old_buffer = getattr(settings, 'CHECKIN_BUFFER', False)
+            old_journal = getattr(settings, 'CHECKIN_BUFFER_JOURNAL', None)
+            settings.CHECKIN_BUFFER = options['buffer']
+            settings.CHECKIN_BUFFER_JOURNAL = journal
+            server = serve(application)
+            try:
+                self.stdout.write('%i peticiones de %i alumnos en %i clases ' \
+                                  'con %i clientes (%s)\n' % (len(requests),
+                                  len(sessions), len(codewords),
+                                  options['clients'], 'en lotes'
+                                  if options['buffer'] else 'directo'))
+                elapsed, results = self.run_load(server.server_port,
+                                                 requests, options['clients'],
+                                                 options['buffer'])
+            finally:
+                server.shutdown()
+                server.server_close()
+                settings.CHECKIN_BUFFER = old_buffer
+                settings.CHECKIN_BUFFER_JOURNAL = old_journal
+            self.report(elapsed, results)
+
+    def build_requests(self, enrollments, codewords, sessions, pages, seed):
+        """
+        Devuelve las peticiones (tipo, metodo, ruta, datos, clave de
+        sesion) en orden aleatorio: un check in por matricula y, por cada
+        uno, pages visitas a / o a la asignatura
+        """
+        rand = random.Random(seed)
+        requests = []
+        for iduser, idsubj in enrollments:
+            requests.append(('checkin', 'POST', '/checkin',
+                             {'subject': idsubj, 'mark': rand.randint(0, 5),
+                              'codeword': codewords[idsubj]},
+                             sessions[iduser]))
+        n_pages = int(len(requests) * pages)
+        for i in range(n_pages):
+            iduser, idsubj = rand.choice(enrollments)
+            if rand.random() < 0.5:
+                requests.append(('home', 'GET', '/', None, sessions[iduser]))
+            else:
+                requests.append(('subject', 'GET', '/subjects/%i' % idsubj,
+                                 None, sessions[iduser]))
+        rand.shuffle(requests)
+        return requests
+
+    def run_load(self, port, requests, n_clients, buffered):
+        """
+        Lanza requests desde n_clients hilos y devuelve el tiempo total y
+        la lista de resultados (tipo, segundos, error)
+        """
+        queue = Queue.Queue()
+        for request in requests:
+            queue.put(request)
+        results = []
+        threads = [threading.Thread(target=load_worker,
+                                    args=(port, queue, results))
+                   for i in range(n_clients)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if buffered:
+            #Se cuenta tambien el tiempo hasta que todo queda guardado
+            get_checkin_buffer().stop()
+        return time.time() - start, results
+
+    def report(self, elapsed, results):
+        """Muestra el rendimiento y la latencia de cada tipo de peticion"""
+        self.stdout.write('%-10s %8s %10s %9s %9s %9s %8s' % ('Peticion',
+                          'Total', 'Peticion/s', 'p50 (ms)', 'p95 (ms)',
+                          'p99 (ms)', 'Errores'))
+        for kind in ('checkin', 'home', 'subject', None):
+            selected = [r for r in results if kind is None or r[0] == kind]
+            if not selected:
+                continue
+            latencies = sorted(secs * 1000 for k, secs, error in selected)
+            n_errors = len([r for r in selected if r[2] is not None])
+            self.stdout.write('%-10s %8i %10.1f %9.1f %9.1f %9.1f %8i' % (
+                              kind or 'total', len(selected),
+                              len(selected)/elapsed,
+                              percentile(latencies, 50),
+                              percentile(latencies, 95),
+                              percentile(latencies, 99), n_errors))
+        errors = [error for k, secs, error in results if error is not None]
+        for error in sorted(set(errors)):
+            self.stdout.write('    %i x %s' % (errors.count(error), error))
+        n_ok = len([r for r in results
+                    if r[0] == 'checkin' and r[2] is None])
+        saved = CheckIn.objects.count()
+        if saved != n_ok:
+            self.stderr.write('Guardados %i check ins, pero se aceptaron %i' %
+                              (saved, n_ok))
+        self.stdout.write('Tiempo total: %.2fs' % elapsed)
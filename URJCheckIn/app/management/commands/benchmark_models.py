@@ -0,0 +1,281 @@
+# -*- encoding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.core.exceptions import ValidationError
+from django.utils import timezone
+from optparse import make_option
+from app.models import (Subject, Lesson, Timetable, Room, Building,
+                        mark_stats_dirty, create_timetable_lessons,
+                        get_free_room, get_first_lesson_date)
+from app.benchmark import (benchmark_database, create_dataset,
+                           create_activity, measure)
+import datetime
+import random
+import json
+import os
+import pytz
+
+#Fichero con los resultados de referencia (ver --save-baseline)
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.dirname(
+                        os.path.dirname(os.path.abspath(__file__)))),
+                        'benchmark_baseline.json')
+#Las diferencias de tiempo menores que esta (ms por operacion) son ruido
+MIN_REGRESSION_MS = 0.05
+
+#Tamanos de los datos generados (argumentos de create_dataset)
+DATASET_SIZES = {
+    'pequeno': {'n_buildings': 1, 'rooms_per_building': 5, 'n_subjects': 10,
+                'n_students': 200, 'subjects_per_student': 3, 'weeks': 8},
+    'mediano': {'n_buildings': 2, 'rooms_per_building': 20, 'n_subjects': 40,
+                'n_students': 1000, 'subjects_per_student': 5, 'weeks': 17},
+    'grande': {'n_buildings': 4, 'rooms_per_building': 30, 'n_subjects': 120,
+               'n_students': 4000, 'subjects_per_student': 6, 'weeks': 17},
+}
+SIZES_ORDER = ('pequeno', 'mediano', 'grande')
+
+
+def random_interval(rand, ctx, hours=2):
+    """Devuelve un intervalo (inicio, fin) al azar dentro del semestre"""
+    days = (ctx['last_date'] - ctx['first_date']).days
+    date = ctx['first_date'] + datetime.timedelta(days=rand.randint(0, days))
+    start_time = ctx['tz'].localize(datetime.datetime(date.year, date.month,
+                                    date.day, rand.randint(8, 19)))
+    return start_time, start_time + datetime.timedelta(hours=hours)
+
+def setup_subject(rand, ctx):
+    return (Subject.objects.get(id=rand.choice(ctx['subjects'])),)
+
+def setup_stale_subject(rand, ctx):
+    idsubj = rand.choice(ctx['subjects'])
+    mark_stats_dirty([idsubj])
+    return (Subject.objects.get(id=idsubj),)
+
+def setup_lesson(rand, ctx):
+    return (Lesson.objects.get(id=rand.choice(ctx['lessons'])),)
+
+def setup_new_lesson(rand, ctx):
+    start_time, end_time = random_interval(rand, ctx)
+    #Clean solo comprueba los solapamientos de clases futuras
+    now = timezone.now()
+    if start_time < now:
+        start_time, end_time = now + (end_time - start_time), now + \
+                                      2*(end_time - start_time)
+    return (Lesson(subject_id=rand.choice(ctx['subjects']),
+                   room_id=rand.choice(ctx['rooms']), start_time=start_time,
+                   end_time=end_time),)
+
+def setup_new_timetable(rand, ctx):
+    hour = rand.randint(8, 19)
+    return (Timetable(subject=Subject.objects.get(
+                            id=rand.choice(ctx['subjects'])),
+                      day=str(rand.randint(0, 4)),
+                      start_time=datetime.time(hour),
+                      end_time=datetime.time(hour + 2),
+                      room=Room.objects.get(id=rand.choice(ctx['rooms']))),)
+
+def setup_timetable(rand, ctx):
+    return (Timetable.objects.get(id=rand.choice(ctx['timetables'])),)
+
+def setup_free_room(rand, ctx):
+    start_time, end_time = random_interval(rand, ctx)
+    return start_time, end_time, rand.choice(ctx['buildings'])
+
+def clean(obj):
+    """Llama a obj.clean() y devuelve si es valido"""
+    try:
+        obj.clean()
+        return True
+    except ValidationError:
+        return False
+
+def delete_new_lessons(ctx):
+    """Borra las clases creadas durante la prueba"""
+    Lesson.objects.filter(id__gt=ctx['last_lesson']).delete()
+
+#Pruebas (nombre, preparacion, operacion, limpieza): la preparacion recibe
+#un random.Random y el contexto y devuelve los argumentos de la operacion,
+#que es lo unico que se mide; la limpieza se llama despues de cada ronda
+MICROBENCHMARKS = (
+    ('Subject.avg_mark', setup_subject,
+     lambda subject: subject.avg_mark(), None),
+    ('Subject.avg_mark (recalculo)', setup_stale_subject,
+     lambda subject: subject.avg_mark(), None),
+    ('Subject.percent_stud_attend', setup_subject,
+     lambda subject: subject.percent_stud_attend(), None),
+    ('Subject.percent_prof_attend', setup_subject,
+     lambda subject: subject.percent_prof_attend(), None),
+    ('Lesson.checkin_percent', setup_lesson,
+     lambda lesson: lesson.checkin_percent(), None),
+    ('Lesson.clean', setup_new_lesson, clean, None),
+    ('Timetable.clean', setup_new_timetable, clean, None),
+    ('create_timetable_lessons', setup_new_timetable,
+     lambda timetable: create_timetable_lessons(Timetable, timetable),
+     delete_new_lessons),
+    ('get_free_room', setup_free_room, get_free_room, None),
+    ('get_first_lesson_date', setup_timetable, get_first_lesson_date, None),
+)
+
+
+def run_microbenchmark(setup, operation, teardown, ctx, n_ops, rounds, seed):
+    """
+    Ejecuta rounds veces operation sobre n_ops entradas generadas con
+    setup y devuelve el mejor tiempo (ms) y el numero de consultas por
+    operacion
+    """
+    best = None
+    for i in range(rounds):
+        #Las mismas entradas en cada ronda para que sean comparables
+        rand = random.Random(seed)
+        inputs = [setup(rand, ctx) for j in range(n_ops)]
+        def run():
+            for args in inputs:
+                operation(*args)
+        elapsed, n_queries, result = measure(run)
+        if teardown is not None:
+            teardown(ctx)
+        if best is None or elapsed < best[0]:
+            best = (elapsed, n_queries)
+    return 1000.0*best[0]/n_ops, float(best[1])/n_ops
+
+
+def find_regressions(results, baseline, threshold):
+    """
+    Devuelve las pruebas (tamano, nombre, motivo) de results que hacen
+    mas consultas que en baseline o tardan mas de threshold veces lo
+    que tardaban. Solo se comparan los tamanos medidos con el mismo
+    numero de operaciones, ya que las consultas por operacion dependen
+    de las entradas generadas
+    """
+    regressions = []
+    for size, result in sorted(results.items()):
+        base = baseline.get(size)
+        if base is None or base['ops'] != result['ops']:
+            continue
+        for name, current in sorted(result['benchmarks'].items()):
+            before = base['benchmarks'].get(name)
+            if before is None:
+                continue
+            if current['queries'] > before['queries']:
+                regressions.append((size, name, '%.2f consultas (antes %.2f)'
+                                    % (current['queries'],
+                                       before['queries'])))
+            elif (current['ms'] > before['ms']*threshold and
+                  current['ms'] - before['ms'] > MIN_REGRESSION_MS):
+                regressions.append((size, name, '%.3fms (antes %.3fms)' %
+                                    (current['ms'], before['ms'])))
+    return regressions
+
+
+class Command(BaseCommand):
+    """
+    Microbenchmarks de las funciones de los modelos que mas se usan,
+    sobre datos generados de varios tamanos en una base de datos
+    temporal, para ver como escalan con el numero de clases, alumnos y
+    aulas. Muestra el tiempo y las consultas por operacion y los compara
+    con los de referencia guardados con --save-baseline: falla si una
+    prueba hace mas consultas o tarda mas de --threshold veces lo que
+    tardaba
+    """
+    help = ('Mide el tiempo y las consultas de las funciones de los ' +
+            'modelos y los compara con los de referencia')
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='pequeno,mediano',
+                    help='Tamanos de los datos separados por comas (%s)' %
+                         ', '.join(SIZES_ORDER)),
+        make_option('--ops', type='int', dest='ops', default=50,
+                    help='Operaciones de cada prueba por ronda'),
+        make_option('--rounds', type='int', dest='rounds', default=3,
+                    help='Rondas de cada prueba (se toma la mas rapida)'),
+        make_option('--baseline', dest='baseline', default=DEFAULT_BASELINE,
+                    help='Fichero JSON con los resultados de referencia'),
+        make_option('--save-baseline', action='store_true',
+                    dest='save_baseline', default=False,
+                    help='Guarda los resultados como los de referencia'),
+        make_option('--threshold', type='float', dest='threshold',
+                    default=1.5,
+                    help='Cuantas veces mas lento se considera regresion'),
+    )
+
+    def handle(self, *args, **options):
+        sizes = [size.strip() for size in options['sizes'].split(',')]
+        for size in sizes:
+            if size not in DATASET_SIZES:
+                raise CommandError('Tamano desconocido: %s' % size)
+        baseline = {}
+        if os.path.exists(options['baseline']):
+            with open(options['baseline']) as fich:
+                baseline = json.load(fich)
+
+        results = {}
+        for size in sizes:
+            base = baseline.get(size)
+            if base is not None and base['ops'] != options['ops']:
+                self.stdout.write('La referencia de %s se midio con --ops ' \
+                                  '%i, no se compara' % (size, base['ops']))
+                base = None
+            with benchmark_database():
+                results[size] = {'ops': options['ops'],
+                                 'benchmarks': self.run_size(size,
+                                        base['benchmarks'] if base else {},
+                                        options['ops'], options['rounds'])}
+
+        if options['save_baseline']:
+            baseline.update(results)
+            with open(options['baseline'], 'w') as fich:
+                json.dump(baseline, fich, indent=2, sort_keys=True,
+                          separators=(',', ': '))
+                fich.write('\n')
+            self.stdout.write('\nResultados guardados en %s' %
+                              options['baseline'])
+            return
+        regressions = find_regressions(results, baseline,
+                                       options['threshold'])
+        if regressions:
+            self.stdout.write('')
+            for size, name, reason in regressions:
+                self.stdout.write('REGRESION %s (%s): %s' % (name, size,
+                                                             reason))
+            raise CommandError('%i pruebas empeoran respecto a %s' %
+                               (len(regressions), options['baseline']))
+
+    def run_size(self, size, baseline, n_ops, rounds):
+        """
+        Genera los datos del tamano size, ejecuta todas las pruebas y
+        devuelve {nombre: {'ms': ms, 'queries': consultas}}
+        """
+        dataset = create_dataset(**DATASET_SIZES[size])
+        activity = create_activity(forum_comments=0, reports=0)
+        ctx = {'subjects': list(Subject.objects.values_list('id', flat=True)),
+               'rooms': list(Room.objects.values_list('id', flat=True)),
+               'buildings': list(Building.objects.all()),
+               'lessons': list(Lesson.objects.values_list('id', flat=True)),
+               'timetables': list(Timetable.objects.values_list('id',
+                                                                flat=True)),
+               'last_lesson': max(Lesson.objects.values_list('id', flat=True)),
+               'first_date': dataset['first_date'],
+               'last_date': dataset['last_date'],
+               'tz': pytz.timezone(str(timezone.get_current_timezone()))}
+        #Se calculan las estadisticas una vez para medir el caso habitual
+        for subject in Subject.objects.all():
+            subject.get_stats()
+
+        self.stdout.write('\n%s: %i aulas, %i asignaturas, %i alumnos, %i ' \
+                          'clases, %i check ins' % (size, dataset['rooms'],
+                          dataset['subjects'], dataset['students'],
+                          dataset['lessons'], activity['checkins']))
+        self.stdout.write('%-30s %10s %11s %10s %9s' % ('Prueba', 'ms/op',
+                          'Consultas', 'Ref. ms', 'Cambio'))
+        results = {}
+        for i, (name, setup, operation, teardown) in enumerate(
+                                                        MICROBENCHMARKS):
+            ms, queries = run_microbenchmark(setup, operation, teardown, ctx,
+                                             n_ops, rounds, seed=i)
+            results[name] = {'ms': round(ms, 4), 'queries': queries}
+            base = baseline.get(name)
+            if base:
+                self.stdout.write('%-30s %10.3f %11.2f %10.3f %+8.0f%%' % (
+                                  name, ms, queries, base['ms'],
+                                  100.0*(ms - base['ms'])/max(base['ms'],
+                                                              1e-6)))
+            else:
+                self.stdout.write('%-30s %10.3f %11.2f' % (name, ms, queries))
+        return results
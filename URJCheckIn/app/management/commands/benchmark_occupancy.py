@@ -0,0 +1,135 @@
+# -*- encoding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from optparse import make_option
+from app.models import Lesson, Room, Building, get_free_rooms
+from app.occupancy import LessonOccupancy
+from app.benchmark import benchmark_database, create_dataset, measure
+import datetime
+import random
+import pytz
+
+
+def query_conflicts(candidates):
+    """
+    Comprueba los solapamientos de cada clase candidata (asignatura,
+    aula, inicio, fin) con consultas, como se hacia antes en Lesson.clean
+    """
+    result = []
+    for idsubj, idroom, start_time, end_time in candidates:
+        lesson_same_time = Lesson.objects.exclude(
+                    start_time__gte=end_time
+                ).exclude(
+                    end_time__lte=start_time
+                )
+        result.append((lesson_same_time.filter(subject=idsubj).exists(),
+                       lesson_same_time.filter(room=idroom).exists()))
+    return result
+
+def index_conflicts(occupancy, candidates):
+    """Comprueba los solapamientos de cada clase candidata con el indice"""
+    return [(occupancy.subject_busy(idsubj, start_time, end_time),
+             occupancy.room_busy(idroom, start_time, end_time))
+            for idsubj, idroom, start_time, end_time in candidates]
+
+def query_free_rooms(intervals, buildings):
+    """Busca las aulas libres de cada intervalo con una consulta"""
+    return [sorted(room.id for room in get_free_rooms(start_time, end_time,
+                                                      buildings))
+            for start_time, end_time in intervals]
+
+def index_free_rooms(occupancy, intervals, rooms):
+    """Busca las aulas libres de cada intervalo con el indice"""
+    return [sorted(occupancy.free_rooms(rooms, start_time, end_time))
+            for start_time, end_time in intervals]
+
+
+class Command(BaseCommand):
+    """
+    Compara, sobre un semestre de datos generados en una base de datos
+    temporal, las comprobaciones de solapamiento de clases y la busqueda
+    de aulas libres mediante consultas con las del indice en memoria
+    LessonOccupancy
+    """
+    help = ('Compara las comprobaciones de solapamiento mediante consultas ' +
+            'con el indice de ocupacion en memoria')
+    option_list = BaseCommand.option_list + (
+        make_option('--subjects', type='int', dest='subjects', default=60,
+                    help='Numero de asignaturas generadas'),
+        make_option('--rooms', type='int', dest='rooms', default=20,
+                    help='Numero de aulas por edificio'),
+        make_option('--weeks', type='int', dest='weeks', default=17,
+                    help='Numero de semanas del semestre'),
+        make_option('--checks', type='int', dest='checks', default=500,
+                    help='Numero de comprobaciones de cada tipo'),
+    )
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            elapsed, n_queries, dataset = measure(create_dataset,
+                                            n_subjects=options['subjects'],
+                                            rooms_per_building=options['rooms'],
+                                            n_students=0,
+                                            weeks=options['weeks'])
+            self.stdout.write('Datos generados en %.2fs: %i aulas, %i ' \
+                              'asignaturas, %i clases' % (elapsed,
+                              dataset['rooms'], dataset['subjects'],
+                              dataset['lessons']))
+
+            rand = random.Random(1)
+            current_tz = pytz.timezone(str(timezone.get_current_timezone()))
+            days = (dataset['last_date'] - dataset['first_date']).days
+            subjects = list(Lesson.objects.values_list('subject', flat=True
+                                                       ).distinct())
+            rooms = list(Room.objects.values_list('id', flat=True))
+            buildings = list(Building.objects.all())
+            intervals = []
+            for i in range(options['checks']):
+                date = dataset['first_date'] + datetime.timedelta(
+                                                    days=rand.randint(0, days))
+                hour = rand.randint(8, 19)
+                start_time = current_tz.localize(datetime.datetime(date.year,
+                                date.month, date.day, hour, rand.choice([0, 30])))
+                intervals.append((start_time,
+                                  start_time + datetime.timedelta(hours=2)))
+            candidates = [(rand.choice(subjects), rand.choice(rooms),
+                           start_time, end_time)
+                          for start_time, end_time in intervals]
+            semester = (min(start for start, end in intervals),
+                        max(end for start, end in intervals))
+
+            self.stdout.write('\n%-40s %10s %10s %10s' % ('Prueba', 'Tiempo',
+                                                   'Consultas', 'Por op.'))
+            elapsed, n_queries, occupancy = measure(LessonOccupancy,
+                                                    *semester)
+            self.report('Carga del indice (semestre)', elapsed, n_queries, 1)
+
+            elapsed, n_queries, by_query = measure(query_conflicts,
+                                                   candidates)
+            self.report('Solapamientos con consultas', elapsed, n_queries,
+                        len(candidates))
+            elapsed, n_queries, by_index = measure(index_conflicts,
+                                                   occupancy, candidates)
+            self.report('Solapamientos con el indice', elapsed, n_queries,
+                        len(candidates))
+            self.check_equal('Solapamientos', by_query, by_index)
+
+            elapsed, n_queries, by_query = measure(query_free_rooms,
+                                                   intervals, buildings)
+            self.report('Aulas libres con consultas', elapsed, n_queries,
+                        len(intervals))
+            elapsed, n_queries, by_index = measure(index_free_rooms,
+                                                   occupancy, intervals, rooms)
+            self.report('Aulas libres con el indice', elapsed, n_queries,
+                        len(intervals))
+            self.check_equal('Aulas libres', by_query, by_index)
+
+    def report(self, name, elapsed, n_queries, n_ops):
+        self.stdout.write('%-40s %9.3fs %10i %8.3fms' % (name, elapsed,
+                          n_queries, 1000.0*elapsed/max(n_ops, 1)))
+
+    def check_equal(self, name, by_query, by_index):
+        differences = len([1 for a, b in zip(by_query, by_index) if a != b])
+        if differences:
+            self.stderr.write('%s: %i resultados distintos entre consultas ' \
+                              'e indice' % (name, differences))
@@ -0,0 +1,126 @@
+# -*- encoding: utf-8 -*-
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from app.models import (Lesson, LessonComment, ForumComment, AdminTask,
+                        Timetable, Room, CheckIn)
+from app.pagination import CursorPaginator
+import datetime
+import re
+
+#Linea del plan de SQLite que recorre una tabla entera ('SCAN TABLE x' hasta
+#SQLite 3.36 y 'SCAN x' desde entonces). Si recorre un indice pone 'USING'
+FULL_SCAN = re.compile(r'^SCAN (TABLE )?(?P<table>\w+)')
+
+
+def after_cursor(queryset, order, per_page=10):
+    """
+    Devuelve la consulta de la pagina siguiente a un cursor de
+    CursorPaginator para queryset ordenado por order
+    """
+    paginator = CursorPaginator(queryset, order, per_page)
+    obj = queryset.model(id=1)
+    setattr(obj, order.lstrip('-'), timezone.now())
+    return paginator.after(paginator.encode(obj))[:per_page + 1]
+
+
+def query_catalogue():
+    """
+    Devuelve una lista (nombre, queryset) con las consultas frecuentes
+    de las vistas, con parametros de ejemplo
+    """
+    now = timezone.now()
+    hour = datetime.timedelta(hours=1)
+    week = datetime.timedelta(days=7)
+    return [
+        ('check in: clases activas (get_active_lessons)',
+         Lesson.objects.filter(subject=1, start_time__lte=now,
+                               end_time__gte=now)),
+        ('calendario de la semana (home)',
+         Lesson.objects.filter(subject__in=[1, 2, 3], start_time__gte=now,
+                               start_time__lt=now + week
+                              ).select_related('subject', 'room__building'
+                              ).order_by('start_time')),
+        ('ocupacion de las aulas (LessonOccupancy)',
+         Lesson.objects.filter(start_time__lte=now + hour,
+                               end_time__gte=now)),
+        ('ocupacion de un aula',
+         Lesson.objects.filter(room=1, start_time__lte=now + hour,
+                               end_time__gte=now)),
+        ('aulas libres (get_free_rooms)',
+         Room.objects.filter(building__in=[1]).exclude(
+                id__in=Lesson.objects.filter(start_time__lte=now + hour,
+                                             end_time__gte=now
+                                            ).values('room'))),
+        ('codigos de un dia (show_codes)',
+         Lesson.objects.filter(start_time__gte=now, start_time__lt=now + hour
+                              ).order_by('start_time')),
+        ('proximas clases de una asignatura (subject_page)',
+         Lesson.objects.filter(subject=1, start_time__gte=now
+                              ).order_by('end_time', 'id')[:11]),
+        ('clases pasadas de una asignatura (more_lessons)',
+         after_cursor(Lesson.objects.filter(subject=1), '-start_time')),
+        ('comentarios de una clase (more_comments)',
+         after_cursor(LessonComment.objects.filter(lesson=1), '-date')),
+        ('foro (forum)',
+         ForumComment.objects.order_by('-date', '-id')[:11]),
+        ('foro (more_comments)',
+         after_cursor(ForumComment.objects.all(), '-date')),
+        ('reportes de un usuario (more_reports)',
+         after_cursor(AdminTask.objects.filter(user=1), '-time')),
+        ('tareas pendientes (home)',
+         AdminTask.objects.filter(done=False).order_by('time')[:15]),
+        ('horarios de un aula (Timetable.clean)',
+         Timetable.objects.filter(day='0', room=1)),
+        ('check ins de una clase (CheckInBuffer)',
+         CheckIn.objects.filter(lesson=1).values_list('user', flat=True)),
+    ]
+
+
+def full_scans(queryset):
+    """
+    Devuelve el plan de queryset (lista de lineas) y las tablas que
+    recorre enteras
+    """
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+    plan = [row[-1] for row in cursor.fetchall()]
+    tables = set(connection.introspection.table_names())
+    scans = []
+    for detail in plan:
+        match = FULL_SCAN.match(detail)
+        if match and 'USING' not in detail and match.group('table') in tables:
+            scans.append(match.group('table'))
+    return plan, scans
+
+
+class Command(BaseCommand):
+    """
+    Comprueba con EXPLAIN QUERY PLAN que ninguna de las consultas
+    frecuentes de las vistas (query_catalogue) recorre una tabla entera,
+    para detectar si un cambio deja de usar los indices. Solo SQLite
+    """
+    help = ('Comprueba que las consultas frecuentes usan indices ' +
+            '(falla si alguna recorre una tabla entera)')
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'sqlite':
+            raise CommandError('Solo se pueden comprobar los planes de SQLite')
+        verbosity = int(options.get('verbosity', 1))
+        failed = []
+        for name, queryset in query_catalogue():
+            plan, scans = full_scans(queryset)
+            if scans:
+                failed.append(name)
+                self.stdout.write('FALLA %s: recorre %s' % (name,
+                                                            ', '.join(scans)))
+            elif verbosity > 0:
+                self.stdout.write('OK    %s' % name)
+            if scans or verbosity > 1:
+                for detail in plan:
+                    self.stdout.write('          %s' % detail)
+        if failed:
+            raise CommandError('%i consultas recorren tablas enteras' %
+                               len(failed))
@@ -0,0 +1,20 @@
+# -*- encoding: utf-8 -*-
+from django.core.management.base import NoArgsCommand
+from app.models import (Lesson, Subject, update_lesson_counters,
+                        refresh_subject_stats)
+
+class Command(NoArgsCommand):
+    """
+    Recalcula desde cero los contadores de asistencia de las clases y
+    las estadisticas de las asignaturas (util si se modifican datos sin
+    pasar por los modelos, por ejemplo con update o bulk_create)
+    """
+    help = ('Recalcula los contadores de asistencia de todas las clases y ' +
+            'las estadisticas de todas las asignaturas')
+
+    def handle_noargs(self, **options):
+        update_lesson_counters(Lesson.objects.all())
+        refresh_subject_stats(Subject.objects.all())
+        self.stdout.write('Contadores de %i clases y %i asignaturas ' \
+                          'recalculados' % (Lesson.objects.count(),
+                                            Subject.objects.count()))
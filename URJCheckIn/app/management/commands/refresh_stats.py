@@ -0,0 +1,17 @@
+# -*- encoding: utf-8 -*-
+from django.core.management.base import NoArgsCommand
+from app.models import refresh_subject_stats, subjects_stale_stats
+
+
+class Command(NoArgsCommand):
+    """
+    Recalcula las estadisticas (SubjectStats) que no existen o estan
+    desactualizadas. Pensado para ejecutarse desde cron cada pocos
+    minutos: la pagina de control de asistencia filtra y ordena por
+    ellas y solo recalcula las de las asignaturas que muestra
+    """
+    help = 'Recalcula las estadisticas desactualizadas de las asignaturas'
+
+    def handle_noargs(self, **options):
+        n_subjects = refresh_subject_stats(subjects_stale_stats())
+        self.stdout.write('Asignaturas recalculadas: %i' % n_subjects)
@@ -0,0 +1,23 @@
+# -*- encoding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from app.rollup import rollup_attendance
+
+
+class Command(BaseCommand):
+    """
+    Pone al dia la asistencia semanal (AttendanceFact) con los CheckIns,
+    clases y matriculas que han cambiado desde la ultima vez. Pensado
+    para ejecutarse desde cron cada pocos minutos: las paginas que leen
+    la asistencia de una asignatura solo aplican los de esa asignatura
+    """
+    help = 'Actualiza la asistencia semanal con los cambios pendientes'
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild', action='store_true', dest='rebuild',
+                    default=False,
+                    help='Recalcula toda la asistencia desde cero'),
+    )
+
+    def handle(self, *args, **options):
+        n_subjects = rollup_attendance(rebuild=options['rebuild'])
+        self.stdout.write('Asignaturas recalculadas: %i' % n_subjects)
@@ -0,0 +1,51 @@
+# -*- encoding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from optparse import make_option
+from app.models import ImportJob
+from app.admin_csv import run_import_job
+import time
+
+
+class Command(BaseCommand):
+    """
+    Ejecuta las importaciones de CSV (ImportJob) pendientes, en orden de
+    llegada. Cada importacion se reclama con una actualizacion
+    condicional, de forma que pueden ejecutarse varios procesos a la vez
+    sin repetir ninguna
+    """
+    help = 'Ejecuta las importaciones de CSV pendientes'
+    option_list = BaseCommand.option_list + (
+        make_option('--loop', action='store_true', dest='loop',
+                    default=False,
+                    help='Sigue esperando nuevas importaciones al terminar'),
+        make_option('--sleep', type='float', dest='sleep', default=5,
+                    help='Segundos de espera entre consultas con --loop'),
+    )
+
+    def handle(self, *args, **options):
+        n_jobs = 0
+        while True:
+            job = self.claim_job()
+            if job is None:
+                if not options['loop']:
+                    break
+                time.sleep(options['sleep'])
+                continue
+            run_import_job(job)
+            n_jobs += 1
+            self.stdout.write('%s: %s' % (job, job.get_status_display()))
+        self.stdout.write('Importaciones ejecutadas: %i' % n_jobs)
+
+    def claim_job(self):
+        """
+        Marca como en curso la importacion pendiente mas antigua y la
+        devuelve (None si no hay ninguna)
+        """
+        for idjob in ImportJob.objects.filter(status='pending'
+                                ).order_by('created', 'id'
+                                ).values_list('id', flat=True):
+            if ImportJob.objects.filter(id=idjob, status='pending').update(
+                                status='running', started=timezone.now()):
+                return ImportJob.objects.get(id=idjob)
+        return None
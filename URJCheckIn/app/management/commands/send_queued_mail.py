@@ -0,0 +1,94 @@
+# -*- encoding: utf-8 -*-
+from django.core.management.base import BaseCommand
+from django.core.mail import get_connection, EmailMessage
+from django.utils import timezone
+from optparse import make_option
+from app.models import OutboxEmail
+import datetime
+import smtplib
+import socket
+import time
+
+#Segundos de espera tras el primer fallo de un correo, se duplican en cada
+#intento hasta MAX_RETRY_DELAY
+RETRY_DELAY = 60
+MAX_RETRY_DELAY = 6*3600
+
+
+class Command(BaseCommand):
+    """
+    Envia los correos pendientes del outbox (OutboxEmail) en lotes,
+    reutilizando una unica conexion SMTP. Los correos que fallan se
+    reintentan mas tarde, esperando cada vez el doble
+    Para probarlo en local: python -m smtpd -n -c DebuggingServer
+    localhost:1026
+    """
+    help = 'Envia los correos pendientes del outbox'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', type='int', dest='batch', default=100,
+                    help='Correos que se consultan en cada lote'),
+        make_option('--loop', action='store_true', dest='loop',
+                    default=False,
+                    help='Sigue esperando nuevos correos al vaciar el outbox'),
+        make_option('--sleep', type='float', dest='sleep', default=5,
+                    help='Segundos de espera entre consultas con --loop'),
+        make_option('--max-attempts', type='int', dest='max_attempts',
+                    default=8, help='Intentos antes de descartar un correo'),
+    )
+
+    def handle(self, *args, **options):
+        connection = get_connection(fail_silently=False)
+        n_sent = n_failed = 0
+        try:
+            while True:
+                sent, failed = self.send_batch(connection, options['batch'],
+                                               options['max_attempts'])
+                n_sent += sent
+                n_failed += failed
+                if sent + failed == 0 or (failed and not sent):
+                    #Outbox vacio o servidor caido
+                    if not options['loop']:
+                        break
+                    connection.close()
+                    time.sleep(options['sleep'])
+        finally:
+            connection.close()
+        self.stdout.write('Correos enviados: %i. Fallidos: %i' % (n_sent,
+                                                                  n_failed))
+
+    def send_batch(self, connection, batch_size, max_attempts):
+        """
+        Envia un lote de hasta batch_size correos pendientes por la
+        conexion connection. Devuelve (enviados, fallidos)
+        """
+        now = timezone.now()
+        emails = list(OutboxEmail.objects.filter(sent__isnull=True,
+                                                 next_attempt__lte=now,
+                                                 attempts__lt=max_attempts
+                                        ).order_by('next_attempt',
+                                                   'id')[:batch_size])
+        sent = failed = 0
+        for email in emails:
+            try:
+                #Abre la conexion si no lo esta (si ya lo esta no hace nada)
+                connection.open()
+                EmailMessage(email.subject, email.body, email.from_email,
+                             email.recipients(),
+                             connection=connection).send()
+            except (smtplib.SMTPException, socket.error) as e:
+                #La conexion puede haber quedado inservible
+                connection.close()
+                email.attempts += 1
+                email.last_error = unicode(e)
+                email.next_attempt = timezone.now() + datetime.timedelta(
+                        seconds=min(RETRY_DELAY * 2**(email.attempts - 1),
+                                    MAX_RETRY_DELAY))
+                email.save(update_fields=['attempts', 'last_error',
+                                          'next_attempt'])
+                failed += 1
+            else:
+                email.sent = timezone.now()
+                email.attempts += 1
+                email.save(update_fields=['sent', 'attempts'])
+                sent += 1
+        return sent, failed
@@ -0,0 +1,233 @@
+# -*- encoding: utf-8 -*-
+"""
+Metricas de cada vista (se activa con settings.METRICS)
+
+MetricsMiddleware cuenta por nombre de URL (el de URJCheckIn/urls.py o
+el de la vista si no tiene) las peticiones, un histograma de su
+duracion, las consultas SQL y su tiempo y el tiempo de renderizado de
+las plantillas. La vista metrics las devuelve en el formato de texto de
+Prometheus (solo para el staff)
+Django 1.5 no tiene senales para las consultas ni para las plantillas
+fuera de los tests, asi que al activarlo se envuelven una sola vez
+BaseDatabaseWrapper.cursor y Template.render. Con METRICS = False el
+middleware lanza MiddlewareNotUsed, Django lo descarta y no se envuelve
+nada
+"""
+from django.core.exceptions import MiddlewareNotUsed
+from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db.backends import BaseDatabaseWrapper
+from django.http import HttpResponse, Http404
+from django.template.base import Template
+from django.conf import settings
+import threading
+import bisect
+import time
+
+#Limites superiores (segundos) de los intervalos del histograma de duracion
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class ViewMetrics(object):
+    """Contadores de las peticiones a una vista"""
+    __slots__ = ('requests', 'buckets', 'latency', 'queries', 'sql_time',
+                 'template_time')
+
+    def __init__(self):
+        self.requests = 0
+        #Peticiones en cada intervalo (no acumuladas, el ultimo es +Inf)
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency = 0.0
+        self.queries = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+
+
+class MetricsRegistry(object):
+    """Metricas de todas las vistas del proceso"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def record(self, view, latency, queries, sql_time, template_time):
+        """Anade una peticion a la vista view"""
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, latency)
+        with self.lock:
+            metrics = self.views.get(view)
+            if metrics is None:
+                metrics = self.views[view] = ViewMetrics()
+            metrics.requests += 1
+            metrics.buckets[bucket] += 1
+            metrics.latency += latency
+            metrics.queries += queries
+            metrics.sql_time += sql_time
+            metrics.template_time += template_time
+
+    def reset(self):
+        with self.lock:
+            self.views = {}
+
+    def prometheus(self):
+        """Devuelve las metricas en el formato de texto de Prometheus"""
+        with self.lock:
+            views = sorted((view, metrics.requests, list(metrics.buckets),
+                            metrics.latency, metrics.queries,
+                            metrics.sql_time, metrics.template_time)
+                           for view, metrics in self.views.items())
+        lines = []
+        def header(name, kind, text):
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, kind))
+        header('urjcheckin_requests_total', 'counter', 'Peticiones por vista')
+        for view, requests, buckets, latency, queries, sql, tpl in views:
+            lines.append('urjcheckin_requests_total{view="%s"} %i' % (view,
+                                                                    requests))
+        header('urjcheckin_request_duration_seconds', 'histogram',
+               'Duracion de las peticiones por vista')
+        for view, requests, buckets, latency, queries, sql, tpl in views:
+            count = 0
+            for limit, n in zip(LATENCY_BUCKETS + ('+Inf',), buckets):
+                count += n
+                lines.append('urjcheckin_request_duration_seconds_bucket' \
+                             '{view="%s",le="%s"} %i' % (view, limit, count))
+            lines.append('urjcheckin_request_duration_seconds_sum' \
+                         '{view="%s"} %.6f' % (view, latency))
+            lines.append('urjcheckin_request_duration_seconds_count' \
+                         '{view="%s"} %i' % (view, requests))
+        header('urjcheckin_sql_queries_total', 'counter',
+               'Consultas SQL por vista')
+        for view, requests, buckets, latency, queries, sql, tpl in views:
+            lines.append('urjcheckin_sql_queries_total{view="%s"} %i' % (view,
+                                                                    queries))
+        header('urjcheckin_sql_duration_seconds_total', 'counter',
+               'Tiempo en consultas SQL por vista')
+        for view, requests, buckets, latency, queries, sql, tpl in views:
+            lines.append('urjcheckin_sql_duration_seconds_total' \
+                         '{view="%s"} %.6f' % (view, sql))
+        header('urjcheckin_template_render_seconds_total', 'counter',
+               'Tiempo renderizando plantillas por vista')
+        for view, requests, buckets, latency, queries, sql, tpl in views:
+            lines.append('urjcheckin_template_render_seconds_total' \
+                         '{view="%s"} %.6f' % (view, tpl))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+#Consultas, tiempo SQL y de plantillas acumulados por el hilo actual
+_local = threading.local()
+
+
+def thread_counters():
+    """Devuelve los contadores del hilo actual, creandolos si no existen"""
+    try:
+        return _local.counters
+    except AttributeError:
+        #[consultas, tiempo SQL, tiempo de plantillas, plantillas anidadas]
+        _local.counters = [0, 0.0, 0.0, 0]
+        return _local.counters
+
+
+class TimedCursor(object):
+    """Cursor que suma las consultas y su tiempo a los del hilo"""
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            counters = thread_counters()
+            counters[0] += 1
+            counters[1] += time.time() - start
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            counters = thread_counters()
+            counters[0] += 1
+            counters[1] += time.time() - start
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+
+_installed = False
+_install_lock = threading.Lock()
+
+def install_hooks():
+    """
+    Envuelve (una sola vez) la creacion de cursores y el renderizado de
+    plantillas para medirlos
+    """
+    global _installed
+    with _install_lock:
+        if _installed:
+            return
+        cursor = BaseDatabaseWrapper.cursor
+        def timed_cursor(self):
+            return TimedCursor(cursor(self))
+        BaseDatabaseWrapper.cursor = timed_cursor
+
+        render = Template.render
+        def timed_render(self, context):
+            counters = thread_counters()
+            #Solo se mide la plantilla exterior, no las incluidas en ella
+            if counters[3]:
+                return render(self, context)
+            counters[3] = 1
+            start = time.time()
+            try:
+                return render(self, context)
+            finally:
+                counters[3] = 0
+                counters[2] += time.time() - start
+        Template.render = timed_render
+        _installed = True
+
+
+def metrics_enabled():
+    """Devuelve True si estan activadas las metricas"""
+    return getattr(settings, 'METRICS', False)
+
+
+class MetricsMiddleware(object):
+    """
+    Mide cada peticion y la anade a las metricas de su vista. Debe ir el
+    primero en MIDDLEWARE_CLASSES para medir tambien a los demas
+    """
+    def __init__(self):
+        if not metrics_enabled():
+            raise MiddlewareNotUsed
+        install_hooks()
+
+    def process_request(self, request):
+        counters = thread_counters()
+        request._metrics_start = (time.time(), counters[0], counters[1],
+                                  counters[2])
+
+    def process_response(self, request, response):
+        start = getattr(request, '_metrics_start', None)
+        if start is None:
+            return response
+        counters = thread_counters()
+        match = getattr(request, 'resolver_match', None)
+        registry.record(match.view_name if match else 'unresolved',
+                        time.time() - start[0], counters[0] - start[1],
+                        counters[1] - start[2], counters[2] - start[3])
+        return response
+
+
+@login_required
+@staff_member_required
+def metrics(request):
+    """Devuelve las metricas de las vistas en el formato de Prometheus"""
+    if not metrics_enabled():
+        raise Http404
+    return HttpResponse(registry.prometheus(),
+                        content_type='text/plain; version=0.0.4')
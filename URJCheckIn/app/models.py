@@ -4,11 +4,16 @@ from django.contrib.auth.models import User
 from django.utils import timezone, formats
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.core.exceptions import ValidationError
-from django.db.models import Avg
+from django.db.models import Count, Sum, F, Q
+from django.db import transaction, connection, IntegrityError
 from django.conf import settings
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
 import os
-from django.db.models.signals import post_save, pre_save
+from django.db.models.signals import (post_save, pre_save, post_delete,
+                                      pre_delete, m2m_changed)
 import datetime
+import calendar
 import random
 import pytz
 import random
@@ -43,6 +48,10 @@ class Subject(models.Model):
     #util para seminarios, se puede dejar a 0 para clases
     max_students = models.PositiveIntegerField(verbose_name='plazas',
                                                 default=0)
+    #Alumnos matriculados, se mantiene en update_subject_students y se
+    #incrementa con take_seat al apuntarse a un seminario
+    seats_taken = models.PositiveIntegerField(default=0, editable=False,
+                                              verbose_name='plazas ocupadas')
     description = models.TextField(max_length=200, blank=True,
                                     verbose_name='descripción')
     creator = models.ForeignKey(User, verbose_name='creador')
@@ -65,6 +74,21 @@ class Subject(models.Model):
     def n_students(self):
         return self.userprofile_set.filter(is_student=True).count()
 
+    def get_stats(self):
+        """
+        Devuelve el resumen de estadisticas (SubjectStats) de la
+        asignatura, recalculandolo antes si esta desactualizado
+        """
+        try:
+            stats = self.stats
+        except SubjectStats.DoesNotExist:
+            stats = None
+        if stats is None or stats.needs_refresh():
+            refresh_subject_stats(Subject.objects.filter(id=self.id))
+            stats = SubjectStats.objects.get(subject=self.id)
+            self._stats_cache = stats
+        return stats
+
     def percent_prof_attend(self):
         """
         Devuelve el porcentaje de asistencia de los profesores a la 
@@ -72,43 +96,21 @@ class Subject(models.Model):
         las clases antiguas que no son extraoficiales, por tanto 
         el porcentaje puede ser mayor que 100
         """
-        n_lesson_done = self.lesson_set.filter(done=True).count()
-        n_lesson_past = self.lesson_set.filter(
-                                            end_time__lt = timezone.now(),
-                                            is_extra = False
-                                        ).count()
-        if n_lesson_past < 1:
-            return 100
-        return round(100.0*n_lesson_done/n_lesson_past, 2)
+        return self.get_stats().percent_prof
 
     def percent_stud_attend(self):
         """
         Devuelve el porcentaje de asistencia de los alumnos a la
         asignatura
         """
-        n_lessons_done = self.lesson_set.filter(done=True).count()
-        #El total de checkins que podria haber es el numero de clases dadas por
-        # el numero de estudiantes de la asignatura
-        n_div = self.n_students()*n_lessons_done
-        n_checks = CheckIn.objects.filter(user__userprofile__is_student=True, 
-                                          lesson__subject=self,
-                                          lesson__done=True).count()
-        if n_div < 1:
-            return 100
-        return round(100.0*n_checks/n_div, 2)
+        return self.get_stats().percent_stud
 
     def avg_mark(self):
         """
         Devuelve la valoracion media de la asignatura, teniendo en
         cuenta todas las clases realizadas
         """
-        lessons = self.lesson_set.filter(done=True)
-        if not lessons:
-            return 3
-        mark = 0
-        for lesson in lessons:
-            mark += lesson.avg_mark()
-        return round(mark/lessons.count(), 2)
+        return self.get_stats().avg_mark
 
     def subject_state(self):
         """
@@ -226,9 +228,28 @@ class Lesson(models.Model):
                                 default=get_rand_string)
     students_counted = models.PositiveIntegerField(
                                 default=0, verbose_name='alumnos contados')
+    #Contadores que se mantienen al guardar o borrar CheckIns y al matricular
+    #alumnos, para no tener que contarlos en cada consulta
+    stud_checkins = models.PositiveIntegerField(default=0, editable=False,
+                                        verbose_name='checkins de alumnos')
+    mark_sum = models.PositiveIntegerField(default=0, editable=False,
+                                        verbose_name='suma de puntuaciones')
+    mark_count = models.PositiveIntegerField(default=0, editable=False,
+                                        verbose_name='número de puntuaciones')
+    subject_students = models.PositiveIntegerField(default=0, editable=False,
+                                        verbose_name='alumnos matriculados')
+    #La asistencia semanal (AttendanceFact) de la semana de la clase esta
+    #pendiente de recalcular; se marca en la misma actualizacion que los
+    #contadores, asi que los check ins no escriben nada mas
+    attendance_dirty = models.BooleanField(default=True, editable=False,
+                                verbose_name='asistencia desactualizada')
     
     class Meta:
         verbose_name = 'clase'
+        #Clases en un intervalo (ocupacion, codigos), de una asignatura
+        #(check in, calendario, paginas de la asignatura) y de un aula
+        index_together = [['start_time', 'end_time'],
+                          ['subject', 'start_time'], ['room', 'start_time']]
 
     def __unicode__(self):
         return u"Clase de %s (%s)" % (self.subject, 
@@ -238,6 +259,20 @@ class Lesson(models.Model):
     def get_absolute_url(self):
         return "/lesson/%i" % self.id
 
+    def save(self, *args, **kwargs):
+        """
+        Al crear la clase inicializa el numero de alumnos de la
+        asignatura. Al modificarla no sobreescribe los contadores, que
+        solo se actualizan mediante update() (ver update_lesson_counters)
+        """
+        if self.pk is None:
+            self.subject_students = self.subject.n_students()
+        elif not (kwargs.get('update_fields') or kwargs.get('force_insert')):
+            kwargs['update_fields'] = [f.name for f in self._meta.fields
+                                       if not f.primary_key and
+                                       f.name not in LESSON_COUNTER_FIELDS]
+        super(Lesson, self).save(*args, **kwargs)
+
     def clean(self):
         super(Lesson, self).clean()
         if self.start_time and self.end_time:
@@ -247,57 +282,99 @@ class Lesson(models.Model):
             if self.start_time >= self.end_time:
                 raise ValidationError('La hora de finalización debe ser ' +
                                       'posterior a la de inicio')
-            #Para evitar solapamiento de clases
-            lesson_same_time = Lesson.objects.exclude(
-                        start_time__gte=self.end_time
-                    ).exclude(
-                        end_time__lte=self.start_time
-                    ).exclude(
-                        id=self.id
-                    )
             if timezone.localtime(self.start_time).date() != timezone.\
                                             localtime(self.end_time).date():
                 raise ValidationError('No se pueden crear clases que se ' +
                                       'desarrollen en más de un día')
-                
-            try:
-                if lesson_same_time.filter(subject=self.subject):
-                    raise ValidationError('La clase no puede solaparse con ' +
-                                          'otra de la misma asignatura')
-                if lesson_same_time.filter(room=self.room):
-                    raise ValidationError('La clase no puede solaparse con ' +
-                                          'otra en el mismo aula')
-            except (Subject.DoesNotExist, Room.DoesNotExist):
-                pass
+            #Para evitar solapamiento de clases
+            occupancy = LessonOccupancy(self.start_time, self.end_time,
+                                Lesson.objects.filter(Q(subject=self.subject_id)
+                                                      | Q(room=self.room_id)))
+            if occupancy.subject_busy(self.subject_id, self.start_time,
+                                      self.end_time, exclude=self.id):
+                raise ValidationError('La clase no puede solaparse con ' +
+                                      'otra de la misma asignatura')
+            if occupancy.room_busy(self.room_id, self.start_time,
+                                   self.end_time, exclude=self.id):
+                raise ValidationError('La clase no puede solaparse con ' +
+                                      'otra en el mismo aula')
 
     def n_stud_checkin(self):
         """
         Devuelve el numero de estudiantes que hicieron check in en la
         clase
         """
-        return self.checkin_set.filter(
-                                        user__userprofile__is_student=True
-                                    ).count()
+        return self.stud_checkins
 
     def checkin_percent(self):
         """
         Devuelve el porcentaje de estudiantes que hicieron check in en
         la clase (en relacion a los alumnos de la asignatura)
         """
-        n_students = self.subject.n_students()
-        if n_students > 0:
-            n_checkin = self.n_stud_checkin()
-            return round(100.0*n_checkin/n_students, 2)
+        if self.subject_students > 0:
+            return round(100.0*self.stud_checkins/self.subject_students, 2)
         else:
             return 100
 
     def avg_mark(self):
         """Devuelve la valoracion media de la clase"""
-        checkins = self.checkin_set.filter(user__userprofile__is_student=True)
-        if not checkins:
+        if self.mark_count < 1:
             return 3
-        mark = checkins.aggregate(Avg('mark'))['mark__avg']
-        return round(mark, 2)
+        return round(float(self.mark_sum)/self.mark_count, 2)
+
+LESSON_COUNTER_FIELDS = ('stud_checkins', 'mark_sum', 'mark_count',
+                         'subject_students', 'attendance_dirty')
+
+#Duracion en segundos de las franjas en las que se cachean las clases que
+#se estan impartiendo (ver get_active_lessons)
+ACTIVE_LESSONS_SLICE = getattr(settings, 'ACTIVE_LESSONS_SLICE', 60)
+
+def get_time_slice(when):
+    """Devuelve el numero de franja de ACTIVE_LESSONS_SLICE de when"""
+    return calendar.timegm(when.utctimetuple()) // ACTIVE_LESSONS_SLICE
+
+def active_lessons_key(idsubj, time_slice):
+    """Clave de la cache de las clases de idsubj en la franja time_slice"""
+    return 'active_lessons_%i_%i' % (int(idsubj), time_slice)
+
+def shared_cache():
+    """
+    Devuelve la cache si la comparten todos los procesos servidor o None
+    si es local a cada proceso (LocMemCache, la de por defecto), porque
+    al modificar una clase solo se borraria la copia del proceso que la
+    modifica (ver CACHES en settings)
+    """
+    if isinstance(cache, LocMemCache):
+        return None
+    return cache
+
+def get_active_lessons(idsubj, now=None):
+    """
+    Devuelve la lista de clases de la asignatura con id idsubj que se
+    estan impartiendo en now (por defecto ahora)
+    Si hay una cache compartida (ver shared_cache) las clases de cada
+    franja de ACTIVE_LESSONS_SLICE segundos se guardan en ella, de forma
+    que en los check in al comienzo de una clase solo se consultan una
+    vez por franja
+    """
+    if now is None:
+        now = timezone.now()
+    time_slice = get_time_slice(now)
+    key = active_lessons_key(idsubj, time_slice)
+    active_cache = shared_cache()
+    lessons = active_cache and active_cache.get(key)
+    if lessons is None:
+        slice_start = datetime.datetime.fromtimestamp(
+                            time_slice*ACTIVE_LESSONS_SLICE, timezone.utc)
+        slice_end = slice_start + datetime.timedelta(
+                                                seconds=ACTIVE_LESSONS_SLICE)
+        lessons = list(Lesson.objects.filter(subject=idsubj,
+                                             start_time__lte=slice_end,
+                                             end_time__gte=slice_start))
+        if active_cache is not None:
+            active_cache.set(key, lessons, ACTIVE_LESSONS_SLICE)
+    return [lesson for lesson in lessons
+            if lesson.start_time <= now <= lesson.end_time]
 
 class AdminTask(models.Model):
     user = models.ForeignKey(User, verbose_name='usuario')
@@ -315,6 +392,8 @@ class AdminTask(models.Model):
     class Meta:
         verbose_name = 'tarea de administración'
         verbose_name_plural = 'tareas de administración'
+        #Reportes de un usuario por fecha y tareas pendientes por fecha
+        index_together = [['user', 'time'], ['done', 'time']]
 
     def __unicode__(self):
         return u"Petición de %s" % (self.user)
@@ -338,6 +417,18 @@ class CheckIn(models.Model):
 
     def __unicode__(self):
         return u"Checkin de %s" % (self.lesson)
+
+    def save(self, *args, **kwargs):
+        """
+        Guarda el CheckIn en la misma transaccion en la que se actualizan
+        los contadores de la clase (ver update_checkin_counters)
+        """
+        with transaction.commit_on_success():
+            super(CheckIn, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with transaction.commit_on_success():
+            super(CheckIn, self).delete(*args, **kwargs)
     
     def clean(self):
         super(CheckIn, self).clean()
@@ -352,19 +443,444 @@ class CheckIn(models.Model):
 
 def check_lesson_done(sender, instance, **kwargs):
     """
-    Si el checkin es realizado por un profesor pone lesson.done = True
+    Si el checkin es realizado por un profesor pone lesson.done = True,
+    actualizando solo ese campo de la clase (las estadisticas de la
+    asignatura se marcan como desactualizadas en update_checkin_counters)
     """
-    try:
-        profile = instance.user.userprofile
-        if not profile.is_student:
-            lesson = instance.lesson
-            lesson.done = True
-            lesson.save()
-    except UserProfile.DoesNotExist:
-        pass
+    if checkin_is_student(instance) is False:
+        Lesson.objects.filter(id=instance.lesson_id).update(done=True,
+                                                    attendance_dirty=True)
 post_save.connect(check_lesson_done, sender=CheckIn)
 
 
+def checkin_is_student(checkin):
+    """
+    Devuelve True si el CheckIn es de un alumno, False si es de un
+    profesor y None si no se puede saber (el usuario no tiene perfil)
+    """
+    try:
+        return checkin.user.userprofile.is_student
+    except (User.DoesNotExist, UserProfile.DoesNotExist):
+        return None
+
+def update_checkin_counters(sender, instance, **kwargs):
+    """
+    Actualiza los contadores de la clase del CheckIn instance al crearlo
+    o borrarlo. Si se modifica un CheckIn existente o no se puede saber
+    si es de un alumno se recalculan los contadores de la clase
+    """
+    if kwargs.get('raw'):
+        return
+    is_student = checkin_is_student(instance)
+    lessons = Lesson.objects.filter(id=instance.lesson_id)
+    mark_stats_dirty(lessons.values_list('subject', flat=True))
+    if is_student is None or kwargs.get('created') is False:
+        update_lesson_counters(lessons)
+    elif is_student:
+        #En post_save se suma y en post_delete se resta
+        sign = 1 if kwargs.get('created') else -1
+        if instance.mark is None:
+            lessons.update(stud_checkins=F('stud_checkins') + sign,
+                           attendance_dirty=True)
+        else:
+            lessons.update(stud_checkins=F('stud_checkins') + sign,
+                           mark_sum=F('mark_sum') + sign*instance.mark,
+                           mark_count=F('mark_count') + sign,
+                           attendance_dirty=True)
+post_save.connect(update_checkin_counters, sender=CheckIn)
+post_delete.connect(update_checkin_counters, sender=CheckIn)
+
+
+def update_lesson_counters(lessons):
+    """
+    Recalcula desde cero los contadores de las clases del queryset
+    lessons a partir de los CheckIns y las matriculas, y marca su
+    asistencia semanal como desactualizada
+    """
+    checkins = CheckIn.objects.filter(
+                    lesson__in=lessons, user__userprofile__is_student=True
+                ).values('lesson').annotate(n=Count('id'), marks=Sum('mark'),
+                                            n_marks=Count('mark'))
+    checkins = dict((c['lesson'], c) for c in checkins)
+    students = UserProfile.objects.filter(
+                    is_student=True, subjects__lesson__in=lessons
+                ).values('subjects').annotate(n=Count('id', distinct=True))
+    students = dict((s['subjects'], s['n']) for s in students)
+    with transaction.commit_on_success():
+        for idlesson, idsubj in lessons.values_list('id', 'subject'):
+            info = checkins.get(idlesson, {'n': 0, 'marks': 0, 'n_marks': 0})
+            Lesson.objects.filter(id=idlesson).update(
+                    stud_checkins=info['n'], mark_sum=info['marks'] or 0,
+                    mark_count=info['n_marks'],
+                    subject_students=students.get(idsubj, 0),
+                    attendance_dirty=True)
+        mark_stats_dirty(lessons.values_list('subject', flat=True))
+
+
+def update_subject_students(subjects):
+    """
+    Recalcula el numero de alumnos matriculados guardado en las plazas
+    ocupadas y en las clases de las asignaturas con ids subjects
+    Las plazas se cuentan en la misma sentencia UPDATE, de forma que el
+    recuento no puede pisar una plaza ocupada a la vez con take_seat
+    """
+    through = UserProfile.subjects.through._meta.db_table
+    seats_sql = ('UPDATE ' + Subject._meta.db_table + ' SET seats_taken = ' +
+        '(SELECT COUNT(*) FROM ' + through + ' s INNER JOIN ' +
+        UserProfile._meta.db_table + ' p ON s.userprofile_id = p.id' +
+        ' WHERE s.subject_id = %s AND p.is_student = %s) WHERE id = %s')
+    cursor = connection.cursor()
+    for idsubj in subjects:
+        cursor.execute(seats_sql, [idsubj, True, idsubj])
+        n_students = Subject.objects.filter(id=idsubj).values_list(
+                                                        'seats_taken',
+                                                        flat=True)[0]
+        Lesson.objects.filter(subject=idsubj).update(
+                                                subject_students=n_students)
+    transaction.commit_unless_managed()
+    mark_stats_dirty(subjects)
+    record_attendance_change(subjects)
+
+def take_seat(subject):
+    """
+    Ocupa una plaza del seminario subject si queda alguna y devuelve si
+    la ha ocupado. Es una sola actualizacion condicional, de forma que
+    dos peticiones a la vez no pueden ocupar la misma plaza; ademas
+    bloquea la fila de la asignatura hasta el final de la transaccion,
+    asi que quien la llame dentro de una puede matricular al alumno sin
+    que otra peticion se cuele
+    """
+    #La condicion seats_taken < max_students va en la propia UPDATE y la
+    #base de datos la comprueba al escribir la fila, asi que es la que
+    #impide pasarse de plazas; con extra porque compara dos columnas
+    return Subject.objects.filter(id=subject.id).extra(
+                                where=['seats_taken < max_students']
+                            ).update(seats_taken=F('seats_taken') + 1) > 0
+
+def release_seat(subject):
+    """Libera una plaza ocupada con take_seat del seminario subject"""
+    Subject.objects.filter(id=subject.id, seats_taken__gt=0).update(
+                                        seats_taken=F('seats_taken') - 1)
+
+def enrollment_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Mantiene el numero de alumnos de las clases al modificar las
+    asignaturas de un perfil (o los perfiles de una asignatura)
+    """
+    if reverse:
+        #instance es la asignatura y pk_set los perfiles
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            update_subject_students([instance.id])
+        return
+    if not instance.is_student:
+        return
+    if action == 'pre_clear':
+        instance._cleared_subjects = list(
+                            instance.subjects.values_list('id', flat=True))
+    elif action == 'post_clear':
+        update_subject_students(getattr(instance, '_cleared_subjects', []))
+    elif action in ('post_add', 'post_remove'):
+        update_subject_students(pk_set)
+m2m_changed.connect(enrollment_changed, sender=UserProfile.subjects.through)
+
+def remember_profile_subjects(sender, instance, **kwargs):
+    """
+    Guarda antes de modificar o borrar un perfil si era alumno y sus
+    asignaturas, para que profile_changed recuente sus alumnos (al
+    borrarlo sus matriculas se borran sin enviar m2m_changed)
+    """
+    instance._old_is_student = None
+    if instance.pk is not None and not kwargs.get('raw'):
+        old = list(UserProfile.objects.filter(id=instance.pk
+                                    ).values_list('is_student', flat=True))
+        if old:
+            instance._old_is_student = old[0]
+            instance._old_subjects = list(
+                            instance.subjects.values_list('id', flat=True))
+pre_save.connect(remember_profile_subjects, sender=UserProfile)
+pre_delete.connect(remember_profile_subjects, sender=UserProfile)
+
+def profile_changed(sender, instance, **kwargs):
+    """
+    Recuenta los alumnos de las asignaturas de un alumno borrado (tambien
+    al borrar su usuario) o de un perfil que cambia de alumno a profesor
+    o al reves, y en ese caso tambien los contadores de las clases en las
+    que ha hecho check in
+    """
+    old_is_student = getattr(instance, '_old_is_student', None)
+    if old_is_student is None:
+        return
+    if kwargs.get('signal') is post_delete:
+        if old_is_student:
+            update_subject_students(instance._old_subjects)
+    elif old_is_student != instance.is_student:
+        update_subject_students(instance._old_subjects)
+        update_lesson_counters(Lesson.objects.filter(
+                                            checkin__user=instance.user_id))
+post_save.connect(profile_changed, sender=UserProfile)
+post_delete.connect(profile_changed, sender=UserProfile)
+
+
+class SubjectStats(models.Model):
+    """
+    Resumen de la asistencia y valoracion de una asignatura. Se marca
+    como desactualizado (dirty) al cambiar sus clases, CheckIns o
+    matriculas y se recalcula al consultarlo (ver refresh_subject_stats)
+    """
+    subject = models.OneToOneField(Subject, related_name='stats',
+                                   verbose_name='asignatura')
+    lessons = models.PositiveIntegerField(default=0, verbose_name='clases')
+    lessons_done = models.PositiveIntegerField(default=0,
+                                        verbose_name='clases realizadas')
+    lessons_past = models.PositiveIntegerField(default=0,
+                                        verbose_name='clases pasadas')
+    stud_checkins = models.PositiveIntegerField(default=0,
+                                        verbose_name='checkins de alumnos')
+    n_students = models.PositiveIntegerField(default=0,
+                                        verbose_name='alumnos')
+    mark_sum = models.PositiveIntegerField(default=0,
+                                        verbose_name='suma de puntuaciones')
+    mark_count = models.PositiveIntegerField(default=0,
+                                        verbose_name='número de puntuaciones')
+    percent_prof = models.FloatField(default=100,
+                                verbose_name='asistencia de profesores')
+    percent_stud = models.FloatField(default=100,
+                                verbose_name='asistencia de alumnos')
+    avg_mark = models.FloatField(default=3, verbose_name='valoración media')
+    #Fin de la proxima clase oficial, a partir de la cual cambia lessons_past
+    next_lesson_end = models.DateTimeField(null=True, blank=True,
+                                verbose_name='fin de la próxima clase')
+    dirty = models.BooleanField(default=True, verbose_name='desactualizado')
+
+    class Meta:
+        verbose_name = 'estadísticas de asignatura'
+        verbose_name_plural = 'estadísticas de asignaturas'
+
+    def __unicode__(self):
+        return u"Estadísticas de %s" % (self.subject)
+
+    def needs_refresh(self):
+        """Devuelve True si hay que recalcular las estadisticas"""
+        return self.dirty or (self.next_lesson_end is not None and
+                              self.next_lesson_end < timezone.now())
+
+
+def mark_stats_dirty(subjects):
+    """
+    Marca como desactualizadas las estadisticas de las asignaturas
+    subjects (ids o queryset de ids)
+    """
+    SubjectStats.objects.filter(subject__in=subjects).update(dirty=True)
+
+def subjects_stale_stats():
+    """
+    Devuelve las asignaturas cuyas estadisticas no existen o estan
+    desactualizadas
+    """
+    return Subject.objects.filter(Q(stats__isnull=True) | Q(stats__dirty=True) |
+                                  Q(stats__next_lesson_end__lt=timezone.now()))
+
+def refresh_subject_stats(subjects):
+    """
+    Recalcula las estadisticas de las asignaturas del queryset subjects
+    a partir de los contadores de sus clases. Devuelve el numero de
+    asignaturas recalculadas
+    """
+    ids = list(subjects.values_list('id', flat=True))
+    if not ids:
+        return 0
+    #Se limpia dirty antes de leer para no perder cambios concurrentes
+    SubjectStats.objects.filter(subject__in=ids).update(dirty=False)
+    now = timezone.now()
+    info = dict((idsubj, {'lessons': 0, 'lessons_done': 0, 'lessons_past': 0,
+                          'stud_checkins': 0, 'mark_sum': 0, 'mark_count': 0,
+                          'next_lesson_end': None, 'marks': 0})
+                for idsubj in ids)
+    lessons = Lesson.objects.filter(subject__in=ids).values_list('subject',
+                    'done', 'is_extra', 'end_time', 'stud_checkins',
+                    'mark_sum', 'mark_count')
+    for (idsubj, done, is_extra, end_time, checkins, mark_sum,
+         mark_count) in lessons:
+        stats = info[idsubj]
+        stats['lessons'] += 1
+        if not is_extra:
+            if end_time < now:
+                stats['lessons_past'] += 1
+            elif (stats['next_lesson_end'] is None or
+                  end_time < stats['next_lesson_end']):
+                stats['next_lesson_end'] = end_time
+        if done:
+            stats['lessons_done'] += 1
+            stats['stud_checkins'] += checkins
+            stats['mark_sum'] += mark_sum
+            stats['mark_count'] += mark_count
+            #La valoracion de la asignatura es la media de la de sus clases
+            if mark_count > 0:
+                stats['marks'] += round(float(mark_sum)/mark_count, 2)
+            else:
+                stats['marks'] += 3
+    students = UserProfile.objects.filter(is_student=True, subjects__in=ids
+                            ).values('subjects').annotate(n=Count('id'))
+    students = dict((s['subjects'], s['n']) for s in students)
+
+    with transaction.commit_on_success():
+        for idsubj, stats in info.items():
+            stats['n_students'] = students.get(idsubj, 0)
+            n_div = stats['n_students']*stats['lessons_done']
+            stats['percent_stud'] = 100 if n_div < 1 else round(
+                                    100.0*stats['stud_checkins']/n_div, 2)
+            stats['percent_prof'] = 100 if stats['lessons_past'] < 1 else \
+                round(100.0*stats['lessons_done']/stats['lessons_past'], 2)
+            stats['avg_mark'] = 3 if stats['lessons_done'] < 1 else round(
+                                    stats['marks']/stats['lessons_done'], 2)
+            del stats['marks']
+            if not SubjectStats.objects.filter(subject=idsubj).update(**stats):
+                #Otra peticion puede crearlas a la vez: entonces se actualizan
+                sid = transaction.savepoint()
+                try:
+                    SubjectStats.objects.create(subject_id=idsubj,
+                                                dirty=False, **stats)
+                    transaction.savepoint_commit(sid)
+                except IntegrityError:
+                    transaction.savepoint_rollback(sid)
+                    SubjectStats.objects.filter(subject=idsubj).update(**stats)
+    return len(ids)
+
+
+def lesson_subjects(lesson):
+    """
+    Devuelve los ids de la asignatura de lesson y, si ha cambiado al
+    guardarla, de la anterior (ver remember_lesson_subject)
+    """
+    subjects = set([lesson.subject_id])
+    if getattr(lesson, '_old_subject_id', None) is not None:
+        subjects.add(lesson._old_subject_id)
+    return subjects
+
+def remember_lesson_subject(sender, instance, **kwargs):
+    """
+    Guarda antes de modificar una clase su asignatura anterior, para que
+    lesson_changed y lesson_attendance_changed actualicen tambien la de
+    la asignatura de la que sale
+    """
+    instance._old_subject_id = None
+    if instance.pk is not None and not kwargs.get('raw'):
+        old_subject = list(Lesson.objects.filter(id=instance.pk
+                                    ).values_list('subject', flat=True))
+        if old_subject and old_subject[0] != instance.subject_id:
+            instance._old_subject_id = old_subject[0]
+pre_save.connect(remember_lesson_subject, sender=Lesson)
+
+def lesson_changed(sender, instance, **kwargs):
+    """
+    Marca como desactualizadas las estadisticas de la asignatura al
+    crear, modificar o borrar una de sus clases y borra de la cache sus
+    clases activas (tambien las de la asignatura anterior si cambia)
+    """
+    if not kwargs.get('raw'):
+        subjects = lesson_subjects(instance)
+        mark_stats_dirty(subjects)
+        if shared_cache() is not None:
+            time_slice = get_time_slice(timezone.now())
+            shared_cache().delete_many([active_lessons_key(idsubj,
+                                                           time_slice)
+                                        for idsubj in subjects])
+post_save.connect(lesson_changed, sender=Lesson)
+post_delete.connect(lesson_changed, sender=Lesson)
+
+
+class AttendanceFact(models.Model):
+    """
+    Asistencia de un alumno a una asignatura en una semana ISO: clases
+    realizadas, clases a las que hizo check in y suma y numero de sus
+    valoraciones. Las calcula de forma incremental rollup_attendance
+    (ver app/rollup.py), para no contar los CheckIns en cada consulta
+    """
+    user = models.ForeignKey(User, verbose_name='alumno')
+    subject = models.ForeignKey(Subject, verbose_name='asignatura')
+    year = models.PositiveSmallIntegerField(verbose_name='año')
+    week = models.PositiveSmallIntegerField(verbose_name='semana')
+    lessons = models.PositiveIntegerField(default=0,
+                                          verbose_name='clases realizadas')
+    attended = models.PositiveIntegerField(default=0,
+                                           verbose_name='clases asistidas')
+    mark_sum = models.PositiveIntegerField(default=0,
+                                        verbose_name='suma de puntuaciones')
+    mark_count = models.PositiveIntegerField(default=0,
+                                        verbose_name='número de puntuaciones')
+
+    class Meta:
+        verbose_name = 'asistencia semanal'
+        verbose_name_plural = 'asistencias semanales'
+        unique_together = ('subject', 'year', 'week', 'user')
+        index_together = [['user', 'year', 'week']]
+
+    def __unicode__(self):
+        return u"Asistencia de %s a %s (%i-%02i)" % (self.user, self.subject,
+                                                     self.year, self.week)
+
+
+class AttendanceChange(models.Model):
+    """
+    Cambio pendiente de procesar por rollup_attendance en la asistencia
+    de una asignatura en una semana (en todas si week es nulo). Se
+    apuntan al modificar o borrar clases y al cambiar las matriculas; los
+    CheckIns marcan su clase con Lesson.attendance_dirty
+    """
+    #Id y no ForeignKey porque se apuntan cambios al borrar la asignatura
+    subject = models.PositiveIntegerField(verbose_name='asignatura')
+    year = models.PositiveSmallIntegerField(null=True, blank=True,
+                                            verbose_name='año')
+    week = models.PositiveSmallIntegerField(null=True, blank=True,
+                                            verbose_name='semana')
+    created = models.DateTimeField(default=timezone.now,
+                                   verbose_name='creado')
+
+    class Meta:
+        verbose_name = 'cambio de asistencia'
+        verbose_name_plural = 'cambios de asistencia'
+
+
+class AttendanceRollup(models.Model):
+    """
+    Ultima ejecucion de rollup_attendance (una sola fila), para saber
+    como de actualizada esta la asistencia semanal
+    """
+    updated = models.DateTimeField(null=True, blank=True,
+                                   verbose_name='actualizado')
+
+    class Meta:
+        verbose_name = 'actualización de la asistencia'
+        verbose_name_plural = 'actualizaciones de la asistencia'
+
+
+def lesson_week(start_time):
+    """Devuelve (año, semana ISO) del dia local de start_time"""
+    return tuple(timezone.localtime(start_time).isocalendar()[:2])
+
+def record_attendance_change(subjects, start_time=None):
+    """
+    Apunta que ha cambiado la asistencia de las asignaturas subjects (ids)
+    en la semana de start_time, o en todas si no se indica
+    """
+    year, week = lesson_week(start_time) if start_time else (None, None)
+    AttendanceChange.objects.bulk_create([AttendanceChange(subject=idsubj,
+                                                year=year, week=week)
+                                          for idsubj in subjects])
+
+def lesson_attendance_changed(sender, instance, **kwargs):
+    """
+    Apunta el cambio de asistencia al modificar o borrar una clase. Como
+    puede haber cambiado de semana se recalculan todas las de la
+    asignatura. Las clases nuevas ya se crean con attendance_dirty
+    """
+    if kwargs.get('raw') or kwargs.get('created'):
+        return
+    record_attendance_change(lesson_subjects(instance))
+post_save.connect(lesson_attendance_changed, sender=Lesson)
+post_delete.connect(lesson_attendance_changed, sender=Lesson)
+
+
 class LessonComment(models.Model):
     user = models.ForeignKey(User, verbose_name='usuario')
     lesson = models.ForeignKey(Lesson, verbose_name='clase')
@@ -374,6 +890,7 @@ class LessonComment(models.Model):
     class Meta:
         verbose_name = 'comentario en clase'
         verbose_name_plural = 'comentarios en clase'
+        index_together = [['lesson', 'date']]
 
     def __unicode__(self):
         return u"Comentario de %s" % (self.lesson)
@@ -382,7 +899,8 @@ class LessonComment(models.Model):
 class ForumComment(models.Model):
     user = models.ForeignKey(User, verbose_name='usuario')
     comment = models.TextField(max_length=150, verbose_name='comentario')
-    date =  models.DateTimeField(default=timezone.now, verbose_name='hora')
+    date =  models.DateTimeField(default=timezone.now, db_index=True,
+                                 verbose_name='hora')
 
     class Meta:
         verbose_name = 'comentario del foro'
@@ -401,6 +919,7 @@ class Timetable(models.Model):
     
     class Meta:
         verbose_name = 'horario'
+        index_together = [['day', 'room']]
 
     def __unicode__(self):
         return u"Horario de %s" % (self.subject)
@@ -411,29 +930,28 @@ class Timetable(models.Model):
             if (self.start_time >= self.end_time):
                 raise ValidationError('La hora de finalización debe ser ' +
                                       'posterior a la de inicio')
-            #Para evitar solapamiento de clases
-            timetables_same_time = Timetable.objects.filter(
-                            day=self.day
-                        ).exclude(
-                            start_time__gte=self.end_time
-                        ).exclude(
-                            end_time__lte=self.start_time
-                        ).exclude(
-                            id=self.id
-                        )
             try:
                 if self.subject:
                     #Se comprueba si tiene 'name' para el caso en que se cree
                     # el Timetable a la vez que la Subject y en la creacion de
                     # la Subject haya errores
                     if self.subject.name:
-                        if timetables_same_time.filter(subject=self.subject):
+                        #Para evitar solapamiento de clases
+                        occupancy = TimetableOccupancy(self.subject.first_date,
+                                                       self.subject.last_date,
+                                                       self.day)
+                        if occupancy.subject_busy(self.day, self.subject.id,
+                                                  self.start_time,
+                                                  self.end_time,
+                                                  exclude=self.id):
                             raise ValidationError('El horario no puede ' +
                                                   'solaparse con otro ' +
                                                   'de la misma asignatura')
-                        if timetables_same_time.filter(room=self.room, 
-                            subject__last_date__gte=self.subject.first_date,
-                            subject__first_date__lte=self.subject.last_date):
+                        if occupancy.room_busy(self.day, self.room_id,
+                                               self.start_time, self.end_time,
+                                               self.subject.first_date,
+                                               self.subject.last_date,
+                                               exclude=self.id):
                             raise ValidationError('El horario no puede ' +
                                                   'solaparse con otro ' +
                                                   'en el mismo aula')
@@ -464,79 +982,222 @@ def get_first_lesson_date(timetable):
         first_date += datetime.timedelta(days=7)
     return first_date + datetime.timedelta(days=(dayweek-first_dayweek))
 
-def create_lesson(start_datetime, end_datetime, room, subject):
+def get_timetable_slots(timetable):
+    """
+    Devuelve una lista con el inicio y el fin (datetimes con la
+    timezone actual) de cada clase del horario timetable, desde el
+    primer dia de clase hasta el fin de la asignatura
     """
-    Crea una clase para la asignatura subject desde start_datetime hasta
-    end_datetime
+    date = get_first_lesson_date(timetable)
+    last_date = timetable.subject.last_date
+    current_tz = pytz.timezone(str(timezone.get_current_timezone()))
+    slots = []
+    while date <= last_date:
+        #Se localiza cada dia por separado para respetar los cambios de hora
+        start_datetime = current_tz.localize(datetime.datetime(date.year,
+                                date.month, date.day, timetable.start_time.hour,
+                                timetable.start_time.minute), is_dst=None)
+        end_datetime = current_tz.localize(datetime.datetime(date.year,
+                                date.month, date.day, timetable.end_time.hour,
+                                timetable.end_time.minute), is_dst=None)
+        slots.append((start_datetime, end_datetime))
+        date += datetime.timedelta(days=7)
+    return slots
+
+def create_lessons(slots, room, subject):
+    """
+    Crea con un unico bulk_create las clases de la asignatura subject en
+    el aula room para cada franja (inicio, fin) de slots:
     -En caso de existir ya una clase de la asignatura en esa franja
     horaria no se creara
     -En caso de estar ocupada el aula se buscara una libre en ese
     edificio y si no la hay no se creara
+    Las clases existentes se obtienen con una sola consulta y los
+    solapamientos se comprueban en memoria con un LessonOccupancy
+    Devuelve la lista de clases creadas
     """
-    lessons_now = Lesson.objects.filter(start_time__lte = end_datetime, 
-                                        end_time__gte = start_datetime)
-    #Si ya hay una clase de la asignatura
-    if lessons_now.filter(subject = subject).exists():
-        pass
-    #Si ya hay una clase en ese aula busca otro aula en el edificio
-    elif lessons_now.filter(room = room).exists():
-        new_room = get_free_room(start_datetime, end_datetime, room.building)
-        if new_room:#si no hay aula libre a esa hora no se crea la clase 
-            Lesson(start_time=start_datetime, end_time = end_datetime,
-                   subject = subject, room = new_room).save()
-    else:
-        Lesson(start_time=start_datetime, end_time = end_datetime,
-               subject = subject, room = room).save()
+    if not slots:
+        return []
+    first_start = min(start for start, end in slots)
+    last_end = max(end for start, end in slots)
+    rooms = list(Room.objects.filter(
+                    building=room.building_id).values_list('id', flat=True))
+    occupancy = LessonOccupancy(first_start, last_end, Lesson.objects.filter(
+                    Q(subject=subject) | Q(room__building=room.building_id)))
+
+    n_students = subject.n_students()
+    new_lessons = []
+    for start_time, end_time in slots:
+        #Si ya hay una clase de la asignatura
+        if occupancy.subject_busy(subject.id, start_time, end_time,
+                                  inclusive=True):
+            continue
+        #Si ya hay una clase en ese aula busca otro aula en el edificio
+        idroom = room.id
+        if occupancy.room_busy(idroom, start_time, end_time, inclusive=True):
+            free_rooms = occupancy.free_rooms(rooms, start_time, end_time)
+            if not free_rooms:#si no hay aula libre a esa hora no se crea
+                continue
+            idroom = random.choice(free_rooms)
+        lesson = Lesson(start_time=start_time, end_time=end_time,
+                        subject=subject, room_id=idroom,
+                        subject_students=n_students)
+        new_lessons.append(lesson)
+        occupancy.add_lesson(lesson)
+
+    with transaction.commit_on_success():
+        Lesson.objects.bulk_create(new_lessons)
+        mark_stats_dirty([subject.id])
+    return new_lessons
 
 
 def create_timetable_lessons(sender, instance, **kwargs):
     """
     Crea clases de la asignatura instance.subject en los dias
     instance.day durante el periodo de la asignatuta
-    Funcion pensada para ser llamada despues de guardar un Timetable
-    """
-    date = get_first_lesson_date(instance)
-
-    last_date = instance.subject.last_date
-    current_tz = str(timezone.get_current_timezone())
-    start_datetime_n = datetime.datetime(date.year, date.month, date.day,
-                                         instance.start_time.hour,
-                                         instance.start_time.minute)
-    start_datetime = pytz.timezone(current_tz).localize(start_datetime_n,
-                                                        is_dst=None)
-    end_datetime_n = datetime.datetime(date.year, date.month, date.day,
-                                       instance.end_time.hour,
-                                       instance.end_time.minute)
-    end_datetime = pytz.timezone(current_tz).localize(end_datetime_n,
-                                                      is_dst=None)
-
-    room = instance.room
-    subject = instance.subject
-    while start_datetime.date() <= last_date:
-        create_lesson(start_datetime, end_datetime, room, subject)
-        start_datetime += datetime.timedelta(days=7)
-        end_datetime += datetime.timedelta(days=7)
+    Funcion pensada para ser llamada antes de guardar un Timetable
+    """
+    create_lessons(get_timetable_slots(instance), instance.room,
+                   instance.subject)
     
 pre_save.connect(create_timetable_lessons, sender=Timetable)
 
 
+def get_free_rooms(start_time, end_time, buildings, occupancy=None):
+    """
+    Devuelve la lista de las aulas libres de los edificios buildings
+    (lista o queryset) desde start_time hasta end_time, obtenida en una
+    sola consulta (con una subconsulta NOT IN)
+    Si se indica occupancy (LessonOccupancy que cubra el periodo) solo se
+    consultan las aulas de los edificios y las libres se eligen segun el
+    indice
+    """
+    rooms = Room.objects.filter(building__in=buildings
+                               ).select_related('building')
+    if occupancy is not None and occupancy.covers(start_time, end_time):
+        return [room for room in rooms if not occupancy.room_busy(room.id,
+                                    start_time, end_time, inclusive=True)]
+    busy_rooms = Lesson.objects.filter(start_time__lte=end_time,
+                                       end_time__gte=start_time
+                                      ).values('room')
+    return list(rooms.exclude(id__in=busy_rooms))
+
 def get_free_room(start_time, end_time, building):
     """
     Devuelve un aula libre en el edificio building desde start_time
     hasta end_time
     """
-    rooms = Room.objects.filter(building=building)
-    n_rooms = rooms.count()
-    #Para no recorrerlas en orden, ya que si fuesen en orden se irian ocupando
-    #las primeras y a medida que aumentasen las clases creadas habria que
-    #recorrer muchas hasta dar con un aula libre
-    rand_pos = random.sample(range(n_rooms), n_rooms)
-    for i in rand_pos:
-        room = rooms[i]
-        if not room.lesson_set.filter(start_time__lte = end_time,
-                                      end_time__gte = start_time).exists():
-            return room
+    #Se elige al azar, ya que si fuesen en orden se irian ocupando siempre
+    #las primeras aulas
+    rooms = get_free_rooms(start_time, end_time, [building])
+    if rooms:
+        return random.choice(rooms)
     return None
 
-    
 
+IMPORT_JOB_KINDS = (
+    ('users', 'Creación de usuarios'),
+    ('enroll', 'Matriculación'),
+)
+IMPORT_JOB_STATUS = (
+    ('pending', 'Pendiente'),
+    ('running', 'En curso'),
+    ('done', 'Terminada'),
+    ('failed', 'Fallida'),
+)
+
+def import_job_path(instance, filename):
+    """Devuelve como nombre import_jobs/ + un string aleatorio + filename"""
+    return 'import_jobs/' + get_rand_string() + '_' + filename
+
+class ImportJob(models.Model):
+    """
+    Importacion de un CSV subido al admin, que ejecuta en segundo plano
+    el comando run_import_jobs guardando su progreso
+    """
+    kind = models.CharField(max_length=10, choices=IMPORT_JOB_KINDS,
+                            verbose_name='tipo')
+    csv_file = models.FileField(upload_to=import_job_path,
+                                verbose_name='fichero')
+    subjects = models.ManyToManyField(Subject, blank=True,
+                                      verbose_name='asignaturas')
+    user = models.ForeignKey(User, verbose_name='usuario')
+    status = models.CharField(max_length=10, choices=IMPORT_JOB_STATUS,
+                              default='pending', verbose_name='estado')
+    created = models.DateTimeField(default=timezone.now,
+                                   verbose_name='creada')
+    started = models.DateTimeField(null=True, blank=True,
+                                   verbose_name='comenzada')
+    finished = models.DateTimeField(null=True, blank=True,
+                                    verbose_name='terminada')
+    rows_processed = models.PositiveIntegerField(default=0,
+                                            verbose_name='filas procesadas')
+    rows_created = models.PositiveIntegerField(default=0,
+                                            verbose_name='filas creadas')
+    rows_skipped = models.PositiveIntegerField(default=0,
+                                            verbose_name='filas omitidas')
+    rows_errored = models.PositiveIntegerField(default=0,
+                                            verbose_name='filas con errores')
+    message = models.TextField(blank=True, verbose_name='mensaje')
+
+    class Meta:
+        verbose_name = 'importación'
+        verbose_name_plural = 'importaciones'
+
+    def __unicode__(self):
+        return u"Importación %i (%s)" % (self.id, self.get_kind_display())
+
+    def get_absolute_url(self):
+        return "/admin/import_jobs/%i" % self.id
+
+    def progress(self):
+        """Devuelve un diccionario con el estado y los contadores"""
+        return {'id': self.id, 'kind': self.kind, 'status': self.status,
+                'status_display': self.get_status_display(),
+                'rows_processed': self.rows_processed,
+                'rows_created': self.rows_created,
+                'rows_skipped': self.rows_skipped,
+                'rows_errored': self.rows_errored,
+                'message': self.message}
+
+
+class OutboxEmail(models.Model):
+    """
+    Correo pendiente de enviar. Los envia el comando send_queued_mail
+    reutilizando una conexion SMTP y reintentando los que fallan
+    """
+    subject = models.CharField(max_length=255, verbose_name='asunto')
+    body = models.TextField(verbose_name='mensaje')
+    from_email = models.CharField(max_length=254, verbose_name='remitente')
+    #Destinatarios separados por comas
+    to = models.TextField(verbose_name='destinatarios')
+    created = models.DateTimeField(default=timezone.now,
+                                   verbose_name='creado')
+    sent = models.DateTimeField(null=True, blank=True, verbose_name='enviado')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='intentos')
+    next_attempt = models.DateTimeField(default=timezone.now,
+                                        verbose_name='siguiente intento')
+    last_error = models.TextField(blank=True, verbose_name='último error')
+
+    class Meta:
+        verbose_name = 'correo pendiente'
+        verbose_name_plural = 'correos pendientes'
+        index_together = [['sent', 'next_attempt']]
+
+    def __unicode__(self):
+        return u"Correo %s a %s" % (self.subject, self.to)
+
+    def recipients(self):
+        return [address for address in self.to.split(',') if address]
+
+def outbox_email(subject, message, from_email, recipient_list):
+    """
+    Devuelve (sin guardar) el OutboxEmail con los mismos parametros que
+    send_mail
+    """
+    return OutboxEmail(subject=subject, body=message, from_email=from_email,
+                       to=','.join(recipient_list))
+
+
+#Al final porque occupancy necesita los modelos Lesson y Timetable
+from occupancy import LessonOccupancy, TimetableOccupancy
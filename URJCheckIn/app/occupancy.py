@@ -0,0 +1,262 @@
+# -*- encoding: utf-8 -*-
+"""
+Indices en memoria de la ocupacion de aulas y asignaturas, para
+comprobar solapamientos de clases y horarios sin hacer una consulta por
+cada comprobacion
+Cada llamada construye sus propios indices, que no se actualizan al
+guardar o borrar clases y horarios
+"""
+from models import Lesson, Timetable
+import bisect
+
+
+class IntervalIndex(object):
+    """
+    Conjunto de intervalos (inicio, fin, valor) ordenados por inicio que
+    guarda ademas el mayor fin de cada prefijo, de forma que se puede
+    saber en tiempo logaritmico si algun intervalo se solapa con uno
+    dado. Construirlo con todos los intervalos cuesta O(n log n);
+    insertar y borrar despues es lineal
+    """
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        self.values = []
+        self.max_ends = []
+        for start, end, value in sorted(intervals):
+            self.starts.append(start)
+            self.ends.append(end)
+            self.values.append(value)
+        self._update_max_ends(0)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _update_max_ends(self, pos):
+        """Recalcula max_ends desde la posicion pos"""
+        del self.max_ends[pos:]
+        for end in self.ends[pos:]:
+            if self.max_ends and self.max_ends[-1] > end:
+                self.max_ends.append(self.max_ends[-1])
+            else:
+                self.max_ends.append(end)
+
+    def add(self, start, end, value=None):
+        """Anade el intervalo desde start hasta end con el valor value"""
+        pos = bisect.bisect_right(self.starts, start)
+        self.starts.insert(pos, start)
+        self.ends.insert(pos, end)
+        self.values.insert(pos, value)
+        self._update_max_ends(pos)
+
+    def remove(self, value):
+        """
+        Elimina los intervalos con valor value. Devuelve True si habia
+        alguno
+        """
+        positions = [i for i, v in enumerate(self.values) if v == value]
+        for pos in reversed(positions):
+            del self.starts[pos]
+            del self.ends[pos]
+            del self.values[pos]
+        if positions:
+            self._update_max_ends(positions[0])
+        return bool(positions)
+
+    def overlapping(self, start, end, inclusive=False):
+        """
+        Devuelve un generador con (inicio, fin, valor) de los intervalos
+        que se solapan con el intervalo desde start hasta end. Si
+        inclusive es True tambien se consideran solapados los intervalos
+        que solo se tocan en un extremo
+        """
+        if inclusive:
+            pos = bisect.bisect_right(self.starts, end)
+        else:
+            pos = bisect.bisect_left(self.starts, end)
+        #Todos los intervalos anteriores a pos empiezan antes del fin, se
+        #recorren hacia atras mientras alguno pueda acabar despues del inicio
+        for i in xrange(pos - 1, -1, -1):
+            if self.max_ends[i] < start or (self.max_ends[i] == start and
+                                            not inclusive):
+                break
+            if self.ends[i] > start or (inclusive and self.ends[i] == start):
+                yield (self.starts[i], self.ends[i], self.values[i])
+
+    def is_busy(self, start, end, inclusive=False, exclude=None):
+        """
+        Devuelve True si algun intervalo con valor distinto de exclude se
+        solapa con el intervalo desde start hasta end
+        """
+        pos = bisect.bisect(self.starts, end) if inclusive else \
+              bisect.bisect_left(self.starts, end)
+        if pos == 0:
+            return False
+        if exclude is None:
+            if inclusive:
+                return self.max_ends[pos - 1] >= start
+            return self.max_ends[pos - 1] > start
+        for interval in self.overlapping(start, end, inclusive):
+            if interval[2] != exclude:
+                return True
+        return False
+
+
+def build_indexes(intervals):
+    """
+    Devuelve un diccionario {clave: IntervalIndex} a partir de la lista
+    intervals de (clave, inicio, fin, valor), construyendo cada indice
+    de una vez
+    """
+    grouped = {}
+    for key, start, end, value in intervals:
+        grouped.setdefault(key, []).append((start, end, value))
+    return dict((key, IntervalIndex(group))
+                for key, group in grouped.iteritems())
+
+
+class LessonOccupancy(object):
+    """
+    Ocupacion de cada aula y cada asignatura por las clases que se
+    solapan con el periodo desde start_time hasta end_time, cargada con
+    una sola consulta. Si se indica lessons (queryset de Lesson) solo se
+    cargan esas clases
+    No ve las clases guardadas o borradas despues de crearlo salvo las
+    que se anaden con add_lesson
+    """
+    def __init__(self, start_time, end_time, lessons=None):
+        self.start_time = start_time
+        self.end_time = end_time
+        if lessons is None:
+            lessons = Lesson.objects.all()
+        lessons = list(lessons.filter(start_time__lte=end_time,
+                                      end_time__gte=start_time).values_list(
+                        'id', 'subject', 'room', 'start_time', 'end_time'))
+        self.rooms = build_indexes([(idroom, start, end, idlesson)
+                for idlesson, idsubj, idroom, start, end in lessons])
+        self.subjects = build_indexes([(idsubj, start, end, idlesson)
+                for idlesson, idsubj, idroom, start, end in lessons])
+
+    def _add(self, idlesson, idsubj, idroom, start, end):
+        if idroom not in self.rooms:
+            self.rooms[idroom] = IntervalIndex()
+        self.rooms[idroom].add(start, end, idlesson)
+        if idsubj not in self.subjects:
+            self.subjects[idsubj] = IntervalIndex()
+        self.subjects[idsubj].add(start, end, idlesson)
+
+    def covers(self, start_time, end_time):
+        """
+        Devuelve True si el periodo desde start_time hasta end_time esta
+        dentro del periodo cargado
+        """
+        return self.start_time <= start_time and end_time <= self.end_time
+
+    def add_lesson(self, lesson):
+        """
+        Anade (o actualiza) la clase lesson si esta en el periodo. La
+        clase puede no estar guardada aun (por ejemplo antes de un
+        bulk_create)
+        """
+        if lesson.id is not None:
+            self.remove_lesson(lesson.id)
+        if (lesson.start_time <= self.end_time and
+                lesson.end_time >= self.start_time):
+            self._add(lesson.id, lesson.subject_id, lesson.room_id,
+                      lesson.start_time, lesson.end_time)
+
+    def remove_lesson(self, idlesson):
+        """Elimina la clase con id idlesson"""
+        for index in self.rooms.values() + self.subjects.values():
+            index.remove(idlesson)
+
+    def room_busy(self, idroom, start_time, end_time, inclusive=False,
+                  exclude=None):
+        """
+        Devuelve True si el aula con id idroom tiene alguna clase (con
+        id distinto de exclude) entre start_time y end_time
+        """
+        index = self.rooms.get(idroom)
+        if index is None:
+            return False
+        return index.is_busy(start_time, end_time, inclusive, exclude)
+
+    def subject_busy(self, idsubj, start_time, end_time, inclusive=False,
+                     exclude=None):
+        """
+        Devuelve True si la asignatura con id idsubj tiene alguna clase
+        (con id distinto de exclude) entre start_time y end_time
+        """
+        index = self.subjects.get(idsubj)
+        if index is None:
+            return False
+        return index.is_busy(start_time, end_time, inclusive, exclude)
+
+    def free_rooms(self, rooms, start_time, end_time, inclusive=True):
+        """
+        Devuelve los ids de rooms (ids de aulas) que estan libres desde
+        start_time hasta end_time
+        """
+        return [idroom for idroom in rooms if not
+                self.room_busy(idroom, start_time, end_time, inclusive)]
+
+
+class TimetableOccupancy(object):
+    """
+    Ocupacion de cada aula y cada asignatura por los horarios de las
+    asignaturas que se imparten entre first_date y last_date, indexados
+    por dia de la semana, cargada con una sola consulta
+    """
+    def __init__(self, first_date, last_date, day=None):
+        self.first_date = first_date
+        self.last_date = last_date
+        self.day = day
+        timetables = Timetable.objects.filter(
+                                subject__first_date__lte=last_date,
+                                subject__last_date__gte=first_date)
+        if day is not None:
+            timetables = timetables.filter(day=day)
+        timetables = timetables.values_list('id', 'day', 'subject', 'room',
+                        'start_time', 'end_time', 'subject__first_date',
+                        'subject__last_date')
+        #El valor de cada intervalo es (id, first_date, last_date)
+        timetables = [(day, idsubj, idroom, start, end,
+                       (idtimetable, first_date, last_date))
+                      for idtimetable, day, idsubj, idroom, start, end,
+                          first_date, last_date in timetables]
+        self.rooms = build_indexes([((day, idroom), start, end, value)
+                for day, idsubj, idroom, start, end, value in timetables])
+        self.subjects = build_indexes([((day, idsubj), start, end, value)
+                for day, idsubj, idroom, start, end, value in timetables])
+
+    def subject_busy(self, day, idsubj, start_time, end_time, exclude=None):
+        """
+        Devuelve True si la asignatura con id idsubj tiene algun horario
+        (con id distinto de exclude) el dia day entre start_time y
+        end_time
+        """
+        index = self.subjects.get((day, idsubj))
+        if index is None:
+            return False
+        for interval in index.overlapping(start_time, end_time):
+            if interval[2][0] != exclude:
+                return True
+        return False
+
+    def room_busy(self, day, idroom, start_time, end_time, first_date,
+                  last_date, exclude=None):
+        """
+        Devuelve True si el aula con id idroom tiene algun horario (con
+        id distinto de exclude) el dia day entre start_time y end_time
+        de una asignatura que se imparte entre first_date y last_date
+        """
+        index = self.rooms.get((day, idroom))
+        if index is None:
+            return False
+        for interval in index.overlapping(start_time, end_time):
+            idtimetable, subj_first_date, subj_last_date = interval[2]
+            if (idtimetable != exclude and subj_last_date >= first_date and
+                    subj_first_date <= last_date):
+                return True
+        return False
+
@@ -0,0 +1,200 @@
+# -*- encoding: utf-8 -*-
+"""
+Paginacion por cursor (keyset) de listas ordenadas por un campo
+
+En lugar de contar las filas y saltar las de las paginas anteriores
+(OFFSET), cada pagina se pide a partir del ultimo elemento visto con un
+cursor opaco que guarda su valor del campo de ordenacion y su id, de
+forma que cada pagina es una unica consulta con LIMIT n+1 que puede
+recorrer el indice del campo, tan rapida la primera como la ultima. El
+id desempata los elementos con el mismo valor, que asi no se repiten ni
+se saltan entre paginas
+"""
+from django.db.models import Q
+from django.utils.encoding import force_text
+import base64
+import datetime
+import json
+
+
+class InvalidCursor(ValueError):
+    """Cursor mal formado o de otra ordenacion"""
+    pass
+
+
+class CursorPaginator(object):
+    """
+    Pagina la consulta queryset ordenada por el campo order (con '-'
+    delante si es descendente, puede ser de un modelo relacionado como
+    'stats__avg_mark' y no puede ser nulo) y despues por id, con
+    per_page elementos por pagina
+    """
+    def __init__(self, queryset, order, per_page=10):
+        self.queryset = queryset
+        self.descending = order.startswith('-')
+        self.field_name = order.lstrip('-')
+        self.field = self.get_field(queryset.model, self.field_name)
+        self.per_page = per_page
+
+    def get_field(self, model, lookup):
+        """Devuelve el campo de model al que se refiere lookup"""
+        names = lookup.split('__')
+        for name in names[:-1]:
+            field, field_model, direct, m2m = model._meta.get_field_by_name(
+                                                                        name)
+            #Relaciones inversas (como stats de Subject) son RelatedObject
+            model = field.rel.to if direct else field.model
+        return model._meta.get_field(names[-1])
+
+    def get_value(self, obj):
+        """Devuelve el valor del campo de ordenacion del objeto obj"""
+        for name in self.field_name.split('__'):
+            obj = getattr(obj, name)
+        return obj
+
+    def encode(self, obj):
+        """Devuelve el cursor (str apto para URLs) del objeto obj"""
+        value = self.get_value(obj)
+        if isinstance(value, (datetime.date, datetime.datetime)):
+            value = value.isoformat()
+        data = json.dumps([value, obj.id], separators=(',', ':'))
+        return base64.urlsafe_b64encode(data).rstrip('=')
+
+    def decode(self, cursor):
+        """
+        Devuelve el (valor, id) guardado en el cursor cursor o lanza
+        InvalidCursor si no es valido
+        """
+        try:
+            cursor = str(cursor)
+            data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            value, idobj = json.loads(data)
+            return self.field.to_python(value), int(idobj)
+        except Exception:
+            raise InvalidCursor(cursor)
+
+    def after(self, cursor):
+        """
+        Devuelve la consulta ordenada de los elementos que van despues
+        del cursor cursor
+        """
+        value, idobj = self.decode(cursor)
+        lt = '__lt' if self.descending else '__gt'
+        lte = '__lte' if self.descending else '__gte'
+        #La condicion sobre el campo solo sirve para que la consulta pueda
+        #empezar directamente en el valor del cursor recorriendo el indice
+        return self.order(self.queryset.filter(**{self.field_name + lte:
+                                                  value}).filter(
+                        Q(**{self.field_name + lt: value}) |
+                        Q(**{self.field_name: value, 'id' + lt: idobj})))
+
+    def before(self, cursor):
+        """
+        Devuelve la consulta, ordenada al reves, de los elementos que van
+        antes del cursor cursor
+        """
+        value, idobj = self.decode(cursor)
+        gt = '__gt' if self.descending else '__lt'
+        gte = '__gte' if self.descending else '__lte'
+        return self.order(self.queryset.filter(**{self.field_name + gte:
+                                                  value}).filter(
+                        Q(**{self.field_name + gt: value}) |
+                        Q(**{self.field_name: value, 'id' + gt: idobj})),
+                          reverse=True)
+
+    def order(self, queryset, reverse=False):
+        """Ordena queryset por el campo y el id (al reves si reverse)"""
+        desc = '-' if self.descending != reverse else ''
+        return queryset.order_by(desc + self.field_name, desc + 'id')
+
+    def page(self, cursor=None, before=False):
+        """
+        Devuelve la CursorPage con los elementos que van despues del
+        cursor cursor (o antes si before), o la primera pagina si no se
+        indica cursor
+        """
+        if cursor is None:
+            objects = list(self.order(self.queryset)[:self.per_page + 1])
+        elif before:
+            objects = list(self.before(cursor)[:self.per_page + 1])
+        else:
+            objects = list(self.after(cursor)[:self.per_page + 1])
+        more = len(objects) > self.per_page
+        objects = objects[:self.per_page]
+        if before:
+            objects.reverse()
+            return CursorPage(objects, self, has_previous=more,
+                              has_next=True)
+        return CursorPage(objects, self, has_previous=cursor is not None,
+                          has_next=more)
+
+
+class CursorPage(object):
+    """
+    Pagina de una CursorPaginator. Se usa en las plantillas como un Page
+    de Django (has_next, next_page_number...), pero los 'numeros de
+    pagina' son cursores: el del ultimo elemento con 'a' delante para la
+    siguiente y el del primero con 'b' delante para la anterior (ver
+    page_from_token)
+    """
+    def __init__(self, object_list, paginator, has_previous, has_next):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_previous = has_previous and bool(object_list)
+        self._has_next = has_next and bool(object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_next(self):
+        return self._has_next
+
+    def has_other_pages(self):
+        return self._has_previous or self._has_next
+
+    def first_cursor(self):
+        """Cursor del primer elemento ('' si no hay ninguno)"""
+        if not self.object_list:
+            return ''
+        return self.paginator.encode(self.object_list[0])
+
+    def last_cursor(self):
+        """Cursor del ultimo elemento ('' si no hay ninguno)"""
+        if not self.object_list:
+            return ''
+        return self.paginator.encode(self.object_list[-1])
+
+    def previous_page_number(self):
+        return 'b' + self.first_cursor()
+
+    def next_page_number(self):
+        return 'a' + self.last_cursor()
+
+
+def cursor_for(obj, order):
+    """Devuelve el cursor de obj en una lista ordenada por order"""
+    return CursorPaginator(type(obj)._default_manager.all(),
+                           order).encode(obj)
+
+def page_from_token(paginator, token):
+    """
+    Devuelve la pagina de paginator indicada por token (un
+    next_page_number o previous_page_number de otra pagina), o la
+    primera si token no es valido
+    """
+    if token:
+        token = force_text(token)
+        try:
+            return paginator.page(token[1:], before=token[0] == 'b')
+        except InvalidCursor:
+            pass
+    return paginator.page()
@@ -0,0 +1,188 @@
+# -*- encoding: utf-8 -*-
+"""
+Calculo incremental de la asistencia semanal (AttendanceFact)
+
+rollup_attendance solo recalcula las semanas de las clases marcadas con
+Lesson.attendance_dirty (al cambiar sus CheckIns, en la misma
+actualizacion que los contadores de la clase) y las apuntadas en
+AttendanceChange al modificar o borrar clases y al cambiar las
+matriculas. Cada semana se recalcula desde cero, asi que procesar dos
+veces el mismo cambio no altera el resultado
+El comando rollup_attendance lo ejecuta periodicamente (cron) para todas
+las asignaturas, y las paginas que leen la asistencia de una asignatura
+aplican antes solo los cambios pendientes de esa asignatura, de forma
+que siempre muestran la asistencia actual
+Los resumenes por clase y por asignatura siguen siendo los contadores de
+Lesson y SubjectStats
+"""
+from django.db import transaction
+from django.db.models import Sum, Q
+from django.utils import timezone
+from models import (Lesson, CheckIn, UserProfile, AttendanceFact,
+                    AttendanceChange, AttendanceRollup, lesson_week)
+import datetime
+import pytz
+
+#Valores de cada consulta __in (SQLite admite como mucho 999 parametros)
+IN_QUERY_SIZE = 500
+
+
+def week_range(year, week):
+    """
+    Devuelve el inicio y el fin (datetimes con la timezone actual) de la
+    semana ISO week del año year
+    """
+    jan4 = datetime.date(year, 1, 4)
+    monday = jan4 + datetime.timedelta(days=1 - jan4.isoweekday(),
+                                       weeks=week - 1)
+    current_tz = pytz.timezone(str(timezone.get_current_timezone()))
+    start = current_tz.localize(datetime.datetime.combine(monday,
+                                                          datetime.time.min))
+    end = current_tz.localize(datetime.datetime.combine(
+                    monday + datetime.timedelta(days=7), datetime.time.min))
+    return start, end
+
+
+def weeks_filter(weeks, prefix=''):
+    """
+    Devuelve un Q con las clases que empiezan en alguna de las semanas
+    weeks (pares (año, semana)). prefix es el camino hasta la clase
+    """
+    query = Q()
+    for year, week in weeks:
+        start, end = week_range(year, week)
+        query |= Q(**{prefix + 'start_time__gte': start,
+                      prefix + 'start_time__lt': end})
+    return query
+
+
+def rebuild_facts(idsubj, weeks=None):
+    """
+    Recalcula la asistencia de los alumnos de la asignatura idsubj en
+    las semanas weeks (conjunto de (año, semana)), o en todas si es None
+    """
+    lessons = Lesson.objects.filter(subject=idsubj, done=True)
+    checkins = CheckIn.objects.filter(lesson__subject=idsubj,
+                                      lesson__done=True,
+                                      user__userprofile__is_student=True)
+    facts = AttendanceFact.objects.filter(subject=idsubj)
+    if weeks is not None:
+        lessons = lessons.filter(weeks_filter(weeks))
+        checkins = checkins.filter(weeks_filter(weeks, 'lesson__'))
+        week_query = Q()
+        for year, week in weeks:
+            week_query |= Q(year=year, week=week)
+        facts = facts.filter(week_query)
+
+    lessons_week = {}
+    lesson_weeks = {}
+    for idlesson, start_time in lessons.values_list('id', 'start_time'):
+        key = lesson_week(start_time)
+        lesson_weeks[idlesson] = key
+        lessons_week[key] = lessons_week.get(key, 0) + 1
+    #[asistidas, suma de puntuaciones, numero de puntuaciones]
+    attendance = {}
+    for idlesson, iduser, mark in checkins.values_list('lesson', 'user',
+                                                       'mark'):
+        counts = attendance.setdefault((iduser, lesson_weeks[idlesson]),
+                                       [0, 0, 0])
+        counts[0] += 1
+        if mark is not None:
+            counts[1] += mark
+            counts[2] += 1
+    students = UserProfile.objects.filter(subjects=idsubj, is_student=True
+                                         ).values_list('user', flat=True)
+    new_facts = []
+    for iduser in students:
+        for (year, week), n_lessons in lessons_week.items():
+            attended, mark_sum, mark_count = attendance.get(
+                                    (iduser, (year, week)), (0, 0, 0))
+            new_facts.append(AttendanceFact(user_id=iduser, subject_id=idsubj,
+                                            year=year, week=week,
+                                            lessons=n_lessons,
+                                            attended=attended,
+                                            mark_sum=mark_sum,
+                                            mark_count=mark_count))
+    facts.delete()
+    AttendanceFact.objects.bulk_create(new_facts)
+    return len(new_facts)
+
+
+def rollup_attendance(rebuild=False, subjects=None):
+    """
+    Recalcula la asistencia semanal de las clases marcadas con
+    attendance_dirty y de los cambios pendientes (toda si rebuild) de
+    las asignaturas con ids subjects, o de todas si es None. Devuelve el
+    numero de asignaturas recalculadas
+    """
+    lessons = Lesson.objects.filter(attendance_dirty=True)
+    changes = AttendanceChange.objects.all()
+    if subjects is not None:
+        lessons = lessons.filter(subject__in=subjects)
+        changes = changes.filter(subject__in=subjects)
+    dirty = list(lessons.values_list('id', 'subject', 'start_time'))
+    changes = list(changes.values_list('id', 'subject', 'year', 'week'))
+    if not dirty and not changes and not rebuild:
+        return 0
+
+    #Semanas que cambian de cada asignatura (None si cambian todas)
+    changed = {}
+    if rebuild:
+        all_lessons = Lesson.objects.all()
+        if subjects is not None:
+            all_lessons = all_lessons.filter(subject__in=subjects)
+        for idsubj in all_lessons.values_list('subject',
+                                              flat=True).distinct():
+            changed[idsubj] = None
+    for idlesson, idsubj, start_time in dirty:
+        if changed.get(idsubj, set()) is not None:
+            changed.setdefault(idsubj, set()).add(lesson_week(start_time))
+    for idchange, idsubj, year, week in changes:
+        if year is None:
+            changed[idsubj] = None
+        elif changed.get(idsubj, set()) is not None:
+            changed.setdefault(idsubj, set()).add((year, week))
+
+    with transaction.commit_on_success():
+        #Se limpian las marcas antes de leer los CheckIns, para no perder
+        #los que lleguen mientras tanto
+        ids = [idlesson for idlesson, idsubj, start_time in dirty]
+        for i in range(0, len(ids), IN_QUERY_SIZE):
+            Lesson.objects.filter(id__in=ids[i:i + IN_QUERY_SIZE]
+                                 ).update(attendance_dirty=False)
+        ids = [idchange for idchange, idsubj, year, week in changes]
+        for i in range(0, len(ids), IN_QUERY_SIZE):
+            AttendanceChange.objects.filter(id__in=ids[i:i + IN_QUERY_SIZE]
+                                           ).delete()
+        if rebuild:
+            facts = AttendanceFact.objects.all()
+            if subjects is not None:
+                facts = facts.filter(subject__in=subjects)
+            facts.delete()
+        for idsubj, weeks in changed.items():
+            rebuild_facts(idsubj, weeks)
+        if subjects is None and not AttendanceRollup.objects.filter(
+                                    id=1).update(updated=timezone.now()):
+            AttendanceRollup.objects.create(id=1, updated=timezone.now())
+    return len(changed)
+
+
+def get_subject_attendance(idsubj, facts=Q()):
+    """
+    Devuelve el numero de clases realizadas de la asignatura idsubj y un
+    diccionario {id del usuario: clases asistidas} de sus alumnos, leidos
+    de la asistencia semanal filtrada por el Q facts (una consulta). Hay
+    que llamar antes a rollup_attendance(subjects=[idsubj]) para que este
+    al dia
+    """
+    n_lessons = 0
+    n_checkins = {}
+    for iduser, attended, lessons in AttendanceFact.objects.filter(facts,
+                                subject=idsubj).order_by().values('user'
+                                ).annotate(n=Sum('attended'),
+                                           l=Sum('lessons')
+                                ).values_list('user', 'n', 'l'):
+        n_checkins[iduser] = attended
+        #Todos los alumnos tienen las mismas clases de cada semana
+        n_lessons = max(n_lessons, lessons)
+    return n_lessons, n_checkins
@@ -1,16 +1,1096 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client, RequestFactory
+from django.core import mail
+from django.core.cache import get_cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.mail.backends.base import BaseEmailBackend
+from django.core.management import call_command
+from django.test.utils import override_settings
+from StringIO import StringIO
+from django.contrib.auth.models import User
+from django.utils import timezone
+from django.core.exceptions import ValidationError
+from django.db import connection, DatabaseError
+from django.db.models.signals import pre_save
+from models import (Degree, Subject, Building, Room, UserProfile, Lesson,
+                    Timetable, CheckIn, OutboxEmail, ImportJob, ForumComment,
+                    AdminTask, AttendanceFact, AttendanceChange,
+                    get_first_lesson_date, get_free_rooms,
+                    get_active_lessons, update_lesson_counters, SubjectStats,
+                    refresh_subject_stats, subjects_stale_stats,
+                    active_lessons_key, get_time_slice)
+import models
+from occupancy import IntervalIndex, LessonOccupancy
+from checkin_buffer import CheckInBuffer
+from pagination import CursorPaginator, cursor_for
+from metrics import registry
+from rollup import rollup_attendance
+from views import subject_page
+from exports import date_range_filter
+from benchmark import create_dataset, create_activity, BENCHMARK_PASSWORD
+from admin_csv import (import_users, enroll_dnis, iter_upload_lines,
+                       read_csv_upload)
+import datetime
+import random
+import json
+import tempfile
+import fcntl
+import os
+import smtplib
+import threading
+import Queue
 
-Replace this with more appropriate tests for your application.
-"""
 
-from django.test import TestCase
+def create_profile(username, is_student=True):
+    """Crea un usuario con perfil y lo devuelve"""
+    user = User.objects.create(username=username, first_name=username,
+                               last_name=username)
+    return UserProfile.objects.create(user=user, dni=username, age=20,
+                                      is_student=is_student)
 
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
+class LessonCountersTest(TestCase):
+    def setUp(self):
+        today = datetime.date.today()
+        self.teacher = create_profile('teacher', is_student=False)
+        self.subject = Subject.objects.create(name='subject',
+                                    first_date=today, last_date=today,
+                                    creator=self.teacher.user)
+        building = Building.objects.create(building='1')
+        room = Room.objects.create(room='1', building=building, radius=10,
+                                   centre_longitude=0, centre_latitude=0)
+        now = timezone.now()
+        self.lesson = Lesson.objects.create(subject=self.subject, room=room,
+                                start_time=now - datetime.timedelta(hours=1),
+                                end_time=now + datetime.timedelta(hours=1))
+        self.students = [create_profile('student%i' % i) for i in range(4)]
+        for profile in self.students + [self.teacher]:
+            profile.subjects.add(self.subject)
+
+    def get_lesson(self):
+        return Lesson.objects.get(id=self.lesson.id)
+
+    def test_enrollment(self):
+        """Solo cuentan los alumnos, y se actualiza desde ambos lados"""
+        self.assertEqual(self.get_lesson().subject_students, 4)
+        self.subject.userprofile_set.remove(self.students[0])
+        self.assertEqual(self.get_lesson().subject_students, 3)
+        self.students[1].subjects.clear()
+        self.assertEqual(self.get_lesson().subject_students, 2)
+
+    def test_profile_changes(self):
+        """
+        Los alumnos se recuentan al borrar un perfil o su usuario y al
+        cambiar un perfil de alumno a profesor o al reves
+        """
+        def counters():
+            lesson = self.get_lesson()
+            return (lesson.subject_students, lesson.stud_checkins,
+                    Subject.objects.get(id=self.subject.id).seats_taken)
+        CheckIn.objects.create(user=self.students[0].user, lesson=self.lesson,
+                               mark=2, codeword='x')
+        self.assertEqual(counters(), (4, 1, 4))
+        self.students[0].is_student = False
+        self.students[0].save()
+        self.assertEqual(counters(), (3, 0, 3))
+        self.students[0].is_student = True
+        self.students[0].save()
+        self.assertEqual(counters(), (4, 1, 4))
+        self.students[1].delete()
+        self.assertEqual(counters(), (3, 1, 3))
+        self.students[0].user.delete()
+        self.assertEqual(counters(), (2, 0, 2))
+        self.teacher.delete()
+        self.assertEqual(counters(), (2, 0, 2))
+
+    def test_checkins(self):
+        """Los contadores siguen a los CheckIns creados y borrados"""
+        for profile, mark in zip(self.students, (1, 2, 4)):
+            CheckIn.objects.create(user=profile.user, lesson=self.lesson,
+                                   mark=mark, codeword='x')
+        CheckIn.objects.create(user=self.teacher.user, lesson=self.lesson,
+                               mark=0, codeword='x')
+        lesson = self.get_lesson()
+        self.assertTrue(lesson.done)
+        self.assertEqual(lesson.n_stud_checkin(), 3)
+        self.assertEqual(lesson.checkin_percent(), 75)
+        self.assertEqual(lesson.avg_mark(), round(7/3.0, 2))
+        CheckIn.objects.get(user=self.students[0].user).delete()
+        lesson = self.get_lesson()
+        self.assertEqual(lesson.checkin_percent(), 50)
+        self.assertEqual(lesson.avg_mark(), 3)
+        #Un guardado completo de la clase no pisa los contadores
+        self.lesson.save()
+        self.assertEqual(self.get_lesson().n_stud_checkin(), 2)
+
+    def test_rebuild_counters(self):
+        """Recalcular los contadores da lo mismo que las senales"""
+        for profile, mark in zip(self.students, (0, 2, 4)):
+            CheckIn.objects.create(user=profile.user, lesson=self.lesson,
+                                   mark=mark, codeword='x')
+        lesson = self.get_lesson()
+        counters = (lesson.stud_checkins, lesson.mark_sum, lesson.mark_count)
+        self.assertEqual(counters, (3, 6, 3))
+        update_lesson_counters(Lesson.objects.filter(id=self.lesson.id))
+        lesson = self.get_lesson()
+        self.assertEqual((lesson.stud_checkins, lesson.mark_sum,
+                          lesson.mark_count), counters)
+
+    def test_subject_stats(self):
+        """Las estadisticas de la asignatura se recalculan al cambiar"""
+        self.assertEqual(self.subject.percent_stud_attend(), 100)
+        CheckIn.objects.create(user=self.teacher.user, lesson=self.lesson,
+                               mark=0, codeword='x')
+        CheckIn.objects.create(user=self.students[0].user, lesson=self.lesson,
+                               mark=5, codeword='x')
+        subject = Subject.objects.get(id=self.subject.id)
+        self.assertEqual(subject.percent_stud_attend(), 25)
+        self.assertEqual(subject.avg_mark(), 5)
+        self.assertEqual(subject.stats.lessons_done, 1)
+        self.subject.userprofile_set.remove(self.students[1])
+        subject = Subject.objects.get(id=self.subject.id)
+        self.assertEqual(round(subject.percent_stud_attend()), 33)
+
+    def test_subject_stats_created_concurrently(self):
+        """Si otra peticion crea las estadisticas a la vez se actualizan"""
+        SubjectStats.objects.filter(subject=self.subject).delete()
+        CheckIn.objects.create(user=self.teacher.user, lesson=self.lesson,
+                               mark=0, codeword='x')
+        def create_first(sender, instance, **kwargs):
+            #Simula la otra peticion justo antes de crearlas
+            pre_save.disconnect(create_first, sender=SubjectStats)
+            SubjectStats.objects.create(subject=self.subject, dirty=False)
+        pre_save.connect(create_first, sender=SubjectStats)
+        try:
+            self.assertEqual(refresh_subject_stats(Subject.objects.filter(
+                                                    id=self.subject.id)), 1)
+        finally:
+            pre_save.disconnect(create_first, sender=SubjectStats)
+        stats = SubjectStats.objects.get(subject=self.subject)
+        self.assertEqual(stats.lessons_done, 1)
+        self.assertFalse(stats.dirty)
+
+    def test_control_attendance_stats(self):
+        """
+        La pagina de control recalcula las estadisticas de las asignaturas
+        que muestra y el comando refresh_stats las de todas
+        """
+        today = datetime.date.today()
+        other = Subject.objects.create(name='other', first_date=today,
+                                       last_date=today,
+                                       creator=self.teacher.user)
+        refresh_subject_stats(Subject.objects.all())
+        CheckIn.objects.create(user=self.teacher.user, lesson=self.lesson,
+                               mark=0, codeword='x')
+        other.userprofile_set.add(self.students[0])
+        User.objects.create_superuser('staff', 's@example.com', 'x')
+        client = Client()
+        client.login(username='staff', password='x')
+        resp = client.get('/control/attendance', {'subject': 'subject',
+                                                    'order': 'name'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(list(subjects_stale_stats()), [other])
+        self.assertEqual(SubjectStats.objects.get(subject=self.subject
+                                                 ).lessons_done, 1)
+        out = StringIO()
+        call_command('refresh_stats', stdout=out)
+        self.assertIn('recalculadas: 1', out.getvalue())
+        self.assertEqual(SubjectStats.objects.get(subject=other).n_students, 1)
+        self.assertFalse(subjects_stale_stats().exists())
+
+    def test_active_lessons_cache(self):
+        """
+        Al cambiar una clase de asignatura se invalidan las dos caches,
+        y con una cache local a cada proceso no se cachean
+        """
+        other = Subject.objects.create(name='other',
+                                       first_date=self.subject.first_date,
+                                       last_date=self.subject.last_date,
+                                       creator=self.teacher.user)
+        key = active_lessons_key(self.subject.id,
+                                 get_time_slice(timezone.now()))
+        def check_active_lessons():
+            self.lesson.subject = self.subject
+            self.lesson.save()
+            self.assertEqual([lesson.id for lesson in
+                              get_active_lessons(self.subject.id)],
+                             [self.lesson.id])
+            self.assertEqual(get_active_lessons(other.id), [])
+            self.lesson.subject = other
+            self.lesson.save()
+            self.assertEqual(get_active_lessons(self.subject.id), [])
+            self.assertEqual([lesson.id for lesson in
+                              get_active_lessons(other.id)], [self.lesson.id])
+        self.assertTrue(models.shared_cache() is None)
+        check_active_lessons()
+        self.assertEqual(models.cache.get(key), None)
+        #Una cache en ficheros si la comparten todos los procesos
+        local_cache = models.cache
+        cache_dir = tempfile.mkdtemp()
+        models.cache = get_cache(
+                    'django.core.cache.backends.filebased.FileBasedCache',
+                    LOCATION=cache_dir)
+        try:
+            check_active_lessons()
+            self.assertEqual(models.cache.get(key), [])
+        finally:
+            #Borra tambien el directorio
+            models.cache.clear()
+            models.cache = local_cache
+
+    def test_statistics_data(self):
+        """La asistencia de la grafica coincide con la de la asignatura"""
+        CheckIn.objects.create(user=self.teacher.user, lesson=self.lesson,
+                               mark=0, codeword='x')
+        CheckIn.objects.create(user=self.students[0].user, lesson=self.lesson,
+                               mark=5, codeword='x')
+        self.subject.userprofile_set.remove(self.students[1])
+        self.teacher.user.set_password('x')
+        self.teacher.user.save()
+        client = Client()
+        client.login(username='teacher', password='x')
+        data = json.loads(client.get('/subjects/%i/statistics/data' %
+                                     self.subject.id).content)
+        subject = Subject.objects.get(id=self.subject.id)
+        self.assertEqual(data['percent_stud'], subject.percent_stud_attend())
+        self.assertEqual(data['percent_stud'], round(100/3.0, 2))
+        self.assertEqual(data['attendance'], [round(100/3.0, 2)])
+
+    def test_checkin_view(self):
+        """El check in desde /checkin responde lo mismo y actualiza la clase"""
+        def checkin(profile, **data):
+            profile.user.set_password('x')
+            profile.user.save()
+            client = Client()
+            client.login(username=profile.user.username, password='x')
+            data.update({'subject': self.subject.id, 'mark': 4})
+            return json.loads(client.post('/checkin', data,
+                            HTTP_X_REQUESTED_WITH='XMLHttpRequest').content)
+        codeword = self.lesson.codeword
+        self.assertTrue(checkin(self.students[0], codeword=codeword)['ok'])
+        resp = checkin(self.students[0], codeword=codeword)
+        self.assertEqual(resp['msg'],
+                         'Ya has realizado el checkin de esta clase')
+        self.assertIn('__all__', checkin(self.students[1],
+                                         codeword='x')['errors'])
+        self.assertTrue(checkin(self.teacher, codeword=codeword,
+                                n_students=3)['ok'])
+        lesson = self.get_lesson()
+        self.assertTrue(lesson.done)
+        self.assertEqual(lesson.students_counted, 3)
+        self.assertEqual(lesson.n_stud_checkin(), 1)
+        self.lesson.delete()
+        resp = checkin(self.students[1], codeword=codeword)
+        self.assertFalse(resp['ok'])
+        self.assertIn('Ahora no hay ninguna clase', resp['msg'])
+
+    def test_checkin_buffer_replay(self):
         """
-        Tests that 1 + 1 always equals 2.
+        Los check ins que quedaron en los diarios de procesos terminados
+        se guardan al arrancar, pero no los de procesos vivos
         """
-        self.assertEqual(1 + 1, 2)
+        journal = tempfile.mktemp()
+        def write_journal(name, entries):
+            with open(name, 'w') as f:
+                for profile, is_student, n_students in entries:
+                    f.write(json.dumps({'user': profile.user.id,
+                        'lesson': self.lesson.id, 'subject': self.subject.id,
+                        'mark': 2, 'comment': '', 'longitude': None,
+                        'latitude': None, 'codeword': self.lesson.codeword,
+                        'time': timezone.now().isoformat(),
+                        'is_student': is_student,
+                        'n_students': n_students}) + '\n')
+        #Diario de un proceso terminado y de otro vivo (con el bloqueo)
+        write_journal(journal + '.1', [(self.students[0], True, None),
+                                       (self.students[0], True, None),
+                                       (self.teacher, False, 3)])
+        open(journal + '.1.lock', 'w').close()
+        write_journal(journal + '.2', [(self.students[1], True, None)])
+        alive = open(journal + '.2.lock', 'w')
+        fcntl.flock(alive, fcntl.LOCK_EX)
+        buffer = CheckInBuffer(journal=journal)
+        self.assertRaises(RuntimeError, CheckInBuffer, journal=journal)
+        buffer.close()
+        self.assertFalse(os.path.exists(journal + '.1'))
+        self.assertFalse(os.path.exists(buffer.journal_name))
+        self.assertTrue(os.path.exists(journal + '.2'))
+        lesson = self.get_lesson()
+        self.assertEqual(CheckIn.objects.filter(lesson=lesson).count(), 2)
+        self.assertEqual(lesson.n_stud_checkin(), 1)
+        self.assertEqual(lesson.avg_mark(), 2)
+        self.assertTrue(lesson.done)
+        self.assertEqual(lesson.students_counted, 3)
+        alive.close()
+        CheckInBuffer(journal=journal).close()
+        self.assertFalse(os.path.exists(journal + '.2'))
+        self.assertEqual(self.get_lesson().n_stud_checkin(), 2)
+        os.remove(journal + '.lock')
+
+
+    def test_checkin_buffer_prune_and_retry(self):
+        """
+        El buffer olvida las clases terminadas y guarda mas tarde los
+        lotes que fallaron
+        """
+        journal = tempfile.mktemp()
+        buffer = CheckInBuffer(journal=journal, interval=0.0001,
+                               failed_interval=0)
+        #Sin hilo escritor: los lotes se guardan al llamar a flush
+        buffer.running = True
+        now = timezone.now()
+        ended = Lesson.objects.create(subject=self.subject,
+                                room=self.lesson.room,
+                                start_time=now - datetime.timedelta(hours=3),
+                                end_time=now - datetime.timedelta(hours=2))
+        def submit(profile, lesson):
+            return buffer.submit(CheckIn(user=profile.user, lesson=lesson,
+                                         mark=2, codeword=lesson.codeword,
+                                         time=timezone.now()), True)
+        self.assertTrue(submit(self.students[0], self.lesson))
+        self.assertTrue(submit(self.students[0], ended))
+        self.assertFalse(submit(self.students[0], ended))
+        buffer.flush()
+        self.assertEqual(buffer.seen.keys(), [self.lesson.id])
+        self.assertFalse(submit(self.students[0], ended))
+
+        def write(entries):
+            raise DatabaseError('database is locked')
+        buffer.write = write
+        self.assertTrue(submit(self.students[1], ended))
+        buffer.flush()
+        self.assertTrue(os.path.exists(buffer.journal_name + '.failed'))
+        self.assertIn(ended.id, buffer.seen)
+        del buffer.write
+        self.assertTrue(buffer.failed_due())
+        buffer.retry_failed()
+        self.assertFalse(os.path.exists(buffer.journal_name + '.failed'))
+        self.assertEqual(CheckIn.objects.filter(lesson=ended).count(), 2)
+        self.assertEqual(Lesson.objects.get(id=ended.id).n_stud_checkin(), 2)
+        buffer.running = False
+        buffer.close()
+        self.assertFalse(os.path.exists(buffer.journal_name))
+        os.remove(journal + '.lock')
+
+class OccupancyTest(TestCase):
+    def test_interval_index(self):
+        """El indice responde igual que comparar con todos los intervalos"""
+        rand = random.Random(0)
+        intervals = []
+        for i in range(200):
+            start = rand.randint(0, 1000)
+            intervals.append((start, start + rand.randint(1, 50), i))
+        index = IntervalIndex(intervals[:100])
+        for interval in intervals[100:]:
+            index.add(*interval)
+        for i in range(0, 200, 3):
+            index.remove(i)
+        intervals = [t for t in intervals if t[2] % 3 != 0]
+        for i in range(500):
+            start = rand.randint(0, 1000)
+            end = start + rand.randint(1, 50)
+            self.assertEqual(index.is_busy(start, end),
+                             any(s < end and e > start
+                                 for s, e, v in intervals))
+            self.assertEqual(index.is_busy(start, end, inclusive=True),
+                             any(s <= end and e >= start
+                                 for s, e, v in intervals))
+            self.assertEqual(sorted(v for s, e, v in index.overlapping(start,
+                                                                       end)),
+                             sorted(v for s, e, v in intervals
+                                    if s < end and e > start))
+
+    def test_lesson_clean(self):
+        """Lesson.clean detecta solapamientos con las clases guardadas"""
+        teacher = create_profile('teacher', is_student=False)
+        today = datetime.date.today()
+        subject = Subject.objects.create(name='subject', first_date=today,
+                                         last_date=today, creator=teacher.user)
+        building = Building.objects.create(building='1')
+        room = Room.objects.create(room='1', building=building, radius=10,
+                                   centre_longitude=0, centre_latitude=0)
+        start = timezone.now() + datetime.timedelta(days=1)
+        start = start.replace(hour=10, minute=0, second=0, microsecond=0)
+        end = start + datetime.timedelta(hours=2)
+        lesson = Lesson.objects.create(subject=subject, room=room,
+                                       start_time=start, end_time=end)
+        self.assertTrue(LessonOccupancy(start, end).room_busy(room.id, start,
+                                                              end))
+        lesson.clean()
+        self.assertRaises(ValidationError, Lesson(subject=subject, room=room,
+                            start_time=start + datetime.timedelta(hours=1),
+                            end_time=end + datetime.timedelta(hours=1)).clean)
+        Lesson(subject=subject, room=room, start_time=end,
+               end_time=end + datetime.timedelta(hours=1)).clean()
+        lesson.delete()
+        self.assertFalse(LessonOccupancy(start, end).room_busy(room.id, start,
+                                                               end))
+
+
+    def test_free_rooms(self):
+        """Aulas libres de varios edificios, con y sin el indice"""
+        teacher = create_profile('teacher', is_student=False)
+        today = datetime.date.today()
+        subject = Subject.objects.create(name='subject', first_date=today,
+                                         last_date=today, creator=teacher.user)
+        buildings = [Building.objects.create(building=str(i))
+                     for i in range(3)]
+        rooms = [Room.objects.create(room='%i.%i' % (i, j), building=building,
+                                     radius=10, centre_longitude=0,
+                                     centre_latitude=0)
+                 for i, building in enumerate(buildings) for j in range(2)]
+        start = timezone.now() + datetime.timedelta(days=1)
+        start = start.replace(hour=10, minute=0, second=0, microsecond=0)
+        end = start + datetime.timedelta(hours=2)
+        hour = datetime.timedelta(hours=1)
+        #Solapada, terminando justo al empezar, lejana y en otro edificio
+        for room, lesson_start, lesson_end in (
+                (rooms[0], start + hour, end + hour),
+                (rooms[1], start - hour, start),
+                (rooms[2], end + hour, end + 2*hour),
+                (rooms[4], start - hour, end + hour)):
+            Lesson.objects.create(subject=subject, room=room,
+                                  start_time=lesson_start, end_time=lesson_end)
+        def ids(rooms):
+            return sorted(room.id for room in rooms)
+        expected = [rooms[2], rooms[3]]
+        selected = buildings[:2]
+        self.assertEqual(ids(get_free_rooms(start, end, selected)),
+                         ids(expected))
+        occupancy = LessonOccupancy(start, end)
+        self.assertEqual(ids(get_free_rooms(start, end, selected, occupancy)),
+                         ids(expected))
+        self.assertEqual(ids(get_free_rooms(start, end, buildings)),
+                         ids(expected + [rooms[5]]))
+
+        teacher.user.set_password('x')
+        teacher.user.save()
+        client = Client()
+        client.login(username='teacher', password='x')
+        local_start = timezone.localtime(start)
+        local_end = timezone.localtime(end)
+        resp = json.loads(client.get('/freeroom', {
+                    'start_time_0': local_start.date().isoformat(),
+                    'start_time_1': local_start.strftime('%H:%M'),
+                    'end_time_0': local_end.date().isoformat(),
+                    'end_time_1': local_end.strftime('%H:%M'),
+                    'building': [building.id for building in buildings]},
+                    HTTP_X_REQUESTED_WITH='XMLHttpRequest').content)
+        self.assertTrue(resp['ok'])
+        self.assertEqual(sorted(resp['free_rooms']),
+                         sorted(str(room) for room in expected + [rooms[5]]))
+        self.assertIn(resp['free_room'], resp['free_rooms'])
+
+class TimetableLessonsTest(TestCase):
+    def test_semester_across_dst(self):
+        """Las clases de un horario respetan los cambios de hora"""
+        teacher = create_profile('teacher', is_student=False)
+        today = datetime.date.today()
+        subject = Subject.objects.create(name='subject', first_date=today,
+                                last_date=today + datetime.timedelta(days=400),
+                                creator=teacher.user)
+        other = Subject.objects.create(name='other', first_date=today,
+                                       last_date=subject.last_date,
+                                       creator=teacher.user)
+        for i in range(3):
+            create_profile('student%i' % i).subjects.add(subject)
+        subject.get_stats()
+        building = Building.objects.create(building='1')
+        room, room2 = [Room.objects.create(room=str(i), building=building,
+                                           radius=10, centre_longitude=0,
+                                           centre_latitude=0)
+                       for i in range(2)]
+        timetable = Timetable(subject=subject, day='0',
+                              start_time=datetime.time(10),
+                              end_time=datetime.time(12), room=room)
+        mondays = []
+        date = get_first_lesson_date(timetable)
+        while date <= subject.last_date:
+            mondays.append(date)
+            date += datetime.timedelta(days=7)
+        current_tz = timezone.get_current_timezone()
+        def local(date, hour):
+            return timezone.make_aware(datetime.datetime.combine(date,
+                                        datetime.time(hour)), current_tz)
+        #Aula ocupada el tercer lunes y clase de la asignatura el quinto
+        Lesson.objects.create(subject=other, room=room,
+                              start_time=local(mondays[2], 10),
+                              end_time=local(mondays[2], 11))
+        Lesson.objects.create(subject=subject, room=room2,
+                              start_time=local(mondays[4], 11),
+                              end_time=local(mondays[4], 13))
+        timetable.save()
+
+        lessons = list(Lesson.objects.filter(subject=subject,
+                                             room__in=[room, room2]
+                                            ).order_by('start_time'))
+        self.assertEqual(len(lessons), len(mondays))
+        created = [lesson for lesson in lessons
+                   if timezone.localtime(lesson.start_time).hour == 10]
+        self.assertEqual([timezone.localtime(lesson.start_time).date()
+                          for lesson in created],
+                         mondays[:4] + mondays[5:])
+        offsets = set()
+        for lesson in created:
+            start = timezone.localtime(lesson.start_time)
+            end = timezone.localtime(lesson.end_time)
+            self.assertEqual((start.time(), end.time()),
+                             (datetime.time(10), datetime.time(12)))
+            offsets.add(start.utcoffset())
+            self.assertEqual(lesson.subject_students, 3)
+            self.assertEqual(lesson.room_id,
+                             room2.id if start.date() == mondays[2]
+                             else room.id)
+        self.assertEqual(len(offsets), 2)
+        #bulk_create no envia las senales de Lesson
+        stats = Subject.objects.get(id=subject.id).get_stats()
+        self.assertEqual(stats.lessons, len(mondays))
+        self.assertEqual(stats.n_students, 3)
+        self.assertEqual(stats.next_lesson_end, lessons[0].end_time)
+
+
+class PaginationTest(TestCase):
+    def test_cursor_pages(self):
+        """Las paginas no repiten ni saltan comentarios con la misma hora"""
+        user = User.objects.create_user('user', 'u@example.com', 'x')
+        now = timezone.now()
+        for i in range(35):
+            ForumComment.objects.create(user=user, comment=str(i),
+                    date=now - datetime.timedelta(minutes=i // 4))
+        expected = list(ForumComment.objects.order_by('-date', '-id'))
+        paginator = CursorPaginator(ForumComment.objects.all(), '-date')
+        page = paginator.page()
+        seen = list(page)
+        while page.has_next():
+            with self.assertNumQueries(1):
+                page = paginator.page(page.last_cursor())
+            seen += list(page)
+        self.assertEqual(seen, expected)
+        #Hacia atras desde la ultima pagina
+        start = 30
+        while page.has_previous():
+            page = paginator.page(page.first_cursor(), before=True)
+            start -= 10
+            self.assertEqual(list(page), expected[start:start + 10])
+        self.assertEqual(start, 0)
+
+    def test_more_comments(self):
+        """more_comments devuelve los 10 mas cercanos al cursor"""
+        user = User.objects.create_user('user', 'u@example.com', 'x')
+        client = Client()
+        client.login(username='user', password='x')
+        now = timezone.now()
+        comments = [ForumComment.objects.create(user=user, comment=str(i),
+                                                date=now)
+                    for i in range(25)]
+        def more(cursor, newer):
+            return json.loads(client.get('/more/comments/%s/0/%s' % (cursor,
+                              newer), HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+                              ).content)
+        resp = more(cursor_for(comments[5], '-date'), 'false')
+        self.assertEqual(resp['cursor'], cursor_for(comments[0], '-date'))
+        resp = more(cursor_for(comments[5], '-date'), 'true')
+        self.assertEqual(resp['cursor'], cursor_for(comments[15], '-date'))
+        self.assertEqual(more('invalid', 'true')['cursor'], '')
+
+
+class QueryPlanTest(TestCase):
+    def test_query_plans(self):
+        """Ninguna consulta frecuente recorre una tabla entera"""
+        call_command('check_query_plans', stdout=StringIO())
+
+
+class MetricsTest(TestCase):
+    def test_metrics(self):
+        """Se cuentan las peticiones y consultas de cada vista"""
+        User.objects.create_superuser('admin', 'a@example.com', 'x')
+        with override_settings(METRICS=True):
+            registry.reset()
+            client = Client()
+            client.login(username='admin', password='x')
+            client.get('/forum')
+            resp = client.get('/metrics')
+        self.assertIn('urjcheckin_requests_total{view="forum"} 1\n',
+                      resp.content)
+        self.assertIn('urjcheckin_request_duration_seconds_bucket' \
+                      '{view="forum",le="+Inf"} 1\n', resp.content)
+        self.assertEqual(registry.views['forum'].requests, 1)
+        self.assertTrue(registry.views['forum'].queries > 0)
+        self.assertTrue(registry.views['forum'].template_time > 0)
+        #Desactivadas no se miden y el endpoint no existe
+        self.assertEqual(client.get('/metrics').status_code, 404)
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        create_dataset(n_buildings=1, rooms_per_building=3, n_subjects=4,
+                       n_students=20, subjects_per_student=2, weeks=4)
+        create_activity(forum_comments=0, reports=0)
+        rollup_attendance()
+        User.objects.create_superuser('staff', 's@example.com',
+                                      BENCHMARK_PASSWORD)
+        self.client = Client()
+        self.client.login(username='staff', password=BENCHMARK_PASSWORD)
+
+    def export(self, **params):
+        resp = self.client.get('/control/attendance/export', params)
+        self.assertTrue(resp.streaming)
+        lines = ''.join(resp.streaming_content).splitlines()
+        return [line.split(';') for line in lines[1:]]
+
+    def test_export_lessons(self):
+        """Una fila por alumno y clase realizada"""
+        expected = 0
+        for subject in Subject.objects.all():
+            expected += subject.lesson_set.filter(done=True).count() * \
+                        subject.userprofile_set.filter(is_student=True).count()
+        rows = self.export()
+        self.assertEqual(len(rows), expected)
+        self.assertEqual(len([row for row in rows if row[6] == 'Si']),
+                         CheckIn.objects.filter(lesson__done=True,
+                                user__userprofile__is_student=True).count())
+        subject = Subject.objects.order_by('id')[0]
+        self.assertEqual(len(self.export(subject=subject.id)),
+                         subject.lesson_set.filter(done=True).count() *
+                         subject.userprofile_set.filter(is_student=True
+                                                       ).count())
+        today = datetime.date.today()
+        self.assertEqual(self.export(start_date=today + datetime.timedelta(
+                                                                    days=1)), [])
+
+    def test_export_subjects(self):
+        """El resumen coincide con la pagina de asistencia"""
+        from views import get_students_attendance
+        subject = Subject.objects.order_by('id')[1]
+        degree = subject.degrees.all()[0]
+        rows = self.export(rows='subjects', degree=degree.id)
+        self.assertEqual(len(rows), UserProfile.objects.filter(
+                                    is_student=True,
+                                    subjects__degrees=degree).count())
+        summary = dict((row[1], float(row[6])) for row in rows
+                       if row[0] == subject.name)
+        for student in get_students_attendance(subject):
+            self.assertEqual(summary[student['dni']], student['percent'])
+
+    def test_export_subjects_range(self):
+        """El resumen cubre exactamente las fechas pedidas"""
+        first_day = timezone.localtime(Lesson.objects.filter(done=True
+                                    ).order_by('start_time')[0].start_time
+                                      ).date()
+        #Desde un miercoles hasta el martes de dos semanas despues
+        start_date = first_day + datetime.timedelta(
+                                        days=(2 - first_day.weekday()) % 7)
+        end_date = start_date + datetime.timedelta(days=13)
+        params = {'start_date': start_date.isoformat(),
+                  'end_date': end_date.isoformat()}
+        attended = {}
+        for row in self.export(**params):
+            if row[6] == 'Si':
+                attended[(row[0], row[3])] = attended.get((row[0], row[3]),
+                                                          0) + 1
+        rows = self.export(rows='subjects', **params)
+        self.assertTrue(rows)
+        for row in rows:
+            self.assertEqual(int(row[5]), attended.get((row[0], row[1]), 0))
+        lessons = Lesson.objects.filter(done=True,
+                    **date_range_filter(start_date, end_date))
+        for name in set(row[0] for row in rows):
+            self.assertEqual(set(int(row[4]) for row in rows
+                                 if row[0] == name),
+                             set([lessons.filter(subject__name=name).count()]))
+
+    def test_export_permission(self):
+        """Sin el permiso can_see_statistics no se exporta nada"""
+        student = UserProfile.objects.filter(is_student=True)[0].user
+        student.set_password('x')
+        student.save()
+        self.client.login(username=student.username, password='x')
+        resp = self.client.get('/control/attendance/export')
+        self.assertFalse(resp.streaming)
+        self.assertIn('No tienes permisos', resp.content)
+
+
+class AttendanceRollupTest(TestCase):
+    def setUp(self):
+        create_dataset(n_buildings=1, rooms_per_building=3, n_subjects=4,
+                       n_students=20, subjects_per_student=2, weeks=4)
+        create_activity(forum_comments=0, reports=0)
+
+    def assertFactsMatch(self):
+        """La asistencia semanal coincide con los CheckIns"""
+        for subject in Subject.objects.all():
+            facts = AttendanceFact.objects.filter(subject=subject)
+            checkins = CheckIn.objects.filter(lesson__subject=subject,
+                                lesson__done=True,
+                                user__userprofile__is_student=True)
+            self.assertEqual(sum(fact.attended for fact in facts),
+                             checkins.count())
+            self.assertEqual(sum(fact.mark_sum for fact in facts),
+                             sum(checkin.mark for checkin in checkins))
+            n_students = subject.userprofile_set.filter(is_student=True
+                                                       ).count()
+            self.assertEqual(sum(fact.lessons for fact in facts),
+                             n_students * subject.lesson_set.filter(
+                                                        done=True).count())
+
+    def test_rollup(self):
+        """Solo se recalculan las asignaturas que cambian"""
+        self.assertEqual(rollup_attendance(), 4)
+        self.assertFactsMatch()
+        self.assertEqual(rollup_attendance(), 0)
+
+        #CheckIn nuevo en una clase pasada con el id del ultimo borrado,
+        #que SQLite reutiliza
+        checkin = CheckIn.objects.filter(user__userprofile__is_student=True,
+                                         lesson__done=True).order_by('-id')[0]
+        CheckIn.objects.filter(id__gt=checkin.id).delete()
+        rollup_attendance()
+        idcheckin, lesson, user = checkin.id, checkin.lesson, checkin.user
+        checkin.delete()
+        self.assertEqual(rollup_attendance(), 1)
+        self.assertFactsMatch()
+        new_checkin = CheckIn(user=user, lesson=lesson, mark=5,
+                              codeword=lesson.codeword)
+        new_checkin.save()
+        self.assertEqual(new_checkin.id, idcheckin)
+        self.assertEqual(rollup_attendance(), 1)
+        self.assertFactsMatch()
+
+        #Matricula nueva: se recalcula toda la asignatura
+        subject = lesson.subject
+        student = UserProfile.objects.filter(is_student=True).exclude(
+                                                subjects=subject)[0]
+        student.subjects.add(subject)
+        self.assertEqual(rollup_attendance(), 1)
+        self.assertFactsMatch()
+        self.assertEqual(AttendanceChange.objects.count(), 0)
+
+        AttendanceFact.objects.all().delete()
+        self.assertEqual(rollup_attendance(), 0)
+        self.assertEqual(rollup_attendance(rebuild=True), 4)
+        self.assertFactsMatch()
+
+    def test_read_after_checkin(self):
+        """La pagina de asistencia muestra los check ins sin esperar al cron"""
+        from views import get_students_attendance
+        subject = Subject.objects.order_by('id')[0]
+        #Sin ejecutar nunca rollup_attendance (recien instalado)
+        before = dict((student['id'], student['n_checkins'])
+                      for student in get_students_attendance(subject))
+        lesson = subject.lesson_set.filter(done=True)[0]
+        student = subject.userprofile_set.filter(is_student=True).exclude(
+                                    user__checkin__lesson=lesson)[0].user
+        self.assertEqual(before[student.id], CheckIn.objects.filter(
+                                lesson__subject=subject, lesson__done=True,
+                                user=student).count())
+        CheckIn.objects.create(user=student, lesson=lesson, mark=4,
+                               codeword=lesson.codeword)
+        self.assertEqual(AttendanceChange.objects.count(), 0)
+        after = dict((student['id'], student['n_checkins'])
+                     for student in get_students_attendance(subject))
+        self.assertEqual(after[student.id], before[student.id] + 1)
+
+
+class SeminarSignupTest(TransactionTestCase):
+    """
+    Apuntarse a la vez a un seminario no ocupa mas plazas de las que
+    hay (TransactionTestCase para que cada hilo use su conexion)
+    """
+    def test_concurrent_signups(self):
+        """Cientos de alumnos se apuntan a la vez a un seminario"""
+        create_dataset(n_subjects=1, n_students=300, subjects_per_student=0,
+                       weeks=1)
+        seminar = Subject.objects.create(name='Seminario', is_seminar=True,
+                        max_students=25,
+                        first_date=datetime.date.today() +
+                                   datetime.timedelta(days=7),
+                        last_date=datetime.date.today() +
+                                  datetime.timedelta(days=14),
+                        creator=User.objects.get(username='prof0'))
+        seminar.degrees.add(Degree.objects.all()[0])
+        users = Queue.Queue()
+        #Cada peticion apunta o desapunta, asi que cada alumno lo intenta
+        #una sola vez
+        students = list(User.objects.filter(userprofile__is_student=True))
+        for user in students:
+            users.put(user)
+        results = []
+
+        def signup():
+            factory = RequestFactory()
+            try:
+                while True:
+                    try:
+                        user = users.get_nowait()
+                    except Queue.Empty:
+                        return
+                    request = factory.post('/subjects/%i' % seminar.id,
+                                           HTTP_X_REQUESTED_WITH=
+                                                            'XMLHttpRequest')
+                    request.user = user
+                    try:
+                        resp = json.loads(subject_page(request,
+                                                       seminar.id).content)
+                        if 'error' in resp:
+                            results.append(resp['error'])
+                        else:
+                            results.append('signed' if resp['signed']
+                                           else 'unsigned')
+                    except Exception as e:
+                        results.append(str(e))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=signup) for i in range(30)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        seminar = Subject.objects.get(id=seminar.id)
+        n_students = seminar.n_students()
+        self.assertEqual(len(results), len(students))
+        self.assertEqual(results.count('signed'), 25)
+        self.assertEqual(results.count('No hay plazas disponibles'),
+                         len(students) - 25)
+        self.assertEqual(n_students, 25)
+        self.assertEqual(seminar.seats_taken, 25)
+
+
+class QueryBudgetTest(TestCase):
+    """
+    Numero maximo de consultas de cada vista con un semestre de datos, en
+    la primera peticion y en las siguientes, y de los check ins, para
+    detectar consultas repetidas por cada elemento (N+1)
+    """
+    def setUp(self):
+        create_dataset(n_buildings=3, rooms_per_building=5, n_subjects=30,
+                       n_students=300, subjects_per_student=4)
+        create_activity()
+        rollup_attendance()
+        User.objects.create_superuser('staff', 's@example.com',
+                                      BENCHMARK_PASSWORD)
+        self.use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+
+    def tearDown(self):
+        connection.use_debug_cursor = self.use_debug_cursor
+
+    def test_query_budgets(self):
+        """Ninguna vista supera su presupuesto de consultas"""
+        now = timezone.now()
+        subject = Subject.objects.order_by('id')[3]
+        teacher = subject.creator
+        student = subject.userprofile_set.filter(is_student=True
+                                                ).order_by('id')[0].user
+        staff = User.objects.get(username='staff')
+        reporter = AdminTask.objects.all()[0].user
+        past = subject.lesson_set.filter(end_time__lt=now
+                                        ).order_by('-start_time')[0]
+        future = subject.lesson_set.filter(start_time__gt=now
+                                          ).order_by('start_time')[0]
+        forum_cursor = cursor_for(ForumComment.objects.order_by('-date')[10],
+                                  '-date')
+        report_cursor = cursor_for(AdminTask.objects.order_by('-time')[10],
+                                   '-time')
+        #(vista, usuario, url, ajax, maximo de consultas de la primera
+        #peticion, que rellena las caches, y de la segunda)
+        views = [
+            ('home alumno', student, '/', False, 6, 6),
+            ('home profesor', teacher, '/', False, 6, 6),
+            ('home staff', staff, '/', False, 5, 5),
+            ('checkin', student, '/checkin', False, 4, 4),
+            ('subject alumno', student, '/subjects/%i' % subject.id, False,
+             24, 17),
+            ('subject profesor', teacher, '/subjects/%i' % subject.id, False,
+             16, 16),
+            ('subjects', student, '/subjects', False, 7, 7),
+            ('seminars', student, '/seminars', False, 4, 4),
+            ('lesson profesor', teacher, '/lesson/%i' % past.id, False, 13,
+             13),
+            ('lesson alumno', student, '/lesson/%i' % past.id, False, 12, 12),
+            ('lesson_attendance', teacher,
+             '/lesson/%i/attendance' % past.id, False, 9, 9),
+            ('subject_attendance', teacher,
+             '/subjects/%i/attendance' % subject.id, False, 11, 11),
+            ('subject_statistics', teacher,
+             '/subjects/%i/statistics' % subject.id, False, 6, 6),
+            ('subject_statistics_data', teacher,
+             '/subjects/%i/statistics/data' % subject.id, True, 5, 5),
+            ('profile', student, '/profile/view/%i' % student.id, False, 7,
+             7),
+            ('forum', student, '/forum', False, 4, 4),
+            ('reports', reporter, '/reports', False, 4, 4),
+            ('control_attendance', staff, '/control/attendance', False, 32,
+             8),
+            ('show_codes', staff, '/control/codes?day=%s' % now.date(),
+             False, 5, 5),
+            ('freeroom', student, '/freeroom', False, 4, 4),
+            ('more_comments foro', student,
+             '/more/comments/%s/0/false' % forum_cursor, True, 3, 3),
+            ('more_comments clase', teacher,
+             '/more/comments/0/%i/false' % past.id, True, 8, 8),
+            ('more_lessons pasadas', student, '/more/lessons/%s/false' %
+             cursor_for(past, '-start_time'), True, 8, 8),
+            ('more_lessons futuras', student, '/more/lessons/%s/true' %
+             cursor_for(future, 'end_time'), True, 8, 8),
+            ('more_reports', reporter,
+             '/more/reports/%s/false' % report_cursor, True, 3, 3),
+        ]
+        clients = {}
+        def get_client(user):
+            if user.id not in clients:
+                clients[user.id] = Client()
+                clients[user.id].login(username=user.username,
+                                       password=BENCHMARK_PASSWORD)
+            return clients[user.id]
+        over_budget = []
+        def measure(name, budget, request, *args, **kwargs):
+            connection.queries = []
+            resp = request(*args, **kwargs)
+            self.assertEqual(resp.status_code, 200, name)
+            if len(connection.queries) > budget:
+                over_budget.append('%s: %i consultas (maximo %i)' % (name,
+                                   len(connection.queries), budget))
+            return resp
+        for name, user, url, ajax, cold_budget, budget in views:
+            client = get_client(user)
+            extra = {'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest'} if ajax else {}
+            measure(name + ' (primera)', cold_budget, client.get, url,
+                    **extra)
+            measure(name, budget, client.get, url, **extra)
+
+        #Check ins de dos alumnos (el primero con las caches vacias) y del
+        #profesor en una clase que se esta impartiendo
+        lesson = Lesson.objects.create(subject=subject, room=past.room,
+                                start_time=now - datetime.timedelta(hours=1),
+                                end_time=now + datetime.timedelta(hours=1))
+        students = subject.userprofile_set.filter(is_student=True
+                                                 ).order_by('id')[1:3]
+        for name, user, data, budget in (
+                ('checkin POST alumno (primera)', students[0].user, {}, 7),
+                ('checkin POST alumno', students[1].user, {}, 7),
+                ('checkin POST profesor', teacher, {'n_students': 2}, 8)):
+            data.update({'subject': subject.id, 'mark': 4,
+                         'codeword': lesson.codeword})
+            resp = measure(name, budget, get_client(user).post, '/checkin',
+                           data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            self.assertTrue(json.loads(resp.content)['ok'], name)
+        self.assertFalse(over_budget, '\n'.join(over_budget))
+
+
+class ImportUsersTest(TestCase):
+    def test_import_users(self):
+        """Se crean los usuarios nuevos y se informa de las filas omitidas"""
+        Degree.objects.create(name='Informatica', code='GII')
+        create_profile('existing')
+        User.objects.create(username='jperez')
+        rows = [['Nombre', 'Apellidos', 'Email', 'DNI', 'Grados', 'Alumno'],
+                ['Juan', 'Perez Lopez', 'juan@example.com', '1', 'GII XX',
+                 'Si'],
+                ['Jose', 'P\xc3\xa9rez', 'no es un email', '2', '', 'No'],
+                ['Otro', 'Perez', '', 'existing', '', 'Si'],
+                ['Juan', 'Perez', '', '1', '', 'Si'],
+                ['Incompleta']]
+        report = import_users(rows)
+        self.assertEqual([r['status'] for r in report], ['omitido', 'creado',
+                         'creado', 'omitido', 'omitido', 'error'])
+        self.assertEqual(report[1]['username'], 'jperez1')
+        self.assertEqual(report[2]['username'], 'jperez2')
+        profile = UserProfile.objects.get(dni='1')
+        self.assertTrue(profile.is_student)
+        self.assertEqual(profile.user.username, 'jperez1')
+        self.assertTrue(profile.user.check_password('1'))
+        self.assertEqual([d.code for d in profile.degrees.all()], ['GII'])
+        profile = UserProfile.objects.get(dni='2')
+        self.assertFalse(profile.is_student)
+        self.assertEqual(profile.user.email, '')
+        #Los correos quedan en el outbox hasta que los envia el comando
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboxEmail.objects.count(), 1)
+
+    def test_send_queued_mail(self):
+        """Los correos se envian y los que fallan se reintentan despues"""
+        import_users([['Juan', 'Perez', 'juan@example.com', '1', '', 'Si'],
+                      ['Ana', 'Gil', 'ana@example.com', '2', '', 'Si']])
+        with override_settings(EMAIL_BACKEND='app.tests.FailingEmailBackend'):
+            call_command('send_queued_mail', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 0)
+        email = OutboxEmail.objects.all()[0]
+        self.assertEqual(email.attempts, 1)
+        self.assertTrue(email.next_attempt > timezone.now())
+        OutboxEmail.objects.update(next_attempt=timezone.now())
+        call_command('send_queued_mail', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 2)
+        self.assertEqual(mail.outbox[0].to, ['juan@example.com'])
+        self.assertFalse(OutboxEmail.objects.filter(sent__isnull=True))
+
+    def test_enroll_dnis(self):
+        """Se matricula en varias asignaturas y se cuentan los resultados"""
+        teacher = create_profile('teacher', is_student=False)
+        today = datetime.date.today()
+        subjects = [Subject.objects.create(name='subject%i' % i,
+                                           first_date=today, last_date=today,
+                                           creator=teacher.user)
+                    for i in range(2)]
+        building = Building.objects.create(building='1')
+        room = Room.objects.create(room='1', building=building, radius=10,
+                                   centre_longitude=0, centre_latitude=0)
+        lesson = Lesson.objects.create(subject=subjects[0], room=room,
+                                       start_time=timezone.now(),
+                                       end_time=timezone.now())
+        students = [create_profile(str(i)) for i in range(3)]
+        students[0].subjects.add(subjects[0])
+        result = enroll_dnis(['0', '1', '1 ', 'unknown', 'teacher'],
+                             [s.id for s in subjects])
+        self.assertEqual(result, {'enrolled': 5, 'already_enrolled': 1,
+                                  'unknown': 1})
+        self.assertEqual(Lesson.objects.get(id=lesson.id).subject_students, 2)
+        self.assertEqual(students[1].subjects.count(), 2)
+        result = enroll_dnis(['0', '2'], [subjects[1].id])
+        self.assertEqual(result, {'enrolled': 1, 'already_enrolled': 1,
+                                  'unknown': 0})
+
+    def test_read_csv_upload(self):
+        """Las lineas se separan bien aunque se corten entre trozos"""
+        content = u'\ufeffDNI;\xd1o\r\n1;a\r\n\r\n2;\xe9\n3;b'.encode('utf-8')
+        for chunk_size in (1, 2, 3, 64):
+            lines = list(iter_upload_lines(SimpleUploadedFile('f.csv',
+                                                              content),
+                                           chunk_size=chunk_size))
+            self.assertEqual(lines, ['DNI;\xc3\x91o\r\n', '1;a\r\n',
+                                     '\r\n', '2;\xc3\xa9\n', '3;b'])
+        self.assertEqual(list(read_csv_upload(SimpleUploadedFile('f.csv',
+                                                                 content)))[3],
+                         ['2', '\xc3\xa9'])
+
+    def test_import_job(self):
+        """La subida crea una importacion que ejecuta run_import_jobs"""
+        admin = User.objects.create_superuser('admin', 'a@example.com', 'x')
+        client = Client()
+        client.login(username='admin', password='x')
+        content = 'Nombre;Apellidos;Email;DNI;Grados;Alumno\n' \
+                  'Juan;Perez;;1;;Si\nAna;Gil;;2;;No\nIncompleta\n'
+        resp = client.post('/admin/auth/user/csv/', {'csv_users':
+                           SimpleUploadedFile('users.csv', content)})
+        job = ImportJob.objects.get()
+        self.assertRedirects(resp, job.get_absolute_url())
+        self.assertEqual((job.status, job.user), ('pending', admin))
+        self.assertEqual(UserProfile.objects.count(), 0)
+        call_command('run_import_jobs', stdout=StringIO())
+        self.assertContains(client.get(job.get_absolute_url()), 'Terminada')
+        resp = client.get('/admin/import_jobs/%i/progress' % job.id)
+        progress = json.loads(resp.content)
+        self.assertEqual(progress['status'], 'done')
+        self.assertEqual([progress['rows_processed'], progress['rows_created'],
+                          progress['rows_skipped'], progress['rows_errored']],
+                         [4, 2, 1, 1])
+        self.assertTrue(UserProfile.objects.filter(dni='2',
+                                                   is_student=False))
+        #El fichero subido se borra al terminar
+        self.assertFalse(ImportJob.objects.get().csv_file)
+
+
+class FailingEmailBackend(BaseEmailBackend):
+    """Backend de correo que falla siempre, como un servidor caido"""
+    def send_messages(self, email_messages):
+        raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
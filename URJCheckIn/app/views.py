@@ -9,19 +9,28 @@ from django.contrib.auth.views import logout
 from django.contrib.auth.forms import PasswordChangeForm
 from django.views.decorators.debug import sensitive_post_parameters
 from models import (UserProfile, Lesson, Subject, CheckIn, LessonComment,
-                    ForumComment, remove_if_exists, AdminTask, get_free_room)
+                    ForumComment, remove_if_exists, AdminTask, get_free_rooms,
+                    refresh_subject_stats, subjects_stale_stats,
+                    get_active_lessons, take_seat, release_seat, SubjectStats)
+from rollup import rollup_attendance, get_subject_attendance
 from django.utils import timezone
 from forms import (ProfileEditionForm, CheckInForm, SubjectForm,
                     ExtraLessonForm, ProfileImageForm, ControlFilterForm,
-                    CodesFilterForm, ReportForm, ChangeEmailForm, FreeRoomForm)
+                    CodesFilterForm, ReportForm, ChangeEmailForm, FreeRoomForm,
+                    AttendanceExportForm)
+from checkin_buffer import checkin_buffer_enabled, get_checkin_buffer
 import datetime
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from pagination import (CursorPaginator, InvalidCursor, page_from_token,
+                        cursor_for)
 import json
-from django.db import IntegrityError
+import csv
+import random
+from django.db import IntegrityError, transaction
 import pytz
 
 WEEK_DAYS_BUT_SUNDAY = ['Lunes', 'Martes', 'Mi&eacute;rcoles', 'Jueves',
                         'Viernes', 'S&aacute;bado']
+WEEK_DAYS = WEEK_DAYS_BUT_SUNDAY + ['Domingo']
 
 def ajax_required(funct):
     """Decorator requiring an ajax request"""
@@ -34,23 +43,31 @@ def ajax_required(funct):
     return wrap
 
 
-def my_paginator(request, collection, n_elem):
+def my_paginator(request, collection, n_elem, order, param='page'):
     """
-    Pagina la coleccion de objetos collection con n_elem objetos por
-    pagina. El numero de pagina lo obtiene de el parametro 'page'
-    de la querystring de request
+    Pagina la coleccion de objetos collection ordenada por el campo
+    order (y el id) con n_elem objetos por pagina. La pagina la obtiene
+    del parametro param de la querystring de request, que es un cursor
+    de la pagina anterior (ver CursorPage), y si no es valido devuelve
+    la primera
     """
-    paginator = Paginator(collection, n_elem)
-    page = request.GET.get('page')
+    return page_from_token(CursorPaginator(collection, order, n_elem),
+                           request.GET.get(param))
+
+
+def more_page(paginator, current, newer):
+    """
+    Devuelve la pagina de paginator con los elementos anteriores en su
+    orden al cursor current si newer es True o posteriores si es False,
+    o la primera si current es '0' (no habia elementos en la pagina)
+    Si current no es valido devuelve None
+    """
+    if current == '0':
+        return paginator.page()
     try:
-        results = paginator.page(page)
-    except PageNotAnInteger:
-        #Si no es un entero devuelve la primera
-        results = paginator.page(1)
-    except EmptyPage:
-        #Si no hay tantas paginas devuelve la ultima
-        results = paginator.page(paginator.num_pages)
-    return results
+        return paginator.page(current, before=newer)
+    except InvalidCursor:
+        return None
 
 
 def response_ajax_or_not(request, ctx):
@@ -95,7 +112,8 @@ def home(request):
         return method_not_allowed(request)
 
     if request.user.is_staff:
-        tasks = AdminTask.objects.filter(done=False).order_by('time')[0:15]
+        tasks = AdminTask.objects.filter(done=False).select_related('user'
+                                                    ).order_by('time')[0:15]
     else:
         tasks = None
 
@@ -111,38 +129,56 @@ def home(request):
         week = 0
     today = datetime.date.today()
     monday = today + datetime.timedelta(days= -today.weekday() + 7*week)
-    ctx = {'events': get_week_lessons(monday, profile.subjects.all()),
+    #Se obtienen tambien la semana anterior y la siguiente para poder cambiar
+    #de semana sin pedir de nuevo la pagina
+    first_monday = monday - datetime.timedelta(days=7)
+    days = get_lessons_by_day(first_monday, first_monday +
+                              datetime.timedelta(days=20),
+                              profile.subjects.all())
+    weeks = []
+    for i in range(3):
+        weeks.append({'page': week + i - 1,
+                      'firstday': first_monday + datetime.timedelta(days=7*i),
+                      'lastday': first_monday + datetime.timedelta(days=7*i+6),
+                      'events': days[7*i:7*i+6]})#Sin el domingo
+    ctx = {'events': weeks[1]['events'], 'weeks': weeks, 'page': week,
            'firstday':monday, 'lastday':monday + datetime.timedelta(days=6),
            'previous':week-1, 'next': week+1, 'tasks': tasks,
            'htmlname': 'home.html'}
     return response_ajax_or_not(request, ctx)
 
 
-def get_week_lessons(monday, subjects):
-    """
-    Devuelve las clases de las asignaturas 'subjects' desde el lunes
-    'monday' hasta el sabado de esa misma semana
-    El formato devuelto es un array de longitud 6 y en cada posicion un
-    diccionario con clave 'day' igual al string del dia de la semana y
-    'events' con las clases de ese dia
-    """
-    events = []
-    all_lessons = Lesson.objects.filter(subject__in=subjects)
-    current_tz = str(timezone.get_current_timezone())
-    for day in WEEK_DAYS_BUT_SUNDAY:
-        date = monday + datetime.timedelta(
-                                    days=WEEK_DAYS_BUT_SUNDAY.index(day))
-        init_date = pytz.timezone(current_tz).localize(datetime.datetime(
-                            date.year, date.month, date.day), is_dst=None)
-        end_date = init_date + datetime.timedelta(days=1)
-        events.append({
-                        'day': day,
-                        'events': all_lessons.filter(
-                                start_time__gte = init_date,
-                                start_time__lt = end_date 
-                            ).order_by('start_time')
-                    })
-    return events
+def get_lessons_by_day(first_day, last_day, subjects):
+    """
+    Devuelve las clases de las asignaturas 'subjects' desde el dia
+    'first_day' hasta el dia 'last_day' (incluido), obtenidas con una
+    sola consulta junto con su asignatura, aula y edificio
+    El formato devuelto es un array con una posicion por dia y en cada
+    posicion un diccionario con clave 'date' igual a la fecha, 'day'
+    igual al string del dia de la semana y 'events' con las clases de
+    ese dia ordenadas por hora de inicio
+    """
+    current_tz = pytz.timezone(str(timezone.get_current_timezone()))
+    init_date = current_tz.localize(datetime.datetime(first_day.year,
+                        first_day.month, first_day.day), is_dst=None)
+    end_day = last_day + datetime.timedelta(days=1)
+    end_date = current_tz.localize(datetime.datetime(end_day.year,
+                        end_day.month, end_day.day), is_dst=None)
+    days = []
+    by_date = {}
+    for i in range((last_day - first_day).days + 1):
+        date = first_day + datetime.timedelta(days=i)
+        days.append({'date': date, 'day': WEEK_DAYS[date.weekday()],
+                     'events': []})
+        by_date[date] = days[-1]['events']
+    lessons = Lesson.objects.filter(subject__in=subjects,
+                                    start_time__gte=init_date,
+                                    start_time__lt=end_date
+                        ).select_related('subject', 'room__building'
+                        ).order_by('start_time')
+    for lesson in lessons:
+        by_date[timezone.localtime(lesson.start_time).date()].append(lesson)
+    return days
 
 
 def save_checkin(form, profile, lesson):
@@ -156,18 +192,29 @@ def save_checkin(form, profile, lesson):
     checkin = CheckIn(user=profile.user, lesson=lesson)
     cform = CheckInForm(form, instance=checkin)
     if cform.is_valid():
+        n_stud = None
+        if not profile.is_student:
+            try:
+                n_stud = int(form.__getitem__("n_students"))
+            except (ValueError, MultiValueDictKeyError):
+                pass
+        if checkin_buffer_enabled():
+            #Se guarda en lotes desde el hilo escritor del buffer
+            if not get_checkin_buffer().submit(cform.instance,
+                                               profile.is_student, n_stud):
+                return {'ok': False, 'form': CheckInForm(),
+                        'msg': 'Ya has realizado el checkin de esta clase'}
+            return {'ok': True, 'form': CheckInForm(),
+                    'msg': 'Checkin realizado con &eacute;xito'}
         try:
             cform.save()
         except IntegrityError:
             return {'ok': False, 'form': CheckInForm(),
                     'msg': 'Ya has realizado el checkin de esta clase'}
-        if not profile.is_student:
-            try:
-                n_stud = form.__getitem__("n_students")
-                lesson.students_counted = int(n_stud)
-                lesson.save()
-            except (ValueError, MultiValueDictKeyError):
-                pass
+        if n_stud is not None:
+            lesson.students_counted = n_stud
+            Lesson.objects.filter(id=lesson.id).update(
+                                students_counted=lesson.students_counted)
         return {'ok': True, 'form': CheckInForm(),
                 'msg': 'Checkin realizado con &eacute;xito'}
     else:
@@ -183,28 +230,33 @@ def process_checkin(request):
     """
     form = request.POST
     try:
-        idsubj = form.__getitem__("subject")
+        idsubj = int(form.__getitem__("subject"))
     except (ValueError, MultiValueDictKeyError):
         return {'msg': 'Informacion de la asignatura incorrecta.',
                 'form': CheckInForm(form)}
+    #El perfil y la matricula se obtienen en una sola consulta
     try:
-        profile = UserProfile.objects.get(user=request.user)
-        subject = profile.subjects.get(id=idsubj)
-        lesson = subject.lesson_set.get(start_time__lte=timezone.now(),
-                                        end_time__gte=timezone.now())
-    except UserProfile.DoesNotExist:
-        return {'msg': 'No tienes un perfil creado.', 
-                'form': CheckInForm(form), 'ok': False}
-    except Subject.DoesNotExist:
+        enrollment = UserProfile.subjects.through.objects.select_related(
+                            'userprofile', 'subject'
+                        ).get(userprofile__user=request.user, subject=idsubj)
+    except UserProfile.subjects.through.DoesNotExist:
+        if not UserProfile.objects.filter(user=request.user).exists():
+            return {'msg': 'No tienes un perfil creado.', 
+                    'form': CheckInForm(form), 'ok': False}
         return {'msg': 'No estas matriculado en esa asignatura.',
                 'form': CheckInForm(form), 'ok': False}
-    except Lesson.DoesNotExist:
+    profile = enrollment.userprofile
+    profile.user = request.user
+    subject = enrollment.subject
+    lessons = get_active_lessons(idsubj)
+    if not lessons:
         return {'msg': 'Ahora no hay ninguna clase de la asignatura '
                 + str(subject), 'form': CheckInForm(form), 'ok': False}
-    except Lesson.MultipleObjectsReturned:
+    if len(lessons) > 1:
         return {'msg': 'Actualmente hay dos clases de ' + str(subject) + 
                 ', por favor, contacte con un administrador',
                 'form': CheckInForm(form), 'ok': False}
+    lesson = lessons[0]
     return save_checkin(form, profile, lesson)
 
 
@@ -386,10 +438,10 @@ def process_lesson(request, idlesson):
                                 content_type="application/json")
     
     lesson_state = lesson_str_state(lesson, request.user)
-    comments = my_paginator(request,
-                            lesson.lessoncomment_set.all().order_by('-date'),
-                            10)
-    profesors = lesson.subject.userprofile_set.filter(is_student=False)
+    comments = my_paginator(request, lesson.lessoncomment_set.select_related(
+                                        'user__userprofile'), 10, '-date')
+    profesors = lesson.subject.userprofile_set.filter(is_student=False
+                                        ).select_related('user')
     ctx = {'lesson':lesson, 'comments':comments, 'profile':profile,
            'lesson_state':lesson_state, 'profesors':profesors,
            'subject': lesson.subject, 'htmlname': 'lesson.html'}
@@ -423,7 +475,8 @@ def lesson_attendance(request, idlesson):
                                    'asignatura tienen acceso.')
     
     ctx = {'lesson':lesson,
-            'checkins': lesson.checkin_set.all().order_by(\
+            'checkins': lesson.checkin_set.select_related(
+                                            'user__userprofile').order_by(
                                             'user__userprofile__is_student'),
             'htmlname': 'lesson_attendance.html'}
     return response_ajax_or_not(request, ctx)
@@ -449,8 +502,8 @@ def save_lesson_comment(request, lesson):
     if request.is_ajax():
         html = loader.get_template('pieces/comments.html').render(\
                         RequestContext(request, {'comments': [new_comment]}))
-        return {'ok': True, 'comment': html, 'idcomment': new_comment.id,
-                'idlesson':lesson.id}
+        return {'ok': True, 'comment': html, 'idlesson':lesson.id,
+                'cursor': cursor_for(new_comment, '-date')}
     else:
         return {'ok': True}
     
@@ -494,8 +547,8 @@ def forum(request):
     elif request.method != "GET":
         return method_not_allowed(request)
 
-    comments =  ForumComment.objects.all().order_by('-date')
-    ctx = {'comments': my_paginator(request, comments, 10),
+    comments =  ForumComment.objects.select_related('user__userprofile')
+    ctx = {'comments': my_paginator(request, comments, 10, '-date'),
            'htmlname': 'forum.html'}
     return response_ajax_or_not(request, ctx)
 
@@ -518,7 +571,8 @@ def save_forum_comment(request):
     if request.is_ajax():
         html = loader.get_template('pieces/comments.html').render(\
                         RequestContext(request, {'comments': [new_comment]}))
-        return {'ok': True, 'comment': html, 'idcomment': new_comment.id}
+        return {'ok': True, 'comment': html,
+                'cursor': cursor_for(new_comment, '-date')}
     else:
         return {'ok': True}
 
@@ -536,6 +590,8 @@ def subjects_page(request):
     subjects = profile.subjects.all()
     comments = LessonComment.objects.filter(
                                         lesson__subject__in = subjects
+                                    ).select_related('user__userprofile',
+                                                     'lesson__subject'
                                     ).order_by('-date')[0:15]
     ctx = {'subjects': subjects.filter(is_seminar=False),
            'seminars': subjects.filter(is_seminar=True),
@@ -633,16 +689,17 @@ def subject_page(request, idsubj):
     now = timezone.now()
     today = datetime.date(now.year, now.month, now.day)
     started = subject.first_date < today#Si ha empezado True
-    lessons_f = my_paginator(request, 
-        lessons.filter(start_time__gte=timezone.now()).order_by('end_time'),
-        10)
+    lessons_f = my_paginator(request,
+        lessons.filter(start_time__gte=timezone.now()), 10, 'end_time',
+        'page_f')
     lessons_p = my_paginator(request,
-        lessons.filter(end_time__lte=timezone.now()).order_by('-start_time'),
-        10)
+        lessons.filter(end_time__lte=timezone.now()), 10, '-start_time',
+        'page_p')
     ctx = {'lessons_f': lessons_f, 'lessons_p': lessons_p,
            'lessons_n': lessons.filter(end_time__gt=timezone.now(), 
                                        start_time__lt=timezone.now()),
-           'profesors': subject.userprofile_set.filter(is_student=False),
+           'profesors': subject.userprofile_set.filter(is_student=False
+                                        ).select_related('user'),
            'subject': subject, 'profile':profile, 'error': error,
            'signed': signed, 'started': started,
            'timetables': subject.timetable_set.all(),
@@ -672,10 +729,16 @@ def sign_in_seminar(request, subject, profile):
             profile.subjects.remove(subject)
             signed = False
         else:
-            if profile.is_student:
-                if subject.max_students <= subject.n_students():
-                    return {'error': 'No hay plazas disponibles'}
-            profile.subjects.add(subject)
+            #La plaza se ocupa con una actualizacion condicional que
+            #bloquea la asignatura hasta matricular al alumno
+            with transaction.commit_on_success():
+                if profile.is_student:
+                    if not take_seat(subject):
+                        return {'error': 'No hay plazas disponibles'}
+                    #Si otra peticion suya ya lo ha apuntado se libera
+                    if profile.subjects.filter(id=subject.id).exists():
+                        release_seat(subject)
+                profile.subjects.add(subject)
             signed = True
         if request.is_ajax():
             return {'signed': signed, 'is_student':profile.is_student,
@@ -686,32 +749,89 @@ def sign_in_seminar(request, subject, profile):
             return {'ok': True}
 
 
-@login_required
-def subject_statistics(request, idsubj):
+def get_statistics_subject(request, idsubj):
     """
-    Devuelve una pagina con las estadisticas de la asignatuda con id
-    idsubj
+    Devuelve la asignatura con id idsubj si request.user puede ver sus
+    estadisticas (esta relacionado con ella o tiene el permiso
+    can_see_statistics) y en caso contrario un string con el error
     """
     try:
         subject = Subject.objects.get(id=idsubj)
-        profile = subject.userprofile_set.get(user=request.user)
+        subject.userprofile_set.get(user=request.user)
     except Subject.DoesNotExist:
-        return send_error_page(request, '#404 La asignatura a la que ' +
-                               'intentas acceder no existe.')
+        return '#404 La asignatura a la que intentas acceder no existe.'
     except UserProfile.DoesNotExist:
         #Si controla las estadisticas tiene acceso
         if not request.user.has_perm('app.can_see_statistics'):
-            return send_error_page(request, 'No tienes acceso a esta ' +
-                                   'informaci&oacute;n.')
+            return 'No tienes acceso a esta informaci&oacute;n.'
+    return subject
+
+
+@login_required
+def subject_statistics(request, idsubj):
+    """
+    Devuelve una pagina con las estadisticas de la asignatuda con id
+    idsubj. Los datos de las graficas se piden a subject_statistics_data
+    """
+    subject = get_statistics_subject(request, idsubj)
+    if not isinstance(subject, Subject):
+        return send_error_page(request, subject)
     ctx = {'subject': subject, 'htmlname': 'subject_statistics.html',
            'lessons_done': subject.lesson_set.filter(
-                                done=True).order_by('start_time'),
-           'n_lessons_past': subject.lesson_set.filter(
-                                end_time__lte=timezone.now()).count()
-          }
+                                done=True).order_by('start_time')}
     return response_ajax_or_not(request, ctx)
 
 
+@login_required
+def subject_statistics_data(request, idsubj):
+    """
+    Devuelve un objeto JSON con las series de las graficas de
+    estadisticas de la asignatura con id idsubj: fecha, porcentaje de
+    asistencia y valoracion media de cada clase realizada, y el numero
+    de clases realizadas, pasadas y totales. Se obtiene todo con una
+    sola consulta sobre los contadores de las clases
+    """
+    if request.method != 'GET':
+        return method_not_allowed(request)
+    subject = get_statistics_subject(request, idsubj)
+    if not isinstance(subject, Subject):
+        return HttpResponse(json.dumps({'error': subject}),
+                            content_type="application/json")
+
+    now = timezone.now()
+    resp = {'dates': [], 'attendance': [], 'marks': [], 'n_lessons': 0,
+            'n_lessons_past': 0, 'n_lessons_done': 0}
+    n_checkins = 0
+    lessons = subject.lesson_set.order_by('start_time').values_list(
+                    'start_time', 'end_time', 'done', 'stud_checkins',
+                    'mark_sum', 'mark_count', 'subject_students')
+    for (start_time, end_time, done, checkins, mark_sum, mark_count,
+         lesson_students) in lessons:
+        resp['n_lessons'] += 1
+        if end_time <= now:
+            resp['n_lessons_past'] += 1
+        if not done:
+            continue
+        resp['n_lessons_done'] += 1
+        n_checkins += checkins
+        resp['dates'].append(timezone.localtime(start_time).strftime(
+                                                                '%Y-%m-%d'))
+        if lesson_students > 0:
+            resp['attendance'].append(round(100.0*checkins/lesson_students,
+                                            2))
+        else:
+            resp['attendance'].append(100)
+        if mark_count > 0:
+            resp['marks'].append(round(float(mark_sum)/mark_count, 2))
+        else:
+            resp['marks'].append(3)
+    #Alumnos matriculados ahora (ver update_subject_students)
+    n_div = subject.seats_taken*resp['n_lessons_done']
+    resp['percent_stud'] = 100 if n_div < 1 else round(100.0*n_checkins/n_div,
+                                                       2)
+    return HttpResponse(json.dumps(resp), content_type="application/json")
+
+
 @login_required
 def subject_attendance(request, idsubj):
     """
@@ -739,26 +859,55 @@ def subject_attendance(request, idsubj):
             return send_error_page(request,
                                  'No tienes acceso a esta informaci&oacute;n.')
     
-    students = subject.userprofile_set.filter(is_student=True)
-    lessons = subject.lesson_set.filter(done=True)
-    n_lessons = lessons.count()
-    checkins = CheckIn.objects.filter(lesson__in = lessons)
-    students_info = []
-    for student in students:
-        if n_lessons > 0:
-            n_checkins = checkins.filter(user=student.user).count()
-            percent = round(100.0 * n_checkins / n_lessons, 2)
-        else:
-            percent = 0
-        students_info.append({'id': student.user.id, 'percent': percent,
-                              'name': student.user.first_name + ' ' +
-                              student.user.last_name, 'dni': student.dni})
+    students_info = get_students_attendance(subject)
+    out_format = request.GET.get('format')
+    if out_format == 'json':
+        return HttpResponse(json.dumps({'subject': subject.id,
+                                        'students': students_info}),
+                            content_type="application/json")
+    elif out_format == 'csv':
+        resp = HttpResponse(content_type='text/csv')
+        resp['Content-Disposition'] = ('attachment; filename="asistencia_' +
+                                       str(subject.id) + '.csv"')
+        writer = csv.writer(resp, delimiter=';')
+        writer.writerow(['DNI', 'Nombre', 'Checkins', 'Asistencia'])
+        for student in students_info:
+            writer.writerow([student['dni'].encode('utf-8'),
+                             student['name'].encode('utf-8'),
+                             student['n_checkins'], student['percent']])
+        return resp
         
     ctx = {'students': students_info, 'subject': subject,
            'htmlname': 'subject_attendance.html'}
     return response_ajax_or_not(request, ctx)
 
 
+def get_students_attendance(subject):
+    """
+    Devuelve una lista con un diccionario por cada alumno de la
+    asignatura subject con su id de usuario, nombre, dni, numero de
+    checkins y porcentaje de asistencia a las clases realizadas
+    Las clases y los checkins se leen de la asistencia semanal
+    (AttendanceFact), tras aplicar los cambios pendientes de la asignatura
+    """
+    rollup_attendance(subjects=[subject.id])
+    n_lessons, n_checkins = get_subject_attendance(subject.id)
+    students = subject.userprofile_set.filter(is_student=True
+                ).order_by('user__last_name', 'user__first_name').values_list(
+                    'user__id', 'user__first_name', 'user__last_name', 'dni')
+    students_info = []
+    for iduser, first_name, last_name, dni in students:
+        checkins = n_checkins.get(iduser, 0)
+        if n_lessons > 0:
+            percent = round(100.0 * checkins / n_lessons, 2)
+        else:
+            percent = 0
+        students_info.append({'id': iduser, 'percent': percent,
+                              'name': first_name + ' ' + last_name,
+                              'dni': dni, 'n_checkins': checkins})
+    return students_info
+
+
 @login_required
 def subject_edit(request, idsubj):
     """Devuelve la pagina para editar o eliminar una asignatura"""
@@ -904,27 +1053,34 @@ def edit_lesson(request, idlesson):
 @login_required
 def free_room(request):
     """
-    Devuelve un aula libre en la franja horaria solicitada y en el
-    edificio solicitado
+    Devuelve un aula libre (y la lista de todas las aulas libres) en la
+    franja horaria solicitada y en los edificios solicitados
     """
     if request.method != 'GET':
         return method_not_allowed(request)
     form = FreeRoomForm(request.GET)
     f_room = False
+    f_rooms = []
     if form.is_valid():
         data = form.cleaned_data
-        f_room = get_free_room(data['start_time'], data['end_time'],
-                               data['building'])
-        if not f_room:
-            f_room = 'No hay aulas libres en el ' + str(data['building'])
+        f_rooms = get_free_rooms(data['start_time'], data['end_time'],
+                                 data['building'])
+        if f_rooms:
+            #Al azar para no ocupar siempre las mismas aulas
+            f_room = random.choice(f_rooms)
+        else:
+            f_room = 'No hay aulas libres en el ' + ', '.join(
+                        [str(building) for building in data['building']])
         if request.is_ajax():
             return HttpResponse(json.dumps({'ok': True,
-                                            'free_room': str(f_room)}), 
+                                            'free_room': str(f_room),
+                                            'free_rooms': [str(room) for room
+                                                           in f_rooms]}),
                                 content_type="application/json")
     elif request.is_ajax():
         return HttpResponse(json.dumps({'ok': False, 'errors': form.errors}), 
                             content_type="application/json")
-    ctx = {'room_form': form, 'free_room': f_room,
+    ctx = {'room_form': form, 'free_room': f_room, 'free_rooms': f_rooms,
            'htmlname': 'freeroom.html'}
     return response_ajax_or_not(request, ctx)
 
@@ -951,7 +1107,8 @@ def reports_page(request):
             if request.is_ajax():
                 html = loader.get_template('pieces/reports.html').render(\
                                 RequestContext(request, {'reports':[report]}))
-                resp = {'report':html, 'ok': True, 'idreport': report.id}
+                resp = {'report':html, 'ok': True,
+                        'cursor': cursor_for(report, '-time')}
                 return HttpResponse(json.dumps(resp),
                                     content_type="application/json")
             else:
@@ -959,9 +1116,8 @@ def reports_page(request):
 
     if request.method != 'POST':
         form = ReportForm()
-    reports = my_paginator(
-        request, AdminTask.objects.filter(user=request.user).order_by('-time'),
-        10)
+    reports = my_paginator(request, AdminTask.objects.filter(
+                                        user=request.user), 10, '-time')
     ctx = {'form': form, 'reports': reports, 'htmlname': 'reports.html'}
     return response_ajax_or_not(request, ctx)
 
@@ -977,16 +1133,35 @@ def control_attendance(request):
                                 'informaci&oacute;n.')
 
     form = ControlFilterForm(request.GET)
-    all_subj = control_order(form, control_filter(form))
-    subjects = my_paginator(request, all_subj, 10)
+    #Se filtra y ordena por las estadisticas que recalcula periodicamente
+    #el comando refresh_stats (cron), y de la pagina se recalculan las que
+    #han cambiado para mostrarlas al dia
+    all_subj = control_filter(form).select_related('stats'
+                                  ).prefetch_related('degrees')
+    subjects = my_paginator(request, all_subj, 10, control_order(form))
+    ids = [subject.id for subject in subjects]
+    if refresh_subject_stats(subjects_stale_stats().filter(id__in=ids)):
+        stats = dict((stats.subject_id, stats) for stats in
+                     SubjectStats.objects.filter(subject__in=ids))
+        for subject in subjects:
+            subject._stats_cache = stats[subject.id]
+    #Profesores de todas las asignaturas de la pagina en una consulta
+    professors = {}
+    for enrollment in UserProfile.subjects.through.objects.filter(
+                            subject__in=ids,
+                            userprofile__is_student=False
+                        ).select_related('userprofile__user'):
+        professors.setdefault(enrollment.subject_id, []).append(
+                                                    enrollment.userprofile)
     subjects_wrap = []
     for subject in subjects:
-        element =  {'professors': subject.userprofile_set.filter(\
-                    is_student=False), 'subject': subject}
+        element =  {'professors': professors.get(subject.id, []),
+                    'subject': subject}
         subjects_wrap.append(element)
     url_page = prepare_url_pagination(request.get_full_path())
     ctx = {'form': form, 'rows': subjects_wrap, 'subjects': subjects, 
-           'htmlname': 'control_attendance.html', 'url_page': url_page}
+           'htmlname': 'control_attendance.html', 'url_page': url_page,
+           'export_form': AttendanceExportForm(auto_id='export_%s')}
     return response_ajax_or_not(request, ctx)
 
     
@@ -1011,8 +1186,8 @@ def prepare_url_pagination(full_url):
 
 def control_filter(form):
     """
-    Filtra las asignaturas por nombre, profesor y grado segun el form
-    del tipo ControlFilterForm
+    Filtra las asignaturas por nombre, profesor, grado y porcentaje
+    maximo de asistencia segun el form del tipo ControlFilterForm
     """
     all_subj = Subject.objects.all()
     if not form.is_valid():
@@ -1045,12 +1220,20 @@ def control_filter(form):
                     userprofile__is_student=False,
                     userprofile__user__last_name__contains=f_prof_1).distinct()
 
+    f_max_prof = data['max_prof_attend']
+    if f_max_prof is not None:
+        all_subj = all_subj.filter(stats__percent_prof__lte=f_max_prof)
+
+    f_max_stud = data['max_stud_attend']
+    if f_max_stud is not None:
+        all_subj = all_subj.filter(stats__percent_stud__lte=f_max_stud)
+
     return all_subj
 
-def control_order(form, subjects):
+def control_order(form):
     """
-    Ordena las asignaturas por nombre, fecha de inicio o fecha de
-    finlaizacion
+    Devuelve el orden de las asignaturas: por nombre, fecha de inicio,
+    fecha de finlaizacion, asistencia o valoracion media
     """
     if form.is_valid():
         data = form.cleaned_data
@@ -1059,7 +1242,7 @@ def control_order(form, subjects):
             order = '-' + order
     else:
         order = 'name'
-    return subjects.order_by(order)
+    return order
 
 
 @login_required
@@ -1097,7 +1280,7 @@ def codes_filter(form):
     """
     if not form.is_valid():
         return {}
-    all_lessons = Lesson.objects.all()
+    all_lessons = Lesson.objects.select_related('subject', 'room__building')
     data = form.cleaned_data
     f_type = data['subject_type']    
     if f_type == 'Sem':
@@ -1174,82 +1357,45 @@ def get_lesson_comments(request, idlesson):
     except UserProfile.DoesNotExist:
         if not request.user.has_perm('app.can_see_statistics'):
             return False
-    return LessonComment.objects.filter(lesson=lesson)
-
-
-def get_more_comments_threshold(is_lesson, idcurrent):
-    """
-    Devuelve el momento de publicacion del comentario idcurrent
-    Si is_lesson es True lo busca en LessonComment y en caso contrario
-    en ForumComment
-    Si no existe el comentario devuelve False, y si idcurrent es menor
-    que 0 devuelve el dia anterior a la hora actual
-    """
-    if idcurrent > 0:
-        try:
-            if is_lesson:
-                comment = LessonComment.objects.get(id=idcurrent)
-            else:
-                comment = ForumComment.objects.get(id=idcurrent)
-        except (ForumComment.DoesNotExist, LessonComment.DoesNotExist):
-            return False
-        current_date = comment.date
-    else: #Para el caso en el que no hubiese ningun mensaje en la pagina
-        current_date = timezone.now() - datetime.timedelta(days=1)
-    return current_date
+    return LessonComment.objects.filter(lesson=lesson).select_related(
+                                                        'user__userprofile')
 
 
 @login_required
 @ajax_required
 def more_comments(request, current, idlesson, newer):
     """
-    Si newer = True devuelve un fragmento html con 10 comentarios mas
-    nuevos que num ordenados de mas nuevo a mas antiguo. Si newer = 
-    False los anteriores.
-    Ademas indica si son newer y el id del mas reciente/mas antiguo (si
-    no hay devuelve 0)
+    Si newer = True devuelve un fragmento html con los 10 comentarios
+    mas nuevos que el del cursor current (los mas cercanos a el)
+    ordenados de mas nuevo a mas antiguo. Si newer = False los 10
+    anteriores. Si current es '0' los 10 ultimos
+    Ademas indica si son newer y el cursor del mas reciente/mas antiguo
+    (si no hay devuelve '')
     Si idlesson es menor que 1 los coge del foro y si no de la lesson
     con id idlesson
     """
-    current = int(current)
     idlesson = int(idlesson)
     newer = (newer == 'true')
-    current_date = get_more_comments_threshold(idlesson > 0, current)
-    if not current_date:
-        resp = {'comments': [], 'idcomment': 0, 'newer': True}
-        return HttpResponse(json.dumps(resp),
-                            content_type="application/json")
-        
     if idlesson > 0:
         all_comments = get_lesson_comments(request, idlesson)
         if not all_comments:
-            resp = {'comments': [], 'idcomment': 0, 'newer': True}
+            resp = {'comments': [], 'cursor': '', 'newer': True}
             return HttpResponse(json.dumps(resp),
                                     content_type="application/json")
     else:
-        all_comments = ForumComment.objects.all()
-
-    if newer:
-        comments = all_comments.filter(date__gt=current_date).order_by('-date')
-        #Se tiene que hacer asi porque si se hace el slice primero con
-        #order_by('date') y luego se llama a reverse() se seleccionan los 10 
-        #elementos opuestos
-        n_comments = comments.count()
-        if n_comments > 10:
-            comments = comments[n_comments-10:]
-    else:
-        comments = all_comments.filter(date__lt=current_date).order_by(\
-                                                                '-date')[0:10]
-    if comments:
-        if newer:
-            idcomment = comments[0].id
-        else:
-            idcomment = comments[comments.count()-1].id
-    else:
-        idcomment = 0
+        all_comments = ForumComment.objects.select_related(
+                                                        'user__userprofile')
+
+    comments = more_page(CursorPaginator(all_comments, '-date'), current,
+                         newer)
+    if comments is None:
+        resp = {'comments': [], 'cursor': '', 'newer': True}
+        return HttpResponse(json.dumps(resp),
+                            content_type="application/json")
+    cursor = comments.first_cursor() if newer else comments.last_cursor()
     html = loader.get_template('pieces/comments.html').render(\
                                 RequestContext(request, {'comments':comments}))
-    resp = {'comments':html, 'newer':newer, 'idcomment':idcomment,
+    resp = {'comments':html, 'newer':newer, 'cursor':cursor,
             'idlesson':idlesson}
     return HttpResponse(json.dumps(resp), content_type="application/json")
 
@@ -1265,13 +1411,16 @@ def more_lessons(request, current, newer):
     Ademas indica si son newer y el id de la ultima lesson que devuelve
     (si no hay devuelve 0)
     """
-    current = int(current)
     newer = (newer == 'true')
+    #Las siguientes clases van por orden de fin y las anteriores de inicio
+    #hacia atras, como en subject_page
+    order = 'end_time' if newer else '-start_time'
     try:
-        lesson = Lesson.objects.get(id=current)
-        subject = lesson.subject
-    except Lesson.DoesNotExist:
-        resp = {'lessons': [], 'newer': newer, 'idlesson': 0}
+        idcurrent = CursorPaginator(Lesson.objects.all(),
+                                    order).decode(current)[1]
+        subject = Subject.objects.get(lesson=idcurrent)
+    except (InvalidCursor, Subject.DoesNotExist):
+        resp = {'lessons': [], 'newer': newer, 'cursor': ''}
         return HttpResponse(json.dumps(resp), content_type="application/json")
     #no tiene acceso a asignaturas que no tiene (a no ser que tenga permiso
     #can_see_statistics)
@@ -1280,28 +1429,19 @@ def more_lessons(request, current, newer):
         try:
             profile = request.user.userprofile
         except UserProfile.DoesNotExist:
-            resp = {'lessons': [], 'newer': newer, 'idlesson': 0}
+            resp = {'lessons': [], 'newer': newer, 'cursor': ''}
             return HttpResponse(json.dumps(resp),
                                 content_type="application/json")
-        if not subject in profile.subjects.all():
-            resp = {'lessons': [], 'newer': newer, 'idlesson': 0}
+        if not profile.subjects.filter(id=subject.id).exists():
+            resp = {'lessons': [], 'newer': newer, 'cursor': ''}
             return HttpResponse(json.dumps(resp),
                                 content_type="application/json")
 
-    all_lessons = Lesson.objects.filter(subject=subject.id)
-    if newer:
-        lessons = all_lessons.filter(end_time__gt=lesson.end_time).\
-                                                order_by('end_time')[0:10]
-    else:
-        lessons = all_lessons.filter(start_time__lt=lesson.start_time).\
-                                                order_by('-start_time')[0:10]
-    if lessons:
-        idlesson = lessons[lessons.count()-1].id
-    else:
-        idlesson = 0
+    lessons = CursorPaginator(Lesson.objects.filter(subject=subject.id),
+                              order).page(current)
     html = loader.get_template('pieces/lessons.html').render(RequestContext(
                                 request, {'lessons':lessons, 'future':newer}))
-    resp = {'lessons': html, 'newer': newer, 'idlesson': idlesson}
+    resp = {'lessons': html, 'newer': newer, 'cursor': lessons.last_cursor()}
     return HttpResponse(json.dumps(resp), content_type="application/json")
 
 
@@ -1315,36 +1455,15 @@ def more_reports(request, current, newer):
     Ademas indica si son newer y el id del mas reciente/mas antiguo (si
     no hay devuelve 0)
     """
-    current = int(current)
     newer = (newer == 'true')
-    try:
-        report = AdminTask.objects.get(id=current)
-    except AdminTask.DoesNotExist:
-        resp = {'reports': [], 'newer': newer, 'idreport': 0}
+    reports = more_page(CursorPaginator(AdminTask.objects.filter(
+                                        user=request.user), '-time'),
+                        current, newer)
+    if reports is None:
+        resp = {'reports': [], 'newer': newer, 'cursor': ''}
         return HttpResponse(json.dumps(resp), content_type="application/json")
-
-    all_reports = AdminTask.objects.filter(user=request.user)
-    if newer:
-        reports = all_reports.filter(time__gt=report.time).order_by('-time')
-        #Se tiene que hacer asi porque si se hace el slice primero con
-        #order_by('time') y luego se llama a reverse() se seleccionan los 10
-        #elementos opuestos
-        n_reports = reports.count()
-        if n_reports > 10:
-            reports = reports[n_reports-10:]
-    else:
-        reports = all_reports.filter(time__lt=report.time).\
-                                                    order_by('-time')[0:10]
-
-    if reports:
-        if newer:
-            idreport = reports[0].id
-        else:
-            idreport = reports[reports.count()-1].id
-    else:
-        idreport = 0
+    cursor = reports.first_cursor() if newer else reports.last_cursor()
     html = loader.get_template('pieces/reports.html').render(RequestContext(
                                                 request, {'reports':reports}))
-    resp = {'reports':html, 'newer':newer, 'idreport':idreport}
+    resp = {'reports':html, 'newer':newer, 'cursor':cursor}
     return HttpResponse(json.dumps(resp), content_type="application/json")
-
@@ -26,17 +26,18 @@ function commentSaved(data) {
 	enableButtons(['#comment_button']);
 }
 
-/* Pide mas comentarios, si newer es True pide mas recientes y si es False anteriores
+/* Pide mas comentarios a partir del comentario con cursor cursor, si newer es True
+	pide mas recientes y si es False anteriores
 	Si idlesson es menor que 0 los pide del foro y si es mayor de la clase con id idlesson*/
-function askComments(idcomment, idlesson, newer) {
+function askComments(cursor, idlesson, newer) {
 	disableButtons(['#ask_newer', '#ask_older']);
-	path = '/more/comments/' + idcomment + '/' + idlesson + '/' + newer;
+	path = '/more/comments/' + cursor + '/' + idlesson + '/' + newer;
 	$.getJSON(path, commentsReceived);
 }
 
 /* Coloca los mensajes recibidos en su sitio (en las paginas /forum o /lesson/id */
 function commentsReceived(data) {
-	if (data.idcomment == 0) {
+	if (!data.cursor) {
 		if (!data.newer) {
 			$('#ask_older').replaceWith('<div class="btn btn-primary ' +
 							'btn-sm btn-block disabled">No hay mensajes anteriores</div>')
@@ -45,12 +46,12 @@ function commentsReceived(data) {
 		if (data.newer) {
 			$('#comment_list > li:first').before(data.comments);
 			$('#ask_newer').attr('onClick', 
-						'askComments(' + data.idcomment + ',' + data.idlesson + 
+						'askComments(\'' + data.cursor + '\',' + data.idlesson + 
 						', true);return false;');
 		} else {
 			$('#comment_list > li:last').after(data.comments);
 			$('#ask_older').attr('onClick', 
-						'askComments(' + data.idcomment + ',' + data.idlesson + 
+						'askComments(\'' + data.cursor + '\',' + data.idlesson + 
 						', false);return false;');
 		}
 	}
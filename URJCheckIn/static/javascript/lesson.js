@@ -33,8 +33,14 @@ function freeRoomReceived(data) {
 			alertBefore(data.errors[error], 
 				'#group_fr_'+error, alert_class, 'danger', '#free_room_form');
 	} else if (data.ok) {
-		alertBefore('Aula libre: ' + data.free_room, 
-				'#free_room_form button', alert_class, 'success', '#free_room_form');
+		var msg = 'Aula libre: ' + data.free_room;
+		var others = data.free_rooms.filter(function(room) {
+			return room != data.free_room;
+		});
+		if (others.length > 0)
+			msg += '<br/>Otras aulas libres: ' + others.join('; ');
+		alertBefore(msg, '#free_room_form button', alert_class, 'success',
+				'#free_room_form');
 	} else {
 		alert("Se ha producido un error");
 	}
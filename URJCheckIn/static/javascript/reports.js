@@ -25,15 +25,16 @@ function reportSaved(data) {
 	enableButtons(['#report_problem button']);
 }
 
-/* Pide mas reportes, si newer es True pide mas recientes y si es False anteriores */
-function askReports(idreport, newer) {
+/* Pide mas reportes a partir del reporte con cursor cursor, si newer es True pide
+	mas recientes y si es False anteriores */
+function askReports(cursor, newer) {
 	disableButtons(['#ask_newer', '#ask_older']);
-	$.getJSON('/more/reports/' + idreport + '/' + newer, reportsReceived);
+	$.getJSON('/more/reports/' + cursor + '/' + newer, reportsReceived);
 }
 
 /* Coloca los reportes recibidos arriba o abajo de la lista de reportes */
 function reportsReceived(data) {
-	if (data.idreport == 0) {
+	if (!data.cursor) {
 		if (!data.newer) {
 			$('#ask_older').replaceWith('<div class="btn btn-primary ' +
 							'btn-sm btn-block disabled">No hay m&aacute;s reportes</div>')
@@ -42,11 +43,11 @@ function reportsReceived(data) {
 		if (data.newer) {
 			$('#reports_list > li:first').before(data.reports);
 			$('#ask_newer').attr('onClick', 
-						'askReports(' + data.idreport + ', true);return false;');
+						'askReports(\'' + data.cursor + '\', true);return false;');
 		} else {
 			$('#reports_list > li:last').after(data.reports);
 			$('#ask_older').attr('onClick', 
-						'askReports(' + data.idreport + ', false);return false;');
+						'askReports(\'' + data.cursor + '\', false);return false;');
 		}
 	}
 	enableButtons(['#ask_newer', '#ask_older']);
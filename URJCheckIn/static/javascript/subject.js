@@ -74,14 +74,14 @@ function newChangeSignButton(text, type, logo) {
 }
 
 
-/* Pide mas clases a partir de idlesson, si newer es True pide las 
+/* Pide mas clases a partir de la clase con cursor cursor, si newer es True pide las 
 	clases siguientes y si es False las pasadas */
-function askLessons(idlesson, newer) {
+function askLessons(cursor, newer) {
 	if (newer) 
 		disableButtons(['#ask_newer']);
 	else
 		disableButtons(['#ask_older']);
-	$.getJSON('/more/lessons/' + idlesson + '/' + newer, lessonsReceived);
+	$.getJSON('/more/lessons/' + cursor + '/' + newer, lessonsReceived);
 }
 
 /* Coloca las clases recibidas en su sitio */
@@ -91,7 +91,7 @@ function lessonsReceived(data) {
 	} else {
 		var button = $('#ask_older')
 	}
-	if (data.idlesson == 0) {
+	if (!data.cursor) {
 		button.replaceWith('<div class="btn btn-primary ' +
 							'btn-sm btn-block disabled">No hay m&aacute;s clases</div>');
 	} else {
@@ -101,7 +101,7 @@ function lessonsReceived(data) {
 			$('#past_lessons > a:last').after(data.lessons);
 		}
 		button.attr('onClick', 
-					'askLessons(' + data.idlesson + ',' + data.newer + ');return false;');
+					'askLessons(\'' + data.cursor + '\',' + data.newer + ');return false;');
 	}
 	button.removeAttr("disabled"); 
 }